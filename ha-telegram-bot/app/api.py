@@ -9,6 +9,7 @@ from __future__ import annotations
 import asyncio
 import json
 import logging
+import time
 from typing import Any
 
 import aiohttp
@@ -19,11 +20,17 @@ HA_BASE_URL = "http://supervisor/core/api"
 HA_TIMEOUT = aiohttp.ClientTimeout(total=30, sock_connect=10, sock_read=20)
 MAX_RETRIES = 3
 RETRY_BACKOFF_BASE: float = 1.0
+STATE_CACHE_TTL: float = 3.0  # seconds a fetched entity state is reused
+OPTIMISTIC_STATE_TTL: float = 1.5  # seconds a locally patched state is trusted
+MAX_CONCURRENT_REQUESTS = 8  # in-flight HA requests across all chats
 
 
 class HAClient:
     """Reuses a single aiohttp.ClientSession.
     Retries transient errors with exponential back-off.
+    Caches single-entity states and the full state list for a few seconds
+    so one menu render (or a burst of taps / page flips) does not fetch
+    the same data repeatedly.
     """
 
     def __init__(self, supervisor_token: str) -> None:
@@ -32,6 +39,21 @@ class HAClient:
             "Content-Type": "application/json",
         }
         self._session: aiohttp.ClientSession | None = None
+        # entity_id -> (fetched_at monotonic, state dict)
+        self._state_cache: dict[str, tuple[float, dict[str, Any]]] = {}
+        # Bumped by invalidate(); a fetch that started under an older
+        # generation may predate the change and is returned but not cached
+        self._generation = 0
+        # (fetched_at monotonic, all states) from the last list_states()
+        self._states_list: tuple[float, list[dict[str, Any]]] | None = None
+        # Concurrent list_states() misses share one GET instead of each fetching
+        self._states_lock = asyncio.Lock()
+        # Entities cached while a list_states() GET is in flight; their
+        # entries are newer than the list and are not reseeded from it
+        self._cached_during_list: set[str] | None = None
+        # Caps fan-out (menus fetching many states) so one busy chat cannot
+        # flood the Supervisor proxy; retry back-off sleeps do not hold it
+        self._inflight = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
 
     async def open(self) -> None:
         self._session = aiohttp.ClientSession(timeout=HA_TIMEOUT)
@@ -56,7 +78,7 @@ class HAClient:
 
         for attempt in range(1, MAX_RETRIES + 1):
             try:
-                async with self._session.request(
+                async with self._inflight, self._session.request(
                     method, url, json=json_data, headers=self._headers
                 ) as resp:
                     if resp.status in (200, 201):
@@ -125,6 +147,8 @@ class HAClient:
         ok, result = await self._request(
             "POST", f"services/{domain}/{service}", json_data=data
         )
+        # Targets are about to change state; untargeted calls may touch anything
+        self.invalidate(data.get("entity_id"))
         if ok:
             logger.info(
                 "Service called: %s.%s entity=%s",
@@ -134,16 +158,91 @@ class HAClient:
         return False, str(result)
 
     async def get_state(self, entity_id: str) -> dict[str, Any] | None:
-        """Return entity state dict or None on failure."""
+        """Return entity state dict or None on failure.
+
+        Successful results are cached for STATE_CACHE_TTL seconds.
+        """
+        now = time.monotonic()
+        cached = self._state_cache.get(entity_id)
+        if cached is not None and now - cached[0] < STATE_CACHE_TTL:
+            return cached[1]
+        generation = self._generation
         ok, result = await self._request("GET", f"states/{entity_id}")
-        return result if ok and isinstance(result, dict) else None
+        if ok and isinstance(result, dict):
+            if generation == self._generation:
+                self._state_cache[entity_id] = (now, result)
+                if self._cached_during_list is not None:
+                    self._cached_during_list.add(entity_id)
+            return result
+        self._state_cache.pop(entity_id, None)
+        return None
+
+    def patch_state(
+        self, entity_id: str, base: dict[str, Any] | None, *,
+        state: str | None = None, **attributes: Any,
+    ) -> None:
+        """Cache *base* with the outcome of a successful service call applied.
+
+        Lets the follow-up render skip a refetch.  The entry expires after
+        OPTIMISTIC_STATE_TTL, so a state HA did not actually reach is
+        corrected by the next real fetch.  No-op without a base state.
+        """
+        if base is None:
+            return
+        patched = {**base, "attributes": {**base.get("attributes", {}), **attributes}}
+        if state is not None:
+            patched["state"] = state
+        fetched_at = time.monotonic() - STATE_CACHE_TTL + OPTIMISTIC_STATE_TTL
+        self._state_cache[entity_id] = (fetched_at, patched)
+        if self._cached_during_list is not None:
+            self._cached_during_list.add(entity_id)
+
+    def invalidate(self, entity_id: str | list[str] | None = None) -> None:
+        """Drop cached state for one or more entities (all when None)."""
+        # Any change also makes the full state list stale
+        self._states_list = None
+        self._generation += 1
+        if entity_id is None:
+            self._state_cache.clear()
+        elif isinstance(entity_id, str):
+            self._state_cache.pop(entity_id, None)
+        else:
+            for eid in entity_id:
+                self._state_cache.pop(eid, None)
 
     async def list_states(self) -> list[dict[str, Any]]:
-        """Return all entity states or empty list on failure."""
-        ok, result = await self._request("GET", "states")
-        if ok and isinstance(result, list):
-            return result
-        return []
+        """Return all entity states or empty list on failure.
+
+        A successful result is reused for STATE_CACHE_TTL seconds and
+        shared between callers — do not modify it.  It also seeds the
+        per-entity cache, so get_state() right after a bulk fetch is free.
+        """
+        cached = self._states_list
+        if cached is not None and time.monotonic() - cached[0] < STATE_CACHE_TTL:
+            return cached[1]
+        async with self._states_lock:
+            # Another caller may have fetched while we waited
+            now = time.monotonic()
+            cached = self._states_list
+            if cached is not None and now - cached[0] < STATE_CACHE_TTL:
+                return cached[1]
+            generation = self._generation
+            newer = self._cached_during_list = set()
+            try:
+                ok, result = await self._request("GET", "states")
+            finally:
+                self._cached_during_list = None
+            if ok and isinstance(result, list):
+                if generation != self._generation:
+                    return result
+                self._states_list = (now, result)
+                state_cache = self._state_cache
+                for s in result:
+                    eid = s.get("entity_id")
+                    if eid and eid not in newer:
+                        state_cache[eid] = (now, s)
+                return result
+            return []
 
     async def list_services(self) -> list[dict[str, Any]]:
         """Return all available services or empty list on failure."""
@@ -27,7 +27,7 @@ import logging
 import os
 import re
 import sys
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
 from typing import Any
 
@@ -113,6 +113,13 @@ class Config:
     radio_stations: tuple[dict[str, str], ...]
     device_overrides: dict[str, dict[str, Any]]
     terminal_enabled: bool
+    # Derived: set form of menu_domains_allowlist for membership checks
+    menu_domains_allowlist_set: frozenset[str] = field(init=False)
+
+    def __post_init__(self) -> None:
+        object.__setattr__(
+            self, "menu_domains_allowlist_set", frozenset(self.menu_domains_allowlist),
+        )
 
 
 def _coerce_user_ids(raw: Any) -> list[int]:
@@ -647,6 +654,14 @@ class TelegramBot:
         if self._error_capture is not None:
             logging.getLogger().removeHandler(self._error_capture)
 
+        # Let in-flight handler work (menu-state writes, stepper flushes)
+        # finish while the HA session and database are still open
+        if self._handlers is not None:
+            try:
+                await self._handlers.close()
+            except Exception as exc:
+                errors.append(f"handlers: {exc}")
+
         for label, coro in [
             ("scheduler", self._scheduler.stop()),
             ("notifications", self._notif.stop()),
@@ -120,8 +120,10 @@ class Diagnostics:
 
     async def get_diagnostics_text(self) -> str:
         """Full diagnostics report as formatted text."""
-        info = await self.debug_info()
-        errors = await self._db.get_recent_errors(5)
+        # The HA probe and the error-log read are independent
+        info, errors = await asyncio.gather(
+            self.debug_info(), self._db.get_recent_errors(5),
+        )
 
         lines = [
             "\U0001f6e0 <b>Diagnostics</b>\n",
@@ -13,9 +13,15 @@ from __future__ import annotations
 import asyncio
 import json
 import logging
+import math
 import re
+import sys
 import time
-from datetime import datetime, timezone
+from collections import OrderedDict, deque
+from collections.abc import Callable, Coroutine
+from contextvars import Context, ContextVar
+from dataclasses import dataclass
+from functools import lru_cache
 from typing import Any
 
 from aiogram import Bot
@@ -30,6 +36,7 @@ from state_mapping import map_state
 from storage import Database
 from ui import (
     COLOR_PRESETS,
+    RGB_COLOR_MODES,
     build_active_now_menu,
     build_areas_menu,
     build_automations_menu,
@@ -48,6 +55,7 @@ from ui import (
     build_main_menu,
     build_media_source_menu,
     build_notif_list,
+    build_pin_button,
     build_radio_menu,
     build_roles_list,
     build_scenarios_menu,
@@ -82,11 +90,41 @@ _ALLOWED_SERVICES: frozenset[str] = frozenset({
     "set_temperature",
 })
 
-_ENTITY_ID_RE = re.compile(r"^[a-z][a-z0-9_]*\.[a-z0-9][a-z0-9_\-]*$")
+# Entity ids are ASCII; use with fullmatch() (unlike "$", it rejects a trailing newline)
+_ENTITY_ID_RE = re.compile(r"[a-z][a-z0-9_]*\.[a-z0-9][a-z0-9_\-]*", re.ASCII)
+
+
+@lru_cache(maxsize=1024)
+def _service_target(eid: str, service: str) -> tuple[str, str] | None:
+    """Validate an act:/nact: target; return (domain, "domain.service").
+
+    None when the entity id is malformed or the service is not allowed.
+    Buttons are tapped repeatedly, so each pair is checked once.
+    """
+    if service not in _ALLOWED_SERVICES or not _ENTITY_ID_RE.fullmatch(eid):
+        return None
+    domain = eid.partition(".")[0]
+    return domain, sys.intern(f"{domain}.{service}")
+
+
+# Entity id prefixes offered as one-tap quick scenes in an area
+_SCENE_PREFIXES = ("scene.", "script.")
+
+# Vacuum commands offered as one-tap vcmd: buttons
+_VAC_SIMPLE_CMDS: frozenset[str] = frozenset({"stop", "return_to_base"})
+
+# "Active now" keeps one entity per device, preferring the lowest-ranked domain
+_ACTIVE_DOMAIN_RANK: dict[str, int] = {
+    "vacuum": 0, "media_player": 1, "climate": 2, "light": 3,
+    "cover": 4, "fan": 5, "switch": 6, "lock": 7, "water_heater": 8,
+}
 
 # Role hierarchy levels
 _ROLE_LEVELS: dict[str, int] = {"admin": 3, "user": 2, "guest": 1}
 
+# Seconds a user's role is reused before re-reading it from the DB
+_ROLE_CACHE_TTL: float = 60.0
+
 # Write-action callback prefixes that require at least "user" role
 _WRITE_PREFIXES: frozenset[str] = frozenset({
     "act", "bright", "clim", "fav", "ntog", "vseg", "vcmd", "rtn",
@@ -100,6 +138,56 @@ _WRITE_PREFIXES: frozenset[str] = frozenset({
 # Prefixes exempt from idempotency guard (debounce-eligible rapid taps)
 _DEBOUNCE_PREFIXES: frozenset[str] = frozenset({"bright", "mvol"})
 
+# Identical (uid, callback_data) within this window is dropped as a double tap
+_DUPLICATE_CB_WINDOW_NS = 250_000_000
+
+# Both sets folded into one lookup for the callback dispatcher
+_PF_WRITE = 1
+_PF_DEBOUNCE = 2
+_PREFIX_FLAGS: dict[str, int] = {
+    sys.intern(p): (_PF_WRITE if p in _WRITE_PREFIXES else 0)
+    | (_PF_DEBOUNCE if p in _DEBOUNCE_PREFIXES else 0)
+    for p in _WRITE_PREFIXES | _DEBOUNCE_PREFIXES
+}
+
+# Callback menu renders closer together than this are coalesced per chat
+_EDIT_DEBOUNCE_SECONDS: float = 0.35
+
+# Manual refresh reuses a registry sync younger than this instead of re-syncing
+_REFRESH_FRESH_SECONDS: float = 2.0
+
+# Breadcrumb entries kept per chat; the oldest fall off
+_NAV_STACK_DEPTH = 20
+
+# Brightness/volume taps closer together than this are sent as one service call
+_STEPPER_DEBOUNCE_SECONDS: float = 0.25
+
+# Favorite/notification toggles closer together than this re-render once
+_TOGGLE_REFRESH_SECONDS: float = 0.15
+
+# nav:back replays a cached screen younger than this instead of re-dispatching
+_NAV_SCREEN_TTL: float = 15.0
+_NAV_SCREENS_PER_CHAT = _NAV_STACK_DEPTH
+
+# Search stops scanning once this many entities matched
+_SEARCH_MAX_RESULTS = 200
+
+# Snapshot diff stops comparing once this many changed entities are listed
+_SNAP_DIFF_MAX_LINES = 30
+
+# Callback being dispatched in the current task, the tapping user and the
+# nav pushes it made; lets _send_or_edit remember which callback produced a screen
+_dispatch_ctx: ContextVar[tuple[str, int, list[str]] | None] = ContextVar("dispatch_ctx", default=None)
+
+
+def _cb_args(data: str) -> tuple[str, str] | None:
+    """Split "prefix:a:b" into (a, b); None when there are fewer than two fields.
+
+    *b* keeps any further colons, like ``data.split(":", 2)[2]``.
+    """
+    a, sep, b = data.partition(":")[2].partition(":")
+    return (a, b) if sep else None
+
 
 # ---------------------------------------------------------------------------
 # Global rate limiter
@@ -110,17 +198,76 @@ class GlobalRateLimiter:
     def __init__(self, max_actions: int, window_seconds: int) -> None:
         self._max = max_actions
         self._window = window_seconds
-        self._timestamps: list[float] = []
+        # Ascending action times; expired ones are evicted from the left
+        self._timestamps: deque[float] = deque(maxlen=max_actions)
 
     def check(self) -> bool:
-        now = time.monotonic()
-        cutoff = now - self._window
-        self._timestamps = [t for t in self._timestamps if t > cutoff]
-        return len(self._timestamps) < self._max
+        cutoff = time.monotonic() - self._window
+        ts = self._timestamps
+        while ts and ts[0] <= cutoff:
+            ts.popleft()
+        return len(ts) < self._max
 
     def record(self) -> None:
         self._timestamps.append(time.monotonic())
 
+    def try_acquire(self) -> bool:
+        """check() + record() in one sweep: take a slot if one is free."""
+        now = time.monotonic()
+        cutoff = now - self._window
+        ts = self._timestamps
+        while ts and ts[0] <= cutoff:
+            ts.popleft()
+        if len(ts) >= self._max:
+            return False
+        ts.append(now)
+        return True
+
+
+# ---------------------------------------------------------------------------
+# Bounded per-user / per-chat state
+# ---------------------------------------------------------------------------
+
+# Max users/chats tracked in each in-memory state map
+_STATE_MAP_CAP = 1024
+
+
+class _LRUDict(OrderedDict):
+    """OrderedDict that drops the least recently written key past *cap*.
+
+    Writes (``d[k] = v`` and ``setdefault``) mark a key as recent; plain
+    reads do not. Keeps per-user/per-chat state bounded on open bots.
+    """
+
+    def __init__(self, cap: int = _STATE_MAP_CAP) -> None:
+        super().__init__()
+        self._cap = cap
+
+    def __setitem__(self, key: Any, value: Any) -> None:
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if len(self) > self._cap:
+            self.popitem(last=False)
+
+    def setdefault(self, key: Any, default: Any = None) -> Any:
+        if key in self:
+            self.move_to_end(key)
+            return self[key]
+        self[key] = default
+        return default
+
+
+@dataclass(slots=True)
+class _Stepper:
+    """Pending brightness/volume target and its flush timer for one key."""
+
+    target: float
+    handle: asyncio.TimerHandle | None = None
+    # (flush, args) the armed timer will run; lets shutdown run it early
+    flush: tuple[Callable[..., Coroutine[Any, Any, None]], tuple[Any, ...]] | None = None
+    # HA state read on the first tap, patched optimistically after the flush
+    base: dict[str, Any] | None = None
+
 
 # ---------------------------------------------------------------------------
 # Audit helper
@@ -171,25 +318,51 @@ class Handlers:
         self._device_overrides = getattr(config, "device_overrides", {})
         self.ha_version: str = "unknown"
 
-        # In-memory search result cache: chat_id -> entity list
-        self._search_cache: dict[int, list[dict[str, Any]]] = {}
+        # In-memory search result cache: chat_id -> (entity list, cut at the cap)
+        self._search_cache: dict[int, tuple[list[dict[str, Any]], bool]] = _LRUDict()
+        # Last "active now" list per chat, for pagination: chat_id -> entity list
+        self._active_cache: dict[int, list[dict[str, Any]]] = _LRUDict()
+        # Data derived from the last state list: key -> (that list, data)
+        self._state_views: dict[str, tuple[list[dict[str, Any]], Any]] = {}
         # Navigation breadcrumb stack: chat_id -> [callback, ...]
-        self._nav_stack: dict[int, list[str]] = {}
+        self._nav_stack: dict[int, deque[str]] = _LRUDict()
+        # Screens rendered by callbacks, replayed by nav:back. Keyed per user
+        # too: screens such as ar: carry the tapping user's pin state.
+        # chat_id -> {(user_id, callback): (monotonic ts, text, kb, render opts, nav pushes)}
+        self._nav_screens: dict[int, dict[tuple[int, str], tuple[float, int, str, InlineKeyboardMarkup, dict[str, Any], list[str]]]] = _LRUDict()
         # Radio state per chat: chat_id -> {station_idx, player_eid, playing}
-        self._radio_state: dict[int, dict[str, Any]] = {}
-
-        # Per-user callback serialization lock
-        self._user_locks: dict[int, asyncio.Lock] = {}
-        # Idempotency guard: uid -> (callback_data, timestamp)
-        self._last_cb: dict[int, tuple[str, float]] = {}
-
-        # Debounce state for brightness / volume
-        self._pending_brightness: dict[tuple[int, int, str], int] = {}
-        self._pending_volume: dict[tuple[int, int, str], float] = {}
-        self._debounce_tasks: dict[tuple[int, int, str], asyncio.Task[None]] = {}
+        self._radio_state: dict[int, dict[str, Any]] = _LRUDict()
+        # Registry-derived menu data (floor/area aggregates, per-area device
+        # lists, per-device entity ids): key -> ((reg version, domains, show_all), data)
+        self._menu_cache: dict[str, tuple[tuple[int, frozenset[str], bool], Any]] = _LRUDict()
+        # Menu state per chat, hydrated from the DB on first use; the DB copy
+        # is written through in the background (see _save_menu_state)
+        self._menu_state: dict[int, dict[str, Any]] = _LRUDict()
+        self._bg_tasks: set[asyncio.Task[None]] = set()
+        # Last menu render per chat: chat_id -> (message_id, render key)
+        self._last_render: dict[int, tuple[int, int]] = _LRUDict()
+        # Menu edit coalescing: time of last Telegram render per chat, and
+        # the latest deferred payload / its flush task
+        self._edit_last: dict[int, float] = _LRUDict()
+        self._edit_pending: dict[int, tuple[str, InlineKeyboardMarkup, dict[str, Any]]] = {}
+        self._edit_tasks: dict[int, asyncio.Task[None]] = {}
+        # Telegram flood control: chat_id -> monotonic time the 429 penalty ends
+        self._chat_penalty: dict[int, float] = _LRUDict()
+
+        # Per-user serialization lock for write callbacks
+        self._user_locks: dict[int, asyncio.Lock] = _LRUDict()
+        # Role cache: uid -> (role, monotonic fetch time)
+        self._role_cache: dict[int, tuple[str, float]] = _LRUDict()
+        # Idempotency guard: uid -> (callback_data, monotonic_ns timestamp)
+        self._last_cb: dict[int, tuple[str, int]] = _LRUDict()
+
+        # Debounce state for brightness / volume: (cid, uid, eid) -> stepper
+        self._steppers: dict[tuple[int, int, str], _Stepper] = {}
+        # Deferred screen refresh after toggles: chat_id -> timer
+        self._refresh_handles: dict[int, asyncio.TimerHandle] = {}
 
         # To-do: pending add item state: chat_id -> list_entity_id
-        self._todo_add_pending: dict[int, str] = {}
+        self._todo_add_pending: dict[int, str] = _LRUDict()
 
     # -----------------------------------------------------------------------
     # Security
@@ -201,9 +374,19 @@ class Handlers:
     def _is_authorized_user(self, user_id: int) -> bool:
         return not self._cfg.allowed_user_ids or user_id in self._cfg.allowed_user_ids
 
+    async def _get_role(self, user_id: int) -> str:
+        """User role, cached for _ROLE_CACHE_TTL (cmd_role invalidates)."""
+        now = time.monotonic()
+        cached = self._role_cache.get(user_id)
+        if cached is not None and now - cached[1] < _ROLE_CACHE_TTL:
+            return cached[0]
+        role = await self._db.get_user_role(user_id)
+        self._role_cache[user_id] = (role, now)
+        return role
+
     async def _check_role(self, user_id: int, min_role: str) -> bool:
         """Check if user has at least min_role level."""
-        role = await self._db.get_user_role(user_id)
+        role = await self._get_role(user_id)
         return _ROLE_LEVELS.get(role, 2) >= _ROLE_LEVELS.get(min_role, 2)
 
     @staticmethod
@@ -224,26 +407,119 @@ class Handlers:
     # Message management
     # -----------------------------------------------------------------------
 
+    @staticmethod
+    def _render_key(
+        text: str, kb: InlineKeyboardMarkup, menu: str, entity: str | None, room: str | None,
+    ) -> int:
+        """Hash of everything an edit would change (message + saved menu state)."""
+        buttons = tuple(
+            tuple((b.text, b.callback_data, b.url) for b in row)
+            for row in kb.inline_keyboard
+        )
+        return hash((text, buttons, menu, entity, room))
+
     async def _send_or_edit(
         self, chat_id: int, text: str, kb: InlineKeyboardMarkup, *,
         source: Message | None = None,
         menu: str = "main", entity: str | None = None, room: str | None = None,
         thread_id: int | None = None,
     ) -> None:
-        msg_id = await self._db.get_menu_message_id(chat_id)
+        """Render the chat's menu, coalescing rapid callback re-renders.
+
+        The first render goes out at once; further callback renders within
+        _EDIT_DEBOUNCE_SECONDS of the last Telegram call are collapsed into
+        one trailing render of the latest payload. Commands (source set)
+        render immediately and supersede any pending trailing render.
+        While the chat is under a Telegram 429 penalty every render is
+        deferred until it expires; a deferred command keeps its source.
+        """
+        opts: dict[str, Any] = {"menu": menu, "entity": entity, "room": room, "thread_id": thread_id}
+        now = time.monotonic()
+        ctx = _dispatch_ctx.get()
+        if ctx is not None and source is None and ctx[0] != "nav:back":
+            screens = self._nav_screens.setdefault(chat_id, _LRUDict(_NAV_SCREENS_PER_CHAT))
+            screens[(ctx[1], ctx[0])] = (now, self._reg.version, text, kb, opts, ctx[2])
+        penalty = self._chat_penalty.get(chat_id, 0.0) - now
+        if source is not None and penalty <= 0:
+            # Superseded: a still-sleeping flush would otherwise wake up and
+            # take the payload of the next deferred render early
+            self._edit_pending.pop(chat_id, None)
+            task = self._edit_tasks.pop(chat_id, None)
+            if task is not None:
+                task.cancel()
+        else:
+            # A deferred command still sends a fresh menu and deletes the
+            # command message, even if a callback render replaces its payload
+            pending = self._edit_pending.get(chat_id)
+            if source is None and pending is not None:
+                source = pending[2].get("source")
+            if source is not None:
+                opts = {**opts, "source": source}
+            if pending is not None:
+                self._edit_pending[chat_id] = (text, kb, opts)
+                return
+            wait = max(self._edit_last.get(chat_id, 0.0) + _EDIT_DEBOUNCE_SECONDS - now, penalty)
+            if wait > 0:
+                self._edit_pending[chat_id] = (text, kb, opts)
+                self._edit_tasks[chat_id] = asyncio.create_task(
+                    self._flush_edit(chat_id, wait), name=f"menu_edit_{chat_id}",
+                    context=Context(),
+                )
+                return
+        await self._render_menu(chat_id, text, kb, source=source, **opts)
+
+    async def _flush_edit(self, chat_id: int, delay: float) -> None:
+        await asyncio.sleep(delay)
+        # A 429 may have arrived after this flush was scheduled
+        remaining = self._chat_penalty.get(chat_id, 0.0) - time.monotonic()
+        while remaining > 0:
+            await asyncio.sleep(remaining)
+            remaining = self._chat_penalty.get(chat_id, 0.0) - time.monotonic()
+        self._edit_tasks.pop(chat_id, None)
+        pending = self._edit_pending.pop(chat_id, None)
+        if pending is None:
+            return
+        text, kb, opts = pending
+        try:
+            await self._render_menu(chat_id, text, kb, **opts)
+        except Exception:
+            logger.exception("Deferred menu render failed for chat %s", chat_id)
+
+    async def _render_menu(
+        self, chat_id: int, text: str, kb: InlineKeyboardMarkup, *,
+        source: Message | None = None,
+        menu: str = "main", entity: str | None = None, room: str | None = None,
+        thread_id: int | None = None,
+    ) -> None:
+        state = await self._get_menu_state(chat_id)
+        msg_id = state["message_id"] if state else None
+        render_key = self._render_key(text, kb, menu, entity, room)
 
         if msg_id is not None:
+            # Identical re-render of the current menu (repeated tap): Telegram
+            # would reject it as "message is not modified", so skip the call.
+            # Commands (source set) keep falling through to a fresh send.
+            if source is None and self._last_render.get(chat_id) == (msg_id, render_key):
+                return
+            self._edit_last[chat_id] = time.monotonic()
             try:
                 await self._bot.edit_message_text(
                     text=text, chat_id=chat_id, message_id=msg_id,
                     parse_mode="HTML", reply_markup=kb,
                 )
-                await self._db.save_menu_state(chat_id, msg_id, menu, entity, room)
+                self._save_menu_state(chat_id, msg_id, menu, entity, room)
+                self._last_render[chat_id] = (msg_id, render_key)
                 return
             except TelegramRetryAfter as e:
                 logger.warning("Rate limited %ss", e.retry_after)
+                self._chat_penalty[chat_id] = time.monotonic() + e.retry_after
                 return
-            except (TelegramBadRequest, TelegramForbiddenError):
+            except (TelegramBadRequest, TelegramForbiddenError) as exc:
+                if source is None and "message is not modified" in str(exc):
+                    self._save_menu_state(chat_id, msg_id, menu, entity, room)
+                    self._last_render[chat_id] = (msg_id, render_key)
+                    return
+                self._last_render.pop(chat_id, None)
                 try:
                     await self._bot.delete_message(chat_id=chat_id, message_id=msg_id)
                 except (TelegramBadRequest, TelegramForbiddenError):
@@ -262,13 +538,75 @@ class Handlers:
             }
             if thread_id is not None:
                 kwargs["message_thread_id"] = thread_id
+            self._edit_last[chat_id] = time.monotonic()
             sent = await self._bot.send_message(**kwargs)
-            await self._db.save_menu_state(chat_id, sent.message_id, menu, entity, room)
+            self._save_menu_state(chat_id, sent.message_id, menu, entity, room)
+            self._last_render[chat_id] = (sent.message_id, render_key)
         except TelegramRetryAfter as e:
             logger.warning("Rate limited on send %ss", e.retry_after)
+            self._chat_penalty[chat_id] = time.monotonic() + e.retry_after
         except (TelegramBadRequest, TelegramForbiddenError) as exc:
             logger.error("Failed to send menu: %s", exc)
 
+    async def _get_menu_state(self, chat_id: int) -> dict[str, Any] | None:
+        state = self._menu_state.get(chat_id)
+        if state is None:
+            state = await self._db.get_menu_state(chat_id)
+            if state is not None:
+                self._menu_state[chat_id] = state
+        return state
+
+    def _save_menu_state(
+        self, chat_id: int, message_id: int, menu: str,
+        entity: str | None, room: str | None,
+    ) -> None:
+        self._menu_state[chat_id] = {
+            "message_id": message_id,
+            "current_menu": menu,
+            "selected_entity": entity,
+            "selected_room": room,
+            "updated_at": time.time(),
+        }
+        self._spawn(
+            self._db.save_menu_state(chat_id, message_id, menu, entity, room),
+            name="save_menu_state",
+        )
+
+    def _spawn(self, coro: Coroutine[Any, Any, None], *, name: str) -> None:
+        """Run *coro* in a tracked background task; failures are logged.
+
+        The task gets a fresh context, so its renders are not remembered as
+        screens of the callback that spawned it.
+        """
+        task = asyncio.create_task(coro, name=name, context=Context())
+        self._bg_tasks.add(task)
+        task.add_done_callback(self._on_bg_task_done)
+
+    async def close(self) -> None:
+        """Flush pending stepper calls and wait for background tasks to finish.
+
+        Called on shutdown before the database and HA session close, so the
+        last menu-state write or service call is not lost.
+        """
+        for handle in self._refresh_handles.values():
+            handle.cancel()
+        self._refresh_handles.clear()
+        # Debounced brightness/volume taps are sent now instead of dropped
+        for key, entry in list(self._steppers.items()):
+            if entry.handle is not None and entry.flush is not None:
+                entry.handle.cancel()
+                self._fire_debounced(key, *entry.flush)
+        # Tasks may spawn follow-ups (a flush re-rendering the menu)
+        while self._bg_tasks:
+            await asyncio.gather(*self._bg_tasks, return_exceptions=True)
+        for task in self._edit_tasks.values():
+            task.cancel()
+
+    def _on_bg_task_done(self, task: asyncio.Task[None]) -> None:
+        self._bg_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Background task %s failed", task.get_name(), exc_info=task.exception())
+
     # -----------------------------------------------------------------------
     # Rate limits
     # -----------------------------------------------------------------------
@@ -281,7 +619,7 @@ class Handlers:
         if not allowed:
             await cb.answer(f"\u23f1\ufe0f Подождите {remaining:.1f}с.", show_alert=True)
             return False
-        if not self._rl.check():
+        if not self._rl.try_acquire():
             await cb.answer("\U0001f6a6 Лимит. Подождите.", show_alert=True)
             return False
         return True
@@ -292,15 +630,18 @@ class Handlers:
 
     def _push_nav(self, cid: int, cb: str) -> None:
         """Push a callback onto the navigation stack for this chat."""
-        stack = self._nav_stack.setdefault(cid, [])
+        ctx = _dispatch_ctx.get()
+        if ctx is not None:
+            ctx[2].append(cb)
+        stack = self._nav_stack.get(cid)
+        if stack is None:
+            stack = self._nav_stack[cid] = deque(maxlen=_NAV_STACK_DEPTH)
         if not stack or stack[-1] != cb:
             stack.append(cb)
-        if len(stack) > 20:
-            stack[:] = stack[-20:]
 
     def _pop_nav(self, cid: int) -> str:
         """Pop the navigation stack and return the previous callback."""
-        stack = self._nav_stack.get(cid, [])
+        stack = self._nav_stack.get(cid)
         if stack:
             stack.pop()  # remove current
         if stack:
@@ -333,13 +674,13 @@ class Handlers:
         await self._send_or_edit(cid, text, kb, source=message, menu="main", thread_id=tid)
 
     async def cmd_status(self, message: Message) -> None:
-        uid, uname = self._extract_user(message)
-        if uid is None:
-            return
         cid = message.chat.id
         if not self._is_authorized_chat(cid):
             await message.answer("\u26d4 Неавторизованный чат.")
             return
+        uid, uname = self._extract_user(message)
+        if uid is None:
+            return
         await _audit(self._db, chat_id=cid, user_id=uid, username=uname,
                      action="/status", success=True)
         entities = await self._fetch_status_entities()
@@ -348,17 +689,17 @@ class Handlers:
         await self._send_or_edit(cid, text, kb, source=message, menu="status", thread_id=tid)
 
     async def cmd_ping(self, message: Message) -> None:
-        ts = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC")
+        ts = time.strftime("%Y-%m-%d %H:%M:%S UTC", time.gmtime())
         await message.answer(f"pong  |  HA {self.ha_version}  |  {ts}")
 
     async def cmd_search(self, message: Message) -> None:
-        uid, uname = self._extract_user(message)
-        if uid is None:
-            return
         cid = message.chat.id
         if not self._is_authorized_chat(cid):
             await message.answer("\u26d4 Неавторизованный чат.")
             return
+        uid, uname = self._extract_user(message)
+        if uid is None:
+            return
 
         # Extract query from /search <query>
         parts = (message.text or "").split(maxsplit=1)
@@ -373,12 +714,12 @@ class Handlers:
         await self._do_search(cid, uid, query, message=message)
 
     async def cmd_health(self, message: Message) -> None:
-        uid, uname = self._extract_user(message)
-        if uid is None:
-            return
         cid = message.chat.id
         if not self._is_authorized_chat(cid):
             return
+        uid, uname = self._extract_user(message)
+        if uid is None:
+            return
         health = await self._diag.health_check()
         status = health["status"]
         icon = "\u2705" if status == "ok" else "\u26a0\ufe0f"
@@ -392,12 +733,12 @@ class Handlers:
         await message.answer("\n".join(lines), parse_mode="HTML")
 
     async def cmd_diag(self, message: Message) -> None:
-        uid, uname = self._extract_user(message)
-        if uid is None:
-            return
         cid = message.chat.id
         if not self._is_authorized_chat(cid):
             return
+        uid, uname = self._extract_user(message)
+        if uid is None:
+            return
         if not await self._check_role(uid, "admin"):
             await message.answer("\u26d4 Требуются права администратора.")
             return
@@ -407,12 +748,12 @@ class Handlers:
         await self._send_or_edit(cid, text, kb, source=message, menu="diag", thread_id=tid)
 
     async def cmd_trace(self, message: Message) -> None:
-        uid, uname = self._extract_user(message)
-        if uid is None:
-            return
         cid = message.chat.id
         if not self._is_authorized_chat(cid):
             return
+        uid, uname = self._extract_user(message)
+        if uid is None:
+            return
         if not await self._check_role(uid, "admin"):
             await message.answer("\u26d4 Требуются права администратора.")
             return
@@ -420,17 +761,17 @@ class Handlers:
         await message.answer(trace, parse_mode="HTML")
 
     async def cmd_snapshot(self, message: Message) -> None:
-        uid, uname = self._extract_user(message)
-        if uid is None:
-            return
         cid = message.chat.id
         if not self._is_authorized_chat(cid):
             return
+        uid, uname = self._extract_user(message)
+        if uid is None:
+            return
 
         parts = (message.text or "").split(maxsplit=1)
         snap_name = parts[1].strip() if len(parts) > 1 else ""
         if not snap_name:
-            snap_name = datetime.now(timezone.utc).strftime("snap_%Y%m%d_%H%M%S")
+            snap_name = time.strftime("snap_%Y%m%d_%H%M%S", time.gmtime())
 
         states = await self._ha.list_states()
         payload = [
@@ -445,24 +786,24 @@ class Handlers:
         )
 
     async def cmd_snapshots(self, message: Message) -> None:
-        uid, uname = self._extract_user(message)
-        if uid is None:
-            return
         cid = message.chat.id
         if not self._is_authorized_chat(cid):
             return
+        uid, uname = self._extract_user(message)
+        if uid is None:
+            return
         snaps = await self._db.get_snapshots(uid)
         text, kb = build_snapshots_list(snaps)
         tid = self._get_thread_id(message)
         await self._send_or_edit(cid, text, kb, source=message, menu="snapshots", thread_id=tid)
 
     async def cmd_schedule(self, message: Message) -> None:
-        uid, uname = self._extract_user(message)
-        if uid is None:
-            return
         cid = message.chat.id
         if not self._is_authorized_chat(cid):
             return
+        uid, uname = self._extract_user(message)
+        if uid is None:
+            return
 
         parts = (message.text or "").split(maxsplit=1)
         args = parts[1].strip() if len(parts) > 1 else ""
@@ -506,7 +847,7 @@ class Handlers:
             await message.answer("\u274c Сервис должен быть в формате domain.service")
             return
 
-        domain, service = service_str.split(".", 1)
+        domain, _, service = service_str.partition(".")
         nr = next_cron_time(cron_expr)
         if nr == 0.0:
             await message.answer("\u274c Не удалось вычислить следующий запуск.")
@@ -521,12 +862,12 @@ class Handlers:
         )
 
     async def cmd_role(self, message: Message) -> None:
-        uid, uname = self._extract_user(message)
-        if uid is None:
-            return
         cid = message.chat.id
         if not self._is_authorized_chat(cid):
             return
+        uid, uname = self._extract_user(message)
+        if uid is None:
+            return
         if not await self._check_role(uid, "admin"):
             await message.answer("\u26d4 Требуются права администратора.")
             return
@@ -539,10 +880,12 @@ class Handlers:
                 await message.answer("\u274c user_id должен быть числом.")
                 return
             role = parts[2].lower()
-            if role not in ("admin", "user", "guest"):
+            if role not in _ROLE_LEVELS:
                 await message.answer("\u274c Роль: admin / user / guest")
                 return
             await self._db.set_user_role(target_uid, role)
+            self._role_cache.pop(target_uid, None)
+            self._nav_screens.pop(cid, None)
             await message.answer(f"\u2705 Пользователь {target_uid} → {role}")
             return
 
@@ -552,25 +895,26 @@ class Handlers:
         await self._send_or_edit(cid, text, kb, source=message, menu="roles", thread_id=tid)
 
     async def cmd_export_settings(self, message: Message) -> None:
-        uid, uname = self._extract_user(message)
-        if uid is None:
-            return
         cid = message.chat.id
         if not self._is_authorized_chat(cid):
             return
+        uid, uname = self._extract_user(message)
+        if uid is None:
+            return
         data = await self._db.export_user_settings(uid)
-        text = json.dumps(data, ensure_ascii=False, indent=2)
+        # Indented dumps of a large export is slow; keep it off the event loop
+        text = await asyncio.to_thread(json.dumps, data, ensure_ascii=False, indent=2)
         if len(text) > 4000:
             text = text[:4000] + "\n... (truncated)"
         await message.answer(f"<pre>{text}</pre>", parse_mode="HTML")
 
     async def cmd_import_settings(self, message: Message) -> None:
-        uid, uname = self._extract_user(message)
-        if uid is None:
-            return
         cid = message.chat.id
         if not self._is_authorized_chat(cid):
             return
+        uid, uname = self._extract_user(message)
+        if uid is None:
+            return
         parts = (message.text or "").split(maxsplit=1)
         json_str = parts[1].strip() if len(parts) > 1 else ""
         if not json_str:
@@ -587,23 +931,23 @@ class Handlers:
         await message.answer(f"\u2705 Импортировано: {count} записей.")
 
     async def cmd_notify_test(self, message: Message) -> None:
-        uid, uname = self._extract_user(message)
-        if uid is None:
-            return
         cid = message.chat.id
         if not self._is_authorized_chat(cid):
             return
+        uid, uname = self._extract_user(message)
+        if uid is None:
+            return
         result = await self._diag.notify_test(self._bot, cid)
         await message.answer(result)
 
     async def handle_text_search(self, message: Message) -> None:
         """Handle plain text messages as search queries or to-do add input."""
-        uid, uname = self._extract_user(message)
-        if uid is None:
-            return
         cid = message.chat.id
         if not self._is_authorized_chat(cid):
             return
+        uid, uname = self._extract_user(message)
+        if uid is None:
+            return
         if not self._is_authorized_user(uid):
             return
 
@@ -622,6 +966,8 @@ class Handlers:
                 logger.exception("Todo add item failed")
                 ok, err = False, str(exc)[:200]
             if ok:
+                # Cached screens may show the list before this item
+                self._nav_screens.pop(cid, None)
                 await _audit(self._db, chat_id=cid, user_id=uid, username=uname,
                              action="todo.add", entity_id=list_eid, success=True)
             else:
@@ -629,7 +975,7 @@ class Handlers:
             await self._show_todo_items(cid, list_eid, 0)
             return
 
-        menu_state = await self._db.get_menu_state(cid)
+        menu_state = await self._get_menu_state(cid)
         if not menu_state or menu_state.get("current_menu") != "search":
             return
 
@@ -648,15 +994,15 @@ class Handlers:
             await callback.answer("Сообщение устарело.", show_alert=True)
             return
         cid = callback.message.chat.id
+        if not self._is_authorized_chat(cid):
+            await callback.answer("\u26d4 Неавторизованный чат.", show_alert=True)
+            return
         uid, uname = self._extract_user(callback)
         if uid is None:
             await callback.answer("Не удалось определить пользователя.", show_alert=True)
             return
         data = callback.data or ""
 
-        if not self._is_authorized_chat(cid):
-            await callback.answer("\u26d4 Неавторизованный чат.", show_alert=True)
-            return
         if not self._is_authorized_user(uid):
             await _audit(self._db, chat_id=cid, user_id=uid, username=uname,
                          action=data, success=False, error="Unauth user")
@@ -664,39 +1010,58 @@ class Handlers:
             return
 
         # Idempotency guard: reject duplicate (uid, data) within 0.25s
-        prefix = data.split(":", 1)[0] if ":" in data else data
-        now = time.time()
+        # partition() avoids a list allocation; interning lets the _ROUTES
+        # lookup match the (already interned) literal keys by identity
+        prefix = sys.intern(data.partition(":")[0])
+        flags = _PREFIX_FLAGS.get(prefix, 0)
+        now = time.monotonic_ns()
         last = self._last_cb.get(uid)
-        if last and last[0] == data and (now - last[1]) < 0.25 and prefix not in _DEBOUNCE_PREFIXES:
+        if last and last[0] == data and now - last[1] < _DUPLICATE_CB_WINDOW_NS and not flags & _PF_DEBOUNCE:
             await callback.answer()
             return
         self._last_cb[uid] = (data, now)
 
+        if not flags & _PF_WRITE:
+            # Navigation only reads state and edits the menu; it need not
+            # queue behind another tap's slow Telegram call
+            await self._dispatch(prefix, cid, uid, uname, data, callback)
+            return
+
         # Role check for write actions
-        if prefix in _WRITE_PREFIXES:
-            if not await self._check_role(uid, "user"):
-                await callback.answer("\u26d4 Недостаточно прав (guest).", show_alert=True)
-                return
+        if not await self._check_role(uid, "user"):
+            await callback.answer("\u26d4 Недостаточно прав (guest).", show_alert=True)
+            return
+
+        # Cached screens may show state this action changes
+        self._nav_screens.pop(cid, None)
 
-        # Per-user lock to serialize callback handling
+        # Per-user lock to serialize write actions (service calls, DB toggles)
         lock = self._user_locks.setdefault(uid, asyncio.Lock())
         async with lock:
-            try:
-                handler = self._ROUTES.get(prefix)
-                if handler:
-                    await handler(self, cid, uid, uname, data, callback)
-                else:
-                    await callback.answer("Неизвестное действие.", show_alert=True)
-            except Exception:
-                logger.exception("Callback error: %s", data)
-                await callback.answer("Произошла ошибка.", show_alert=True)
+            await self._dispatch(prefix, cid, uid, uname, data, callback)
+
+    async def _dispatch(
+        self, prefix: str, cid: int, uid: int, uname: str, data: str, callback: CallbackQuery,
+    ) -> None:
+        token = _dispatch_ctx.set((data, uid, []))
+        try:
+            handler = self._ROUTES.get(prefix)
+            if handler:
+                await handler(self, cid, uid, uname, data, callback)
+            else:
+                await callback.answer("Неизвестное действие.", show_alert=True)
+        except Exception:
+            logger.exception("Callback error: %s", data)
+            await callback.answer("Произошла ошибка.", show_alert=True)
+        finally:
+            _dispatch_ctx.reset(token)
 
     # -----------------------------------------------------------------------
     # nav: — back navigation
     # -----------------------------------------------------------------------
 
     async def _nav(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
-        target = data.split(":", 1)[1] if ":" in data else "main"
+        target = data.partition(":")[2] or "main"
         await cb.answer()
         if target == "main":
             self._clear_nav(cid)
@@ -714,10 +1079,19 @@ class Handlers:
                 self._clear_nav(cid)
                 t, k = build_main_menu()
                 await self._send_or_edit(cid, t, k, menu="main")
+            elif (screen := self._nav_screens.get(cid, {}).get((uid, prev))) and (
+                time.monotonic() - screen[0] < _NAV_SCREEN_TTL
+                and screen[1] == self._reg.version
+            ):
+                # Replay the screen this callback rendered moments ago
+                # instead of re-fetching its data
+                _, _, t, k, opts, pushes = screen
+                for nav_cb in pushes:
+                    self._push_nav(cid, nav_cb)
+                await self._send_or_edit(cid, t, k, **opts)
             else:
                 # Simulate the callback by re-dispatching
-                prefix = prev.split(":", 1)[0] if ":" in prev else prev
-                handler = self._ROUTES.get(prefix)
+                handler = self._ROUTES.get(sys.intern(prev.partition(":")[0]))
                 if handler:
                     await handler(self, cid, uid, uname, prev, cb)
                 else:
@@ -732,7 +1106,7 @@ class Handlers:
     # -----------------------------------------------------------------------
 
     async def _menu(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
-        target = data.split(":", 1)[1] if ":" in data else ""
+        target = data.partition(":")[2]
         await cb.answer()
 
         if target == "manage" or target == "devices":
@@ -789,29 +1163,92 @@ class Handlers:
             self._push_nav(cid, "nav:main")
             await self._show_todo_lists(cid)
 
+    def _reg_view(self, key: str, build: Callable[[], Any]) -> Any:
+        """Return *build()*, cached until the registry or menu filters change."""
+        stamp = (self._reg.version, self._cfg.menu_domains_allowlist_set, self._cfg.show_all_enabled)
+        cached = self._menu_cache.get(key)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        data = build()
+        self._menu_cache[key] = (stamp, data)
+        return data
+
+    def _state_view(self, key: str, all_states: list[dict[str, Any]], build: Callable[[], Any]) -> Any:
+        """Return *build()*, cached while list_states() hands out the same list."""
+        cached = self._state_views.get(key)
+        if cached is not None and cached[0] is all_states:
+            return cached[1]
+        data = build()
+        self._state_views[key] = (all_states, data)
+        return data
+
+    def _area_devices(self, area_id: str) -> list[dict[str, Any]]:
+        domains = self._cfg.menu_domains_allowlist_set
+        sa = self._cfg.show_all_enabled
+        if area_id == "__none__":
+            return self._reg_view(
+                "devices:__none__",
+                lambda: self._reg.get_unassigned_devices(domains, show_all=sa),
+            )
+        return self._reg_view(
+            f"devices:{area_id}",
+            lambda: self._reg.get_devices_for_area(area_id, domains, show_all=sa),
+        )
+
+    def _area_counts(self) -> dict[str, int]:
+        """Menu entity count of every non-empty area, shared by floor/area menus."""
+        domains = self._cfg.menu_domains_allowlist_set
+        sa = self._cfg.show_all_enabled
+        return self._reg_view("area_counts", lambda: {
+            aid: n for aid in self._reg.areas
+            if (n := self._reg.count_area_entities(aid, domains, show_all=sa))
+        })
+
+    def _device_eids(self, device_id: str) -> list[str]:
+        domains = self._cfg.menu_domains_allowlist_set
+        return self._reg_view(
+            f"eids:{device_id}",
+            lambda: self._reg.get_device_entity_ids(device_id, domains),
+        )
+
+    def _area_scenes(self, area_id: str) -> list[dict[str, Any]]:
+        area_obj = self._reg.areas.get(area_id)
+        if not area_obj:
+            return []
+        scenes = []
+        for eid in area_obj.entity_ids:
+            if eid.startswith(_SCENE_PREFIXES):
+                ent_info = self._reg.entities.get(eid)
+                if ent_info and not ent_info.disabled_by:
+                    name = ent_info.name or ent_info.original_name or eid
+                    scenes.append({"entity_id": eid, "friendly_name": name})
+        return scenes
+
     # -----------------------------------------------------------------------
     # fl: — floor selected
     # -----------------------------------------------------------------------
 
     async def _floor(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
-        floor_id = data.split(":", 1)[1] if ":" in data else ""
+        floor_id = data.partition(":")[2]
         await cb.answer()
 
-        domains = frozenset(self._cfg.menu_domains_allowlist)
+        domains = self._cfg.menu_domains_allowlist_set
         sa = self._cfg.show_all_enabled
 
-        if floor_id == "__none__":
-            areas = self._reg.get_unassigned_areas()
-        else:
-            areas = self._reg.get_areas_for_floor(floor_id)
-
-        area_dicts = []
-        for a in areas:
-            eids = self._reg.get_area_entities(a.area_id, domains, show_all=sa)
-            if eids:
-                area_dicts.append({"area_id": a.area_id, "name": a.name, "entity_count": len(eids)})
+        def build() -> tuple[list[dict[str, Any]], int]:
+            if floor_id == "__none__":
+                areas = self._reg.get_unassigned_areas()
+            else:
+                areas = self._reg.get_areas_for_floor(floor_id)
+            counts = self._area_counts()
+            area_dicts = [
+                {"area_id": a.area_id, "name": a.name, "entity_count": n}
+                for a in areas
+                if (n := counts.get(a.area_id))
+            ]
+            return area_dicts, len(self._reg.get_unassigned_entities(domains, show_all=sa))
 
-        unassigned = self._reg.get_unassigned_entities(domains, show_all=sa)
+        area_dicts, unassigned_count = self._reg_view(f"floor:{floor_id}", build)
 
         back = "nav:manage" if self._reg.has_floors else "nav:main"
         floor_name = ""
@@ -823,7 +1260,7 @@ class Handlers:
             area_dicts,
             back_target=back,
             title=f"\U0001f3e0 <b>{floor_name or 'Комнаты'}</b>",
-            unassigned_entity_count=len(unassigned),
+            unassigned_entity_count=unassigned_count,
         )
         await self._send_or_edit(cid, t, k, menu=f"floor:{floor_id}")
 
@@ -832,17 +1269,14 @@ class Handlers:
     # -----------------------------------------------------------------------
 
     async def _area(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
-        area_id = data.split(":", 1)[1] if ":" in data else ""
+        area_id = data.partition(":")[2]
         await cb.answer()
         self._push_nav(cid, "nav:manage")
 
-        domains = frozenset(self._cfg.menu_domains_allowlist)
-        sa = self._cfg.show_all_enabled
+        devices = self._area_devices(area_id)
         if area_id == "__none__":
-            devices = self._reg.get_unassigned_devices(domains, show_all=sa)
             title = "\U0001f4e6 <b>Без комнаты</b>"
         else:
-            devices = self._reg.get_devices_for_area(area_id, domains, show_all=sa)
             area = self._reg.areas.get(area_id)
             title = f"\U0001f3e0 <b>{area.name if area else area_id}</b>"
 
@@ -859,21 +1293,12 @@ class Handlers:
         # Collect quick scenes for this area (scene/script entities)
         quick_scenes: list[dict[str, Any]] = []
         if area_id and area_id != "__none__":
-            area_obj = self._reg.areas.get(area_id)
-            if area_obj:
-                for eid in area_obj.entity_ids:
-                    d = eid.split(".", 1)[0]
-                    if d in ("scene", "script"):
-                        ent_info = self._reg.entities.get(eid)
-                        if ent_info and not ent_info.disabled_by:
-                            name = ent_info.name or ent_info.original_name or eid
-                            quick_scenes.append({"entity_id": eid, "friendly_name": name})
+            quick_scenes = self._reg_view(f"scenes:{area_id}", lambda: self._area_scenes(area_id))
 
         pin_btn = None
         if area_id and area_id != "__none__":
             is_pinned = await self._db.is_pinned(uid, "area", area_id)
-            pin_label = "\U0001f4cc Убрать" if is_pinned else "\U0001f4cc Закрепить"
-            pin_btn = InlineKeyboardButton(text=pin_label, callback_data=f"pin:area:{area_id}")
+            pin_btn = build_pin_button(area_id, is_pinned)
 
         t, k = build_device_list(
             devices, 0, self._cfg.menu_page_size,
@@ -890,32 +1315,28 @@ class Handlers:
 
     async def _area_page(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
         # arp:area_id:page
-        parts = data.split(":", 2)
-        if len(parts) < 3:
+        args = _cb_args(data)
+        if args is None:
             await cb.answer()
             return
-        area_id = parts[1]
+        area_id, raw_page = args
         try:
-            page = int(parts[2])
+            page = int(raw_page)
         except ValueError:
             page = 0
         await cb.answer()
 
-        domains = frozenset(self._cfg.menu_domains_allowlist)
-        sa = self._cfg.show_all_enabled
+        devices = self._area_devices(area_id)
         if area_id == "__none__":
-            devices = self._reg.get_unassigned_devices(domains, show_all=sa)
             title = "\U0001f4e6 <b>Без комнаты</b>"
         else:
-            devices = self._reg.get_devices_for_area(area_id, domains, show_all=sa)
             area = self._reg.areas.get(area_id)
             title = f"\U0001f3e0 <b>{area.name if area else area_id}</b>"
 
         pin_btn = None
         if area_id and area_id != "__none__":
             is_pinned = await self._db.is_pinned(uid, "area", area_id)
-            pin_label = "\U0001f4cc Убрать" if is_pinned else "\U0001f4cc Закрепить"
-            pin_btn = InlineKeyboardButton(text=pin_label, callback_data=f"pin:area:{area_id}")
+            pin_btn = build_pin_button(area_id, is_pinned)
 
         t, k = build_device_list(
             devices, page, self._cfg.menu_page_size,
@@ -930,7 +1351,7 @@ class Handlers:
     # -----------------------------------------------------------------------
 
     async def _entity(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
-        eid = data.split(":", 1)[1] if ":" in data else ""
+        eid = data.partition(":")[2]
         if not eid:
             await cb.answer("Некорректная сущность.", show_alert=True)
             return
@@ -942,14 +1363,12 @@ class Handlers:
     # -----------------------------------------------------------------------
 
     async def _device(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
-        device_id = data.split(":", 1)[1] if ":" in data else ""
+        device_id = data.partition(":")[2]
         if not device_id:
             await cb.answer()
             return
         await cb.answer()
 
-        domains = frozenset(self._cfg.menu_domains_allowlist)
-
         # Check if it's a vacuum device → go to vacuum entity control
         vac_eid = self._reg.get_vacuum_entity_for_device(device_id)
         if vac_eid:
@@ -957,7 +1376,7 @@ class Handlers:
             return
 
         # Get entities for this device
-        eids = self._reg.get_device_entity_ids(device_id, domains)
+        eids = self._device_eids(device_id)
 
         # If device_id is actually an entity_id (virtual device), show control directly
         if not eids and "." in device_id:
@@ -970,7 +1389,7 @@ class Handlers:
             return
 
         # Multiple entities → show entity list
-        ent_list = await self._enrich_entities(eids)
+        page, ent_list = await self._enrich_page(eids, 0)
         dev = self._reg.devices.get(device_id)
         dev_name = dev.name if dev else device_id
 
@@ -979,10 +1398,11 @@ class Handlers:
         back_cb = f"ar:{area_id}" if area_id else "nav:manage"
 
         t, k = build_entity_list(
-            ent_list, 0, self._cfg.menu_page_size,
+            ent_list, page, self._cfg.menu_page_size,
             title=f"\U0001f4e6 <b>{dev_name}</b>",
             back_cb=back_cb,
             page_cb_prefix=f"dvp:{device_id}",
+            total=len(eids),
         )
         await self._send_or_edit(cid, t, k, menu=f"device:{device_id}")
 
@@ -991,20 +1411,19 @@ class Handlers:
     # -----------------------------------------------------------------------
 
     async def _device_page(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
-        parts = data.split(":", 2)
-        if len(parts) < 3:
+        args = _cb_args(data)
+        if args is None:
             await cb.answer()
             return
-        device_id = parts[1]
+        device_id, raw_page = args
         try:
-            page = int(parts[2])
+            page = int(raw_page)
         except ValueError:
             page = 0
         await cb.answer()
 
-        domains = frozenset(self._cfg.menu_domains_allowlist)
-        eids = self._reg.get_device_entity_ids(device_id, domains)
-        ent_list = await self._enrich_entities(eids)
+        eids = self._device_eids(device_id)
+        page, ent_list = await self._enrich_page(eids, page)
 
         dev = self._reg.devices.get(device_id)
         dev_name = dev.name if dev else device_id
@@ -1016,26 +1435,45 @@ class Handlers:
             title=f"\U0001f4e6 <b>{dev_name}</b>",
             back_cb=back_cb,
             page_cb_prefix=f"dvp:{device_id}",
+            total=len(eids),
         )
         await self._send_or_edit(cid, t, k, menu=f"device:{device_id}:{page}")
 
-    async def _show_entity_control(self, cid: int, uid: int, eid: str) -> None:
+    async def _state_or_none(self, eid: str) -> dict[str, Any] | None:
         try:
-            state = await self._ha.get_state(eid)
+            return await self._ha.get_state(eid)
         except Exception:
             logger.exception("Failed to fetch state for %s", eid)
-            state = None
+            return None
+
+    async def _vacuum_caps_or_none(self, eid: str) -> Any:
+        try:
+            return await self._vac.get_capabilities(eid)
+        except Exception:
+            logger.exception("Failed to get vacuum capabilities for %s", eid)
+            return None
+
+    async def _show_entity_control(self, cid: int, uid: int, eid: str) -> None:
+        domain = eid.partition(".")[0]
+        # HA state, the per-user flags, the area and (for vacuums) the
+        # capabilities are independent: fetch them all at once
+        fetches = [
+            self._state_or_none(eid),
+            self._db.is_favorite(uid, eid),
+            self._db.get_notification(uid, eid),
+            self._db.get_entity_area(eid),
+        ]
+        if domain == "vacuum":
+            fetches.append(self._vacuum_caps_or_none(eid))
+        state, is_fav, notif, area_info, *rest = await asyncio.gather(*fetches)
         if state is None:
             t, k = build_confirmation("\U0001f534 Сущность не найдена.", "nav:main")
             await self._send_or_edit(cid, t, k, menu="entity_err")
             return
 
-        is_fav = await self._db.is_favorite(uid, eid)
-        notif = await self._db.get_notification(uid, eid)
         is_notif = notif is not None and notif["enabled"]
 
         # Determine best back callback
-        area_info = await self._db.get_entity_area(eid)
         if area_info and area_info.get("area_id"):
             back = f"ar:{area_info['area_id']}"
         else:
@@ -1043,31 +1481,11 @@ class Handlers:
 
         self._push_nav(cid, back)
 
-        t, k = build_entity_control(eid, state, is_fav, is_notif, back)
-
-        domain = eid.split(".", 1)[0]
-
-        # For lights that support color, add color preset button
-        if domain == "light":
-            attrs = state.get("attributes", {})
-            color_modes = attrs.get("supported_color_modes", [])
-            if any(m in ("rgb", "rgbw", "rgbww", "hs", "xy") for m in color_modes):
-                rows = k.inline_keyboard[:]
-                insert_pos = max(0, len(rows) - 2)
-                rows.insert(insert_pos, [InlineKeyboardButton(
-                    text="\U0001f3a8 Цвет",
-                    callback_data=f"lclr:{eid}",
-                )])
-                k = InlineKeyboardMarkup(inline_keyboard=rows)
+        extra_rows: list[list[InlineKeyboardButton]] = []
 
         # For vacuum, add extra buttons (rooms, routines)
         if domain == "vacuum":
-            extra_rows: list[list[InlineKeyboardButton]] = []
-            try:
-                caps = await self._vac.get_capabilities(eid)
-            except Exception:
-                logger.exception("Failed to get vacuum capabilities for %s", eid)
-                caps = None
+            caps = rest[0]
             if caps:
                 if caps.supports_segment_clean:
                     extra_rows.append([InlineKeyboardButton(
@@ -1079,12 +1497,8 @@ class Handlers:
                         text=f"\U0001f3ac Сценарии ({caps.routine_count})",
                         callback_data=f"vrtn:{eid}",
                     )])
-            if extra_rows:
-                rows = k.inline_keyboard[:]
-                insert_pos = max(0, len(rows) - 2)
-                for er in reversed(extra_rows):
-                    rows.insert(insert_pos, er)
-                k = InlineKeyboardMarkup(inline_keyboard=rows)
+
+        t, k = build_entity_control(eid, state, is_fav, is_notif, back, extras=extra_rows)
 
         await self._send_or_edit(cid, t, k, menu="entity", entity=eid)
 
@@ -1093,21 +1507,17 @@ class Handlers:
     # -----------------------------------------------------------------------
 
     async def _action(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
-        parts = data.split(":", 2)
-        if len(parts) < 3:
+        args = _cb_args(data)
+        if args is None:
             await cb.answer("Некорректное действие.", show_alert=True)
             return
-        eid = parts[1]
-        service = parts[2]
-        domain = eid.split(".", 1)[0]
-
-        if not _ENTITY_ID_RE.match(eid):
-            await cb.answer("Некорректная сущность.", show_alert=True)
-            return
-        if service not in _ALLOWED_SERVICES:
-            await cb.answer("Недопустимый сервис.", show_alert=True)
+        eid, service = args
+        target = _service_target(eid, service)
+        if target is None:
+            await cb.answer("Недопустимое действие.", show_alert=True)
             return
-        if not await self._check_rl(uid, f"{domain}.{service}", cb):
+        domain, action = target
+        if not await self._check_rl(uid, action, cb):
             return
 
         await cb.answer("\u2699\ufe0f Выполняю...")
@@ -1116,10 +1526,8 @@ class Handlers:
         except Exception as exc:
             logger.exception("Service call %s.%s failed for %s", domain, service, eid)
             ok, err = False, str(exc)[:200]
-        if ok:
-            self._rl.record()
         await _audit(self._db, chat_id=cid, user_id=uid, username=uname,
-                     action=f"{domain}.{service}", entity_id=eid,
+                     action=action, entity_id=eid,
                      success=ok, error=err if not ok else None)
 
         if ok:
@@ -1133,65 +1541,108 @@ class Handlers:
             )
             await cb.answer(f"Ошибка: {err_msg}", show_alert=True)
 
+    def _debounce(
+        self, key: tuple[int, int, str],
+        flush: Callable[..., Coroutine[Any, Any, None]], *args: Any,
+    ) -> None:
+        """(Re)arm the stepper timer for *key*; *flush* runs once taps pause.
+
+        A rearm only cancels a TimerHandle, so rapid taps allocate no task
+        and raise no CancelledError.
+        """
+        entry = self._steppers[key]
+        if entry.handle is not None:
+            entry.handle.cancel()
+        entry.handle = asyncio.get_running_loop().call_later(
+            _STEPPER_DEBOUNCE_SECONDS, self._fire_debounced, key, flush, args,
+            context=Context(),
+        )
+        entry.flush = (flush, args)
+
+    def _fire_debounced(
+        self, key: tuple[int, int, str],
+        flush: Callable[..., Coroutine[Any, Any, None]], args: tuple[Any, ...],
+    ) -> None:
+        entry = self._steppers.get(key)
+        if entry is not None:
+            entry.handle = None
+        self._spawn(flush(key, *args), name=f"debounce_{key[2]}")
+
+    def _defer_refresh(
+        self, cid: int, refresh: Callable[..., Coroutine[Any, Any, None]], *args: Any,
+    ) -> None:
+        """Run *refresh(*args)* once toggles in *cid* pause; the latest wins.
+
+        Runs outside the tapping callback's dispatch context, so the
+        refreshed screen is not remembered as that write callback's.
+        """
+        handle = self._refresh_handles.get(cid)
+        if handle is not None:
+            handle.cancel()
+        self._refresh_handles[cid] = asyncio.get_running_loop().call_later(
+            _TOGGLE_REFRESH_SECONDS, self._fire_refresh, cid, refresh, args,
+            context=Context(),
+        )
+
+    def _fire_refresh(
+        self, cid: int,
+        refresh: Callable[..., Coroutine[Any, Any, None]], args: tuple[Any, ...],
+    ) -> None:
+        self._refresh_handles.pop(cid, None)
+        # Toggles landed since the tap; replayed screens would predate them
+        self._nav_screens.pop(cid, None)
+        self._spawn(refresh(*args), name=f"refresh_{cid}")
+
     # -----------------------------------------------------------------------
     # bright: — brightness
     # -----------------------------------------------------------------------
 
     async def _brightness(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
-        parts = data.split(":", 2)
-        if len(parts) < 3:
+        args = _cb_args(data)
+        if args is None:
             await cb.answer()
             return
-        eid, direction = parts[1], parts[2]
+        eid, direction = args
         if not await self._check_rl(uid, "light.brightness", cb):
             return
 
         key = (cid, uid, eid)
 
         # Use pending value if mid-debounce, otherwise fetch HA state
-        if key in self._pending_brightness:
-            current = self._pending_brightness[key]
-        else:
+        entry = self._steppers.get(key)
+        if entry is None:
             state = await self._ha.get_state(eid)
             current = (state.get("attributes", {}).get("brightness", 128) or 128) if state else 128
+            entry = self._steppers.setdefault(key, _Stepper(current, base=state))
 
         step = 51
+        current = int(entry.target)
         new_br = min(255, current + step) if direction == "up" else max(1, current - step)
-        self._pending_brightness[key] = new_br
+        entry.target = new_br
+        # Re-arm before awaiting: a timer firing during cb.answer would
+        # flush and drop this entry with the new target unsent
+        self._debounce(key, self._flush_brightness, cid, uid, uname, eid)
 
         pct = round(new_br / 255 * 100)
         await cb.answer(f"\U0001f506 {pct}%")
 
-        # Cancel existing debounce task, schedule new one
-        existing = self._debounce_tasks.get(key)
-        if existing and not existing.done():
-            existing.cancel()
-        self._debounce_tasks[key] = asyncio.create_task(
-            self._flush_brightness(key, cid, uid, uname, eid),
-        )
-
     async def _flush_brightness(
         self, key: tuple[int, int, str], cid: int, uid: int, uname: str, eid: str,
     ) -> None:
-        """Debounce flush: wait, then send ONE HA call with the latest brightness."""
-        try:
-            await asyncio.sleep(0.25)
-        except asyncio.CancelledError:
-            return
-        target = self._pending_brightness.pop(key, None)
-        self._debounce_tasks.pop(key, None)
-        if target is None:
+        """Debounce flush: send ONE HA call with the latest brightness."""
+        entry = self._steppers.pop(key, None)
+        if entry is None:
             return
+        target = int(entry.target)
 
         ok, err = await self._ha.call_service(
             "light", "turn_on", {"entity_id": eid, "brightness": target},
         )
-        if ok:
-            self._rl.record()
         await _audit(self._db, chat_id=cid, user_id=uid, username=uname,
                      action="light.brightness", entity_id=eid,
                      success=ok, error=err if not ok else None)
         if ok:
+            self._ha.patch_state(eid, entry.base, state="on", brightness=target)
             await self._show_entity_control(cid, uid, eid)
 
     # -----------------------------------------------------------------------
@@ -1199,11 +1650,11 @@ class Handlers:
     # -----------------------------------------------------------------------
 
     async def _climate(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
-        parts = data.split(":", 2)
-        if len(parts) < 3:
+        args = _cb_args(data)
+        if args is None:
             await cb.answer()
             return
-        eid, direction = parts[1], parts[2]
+        eid, direction = args
         if not await self._check_rl(uid, "climate.set_temperature", cb):
             return
 
@@ -1220,12 +1671,11 @@ class Handlers:
         ok, err = await self._ha.call_service(
             "climate", "set_temperature", {"entity_id": eid, "temperature": new_temp},
         )
-        if ok:
-            self._rl.record()
         await _audit(self._db, chat_id=cid, user_id=uid, username=uname,
                      action="climate.set_temperature", entity_id=eid,
                      success=ok, error=err if not ok else None)
         if ok:
+            self._ha.patch_state(eid, state, temperature=new_temp)
             await self._show_entity_control(cid, uid, eid)
 
     # -----------------------------------------------------------------------
@@ -1233,11 +1683,11 @@ class Handlers:
     # -----------------------------------------------------------------------
 
     async def _media_vol(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
-        parts = data.split(":", 2)
-        if len(parts) < 3:
+        args = _cb_args(data)
+        if args is None:
             await cb.answer()
             return
-        eid, direction = parts[1], parts[2]
+        eid, direction = args
         if not await self._check_rl(uid, "media_player.volume", cb):
             return
 
@@ -1245,53 +1695,41 @@ class Handlers:
         vol_step = 0.05
 
         # Use pending value if mid-debounce, otherwise fetch HA state
-        if key in self._pending_volume:
-            current_vol = self._pending_volume[key]
-        else:
+        entry = self._steppers.get(key)
+        if entry is None:
             state = await self._ha.get_state(eid)
             raw_vol = state.get("attributes", {}).get("volume_level", 0.5) if state else 0.5
             try:
                 current_vol = float(raw_vol or 0.5)
             except (TypeError, ValueError):
                 current_vol = 0.5
+            entry = self._steppers.setdefault(key, _Stepper(current_vol, base=state))
 
+        current_vol = entry.target
         new_vol = min(1.0, current_vol + vol_step) if direction == "up" else max(0.0, current_vol - vol_step)
-        self._pending_volume[key] = new_vol
+        entry.target = new_vol
+        self._debounce(key, self._flush_volume, cid, uid, uname, eid)
 
         pct = round(new_vol * 100)
         await cb.answer(f"\U0001f50a {pct}%")
 
-        # Cancel existing debounce task, schedule new one
-        existing = self._debounce_tasks.get(key)
-        if existing and not existing.done():
-            existing.cancel()
-        self._debounce_tasks[key] = asyncio.create_task(
-            self._flush_volume(key, cid, uid, uname, eid),
-        )
-
     async def _flush_volume(
         self, key: tuple[int, int, str], cid: int, uid: int, uname: str, eid: str,
     ) -> None:
-        """Debounce flush: wait, then send ONE volume_set call."""
-        try:
-            await asyncio.sleep(0.25)
-        except asyncio.CancelledError:
+        """Debounce flush: send ONE volume_set call."""
+        entry = self._steppers.pop(key, None)
+        if entry is None:
             return
-        target = self._pending_volume.pop(key, None)
-        self._debounce_tasks.pop(key, None)
-        if target is None:
-            return
-
+        target = round(entry.target, 2)
         ok, err = await self._ha.call_service(
             "media_player", "volume_set",
-            {"entity_id": eid, "volume_level": round(target, 2)},
+            {"entity_id": eid, "volume_level": target},
         )
-        if ok:
-            self._rl.record()
         await _audit(self._db, chat_id=cid, user_id=uid, username=uname,
                      action="media_player.volume_set", entity_id=eid,
                      success=ok, error=err if not ok else None)
         if ok:
+            self._ha.patch_state(eid, entry.base, volume_level=target)
             await self._show_entity_control(cid, uid, eid)
 
     # -----------------------------------------------------------------------
@@ -1299,7 +1737,7 @@ class Handlers:
     # -----------------------------------------------------------------------
 
     async def _media_mute(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
-        eid = data.split(":", 1)[1] if ":" in data else ""
+        eid = data.partition(":")[2]
         if not eid:
             await cb.answer()
             return
@@ -1314,12 +1752,11 @@ class Handlers:
             "media_player", "volume_mute",
             {"entity_id": eid, "is_volume_muted": not is_muted},
         )
-        if ok:
-            self._rl.record()
         await _audit(self._db, chat_id=cid, user_id=uid, username=uname,
                      action="media_player.volume_mute", entity_id=eid,
                      success=ok, error=err if not ok else None)
         if ok:
+            self._ha.patch_state(eid, state, is_volume_muted=not is_muted)
             await self._show_entity_control(cid, uid, eid)
 
     # -----------------------------------------------------------------------
@@ -1327,7 +1764,7 @@ class Handlers:
     # -----------------------------------------------------------------------
 
     async def _media_source(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
-        eid = data.split(":", 1)[1] if ":" in data else ""
+        eid = data.partition(":")[2]
         if not eid:
             await cb.answer()
             return
@@ -1352,11 +1789,11 @@ class Handlers:
     # -----------------------------------------------------------------------
 
     async def _media_source_sel(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
-        parts = data.split(":", 2)
-        if len(parts) < 3:
+        args = _cb_args(data)
+        if args is None:
             await cb.answer()
             return
-        eid, source = parts[1], parts[2]
+        eid, source = args
         if not await self._check_rl(uid, "media_player.select_source", cb):
             return
 
@@ -1365,8 +1802,6 @@ class Handlers:
             "media_player", "select_source",
             {"entity_id": eid, "source": source},
         )
-        if ok:
-            self._rl.record()
         await _audit(self._db, chat_id=cid, user_id=uid, username=uname,
                      action="media_player.select_source", entity_id=eid,
                      success=ok, error=err if not ok else None)
@@ -1380,11 +1815,11 @@ class Handlers:
     # -----------------------------------------------------------------------
 
     async def _select_option(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
-        parts = data.split(":", 2)
-        if len(parts) < 3:
+        args = _cb_args(data)
+        if args is None:
             await cb.answer()
             return
-        eid, option = parts[1], parts[2]
+        eid, option = args
         if not await self._check_rl(uid, "select.select_option", cb):
             return
 
@@ -1393,8 +1828,6 @@ class Handlers:
             "select", "select_option",
             {"entity_id": eid, "option": option},
         )
-        if ok:
-            self._rl.record()
         await _audit(self._db, chat_id=cid, user_id=uid, username=uname,
                      action="select.select_option", entity_id=eid,
                      success=ok, error=err if not ok else None)
@@ -1406,11 +1839,11 @@ class Handlers:
     # -----------------------------------------------------------------------
 
     async def _number_val(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
-        parts = data.split(":", 2)
-        if len(parts) < 3:
+        args = _cb_args(data)
+        if args is None:
             await cb.answer()
             return
-        eid, direction = parts[1], parts[2]
+        eid, direction = args
         if not await self._check_rl(uid, "number.set_value", cb):
             return
 
@@ -1433,12 +1866,11 @@ class Handlers:
             "number", "set_value",
             {"entity_id": eid, "value": new_val},
         )
-        if ok:
-            self._rl.record()
         await _audit(self._db, chat_id=cid, user_id=uid, username=uname,
                      action="number.set_value", entity_id=eid,
                      success=ok, error=err if not ok else None)
         if ok:
+            self._ha.patch_state(eid, state, state=str(new_val))
             await self._show_entity_control(cid, uid, eid)
 
     # -----------------------------------------------------------------------
@@ -1447,11 +1879,11 @@ class Handlers:
 
     async def _pin_toggle(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
         # pin:item_type:target_id
-        parts = data.split(":", 2)
-        if len(parts) < 3:
+        args = _cb_args(data)
+        if args is None:
             await cb.answer()
             return
-        item_type, target_id = parts[1], parts[2]
+        item_type, target_id = args
 
         # Resolve label
         label = target_id
@@ -1469,19 +1901,21 @@ class Handlers:
         await cb.answer(f"\U0001f4cc {msg}")
 
         # Refresh the current view
-        menu_state = await self._db.get_menu_state(cid)
+        menu_state = await self._get_menu_state(cid)
         current_menu = menu_state.get("current_menu", "") if menu_state else ""
-        if current_menu.startswith("area:"):
-            area_id = current_menu.split(":", 1)[1].split(":", 1)[0]
-            # Re-render the area page
-            domains = frozenset(self._cfg.menu_domains_allowlist)
-            sa = self._cfg.show_all_enabled
-            devices = self._reg.get_devices_for_area(area_id, domains, show_all=sa)
+        kind, _, rest = current_menu.partition(":")
+        if kind == "area":
+            area_id = rest.partition(":")[0]
+            # Re-render the area page; the toggle result is the pin state
+            # of the area shown unless a routine was toggled from it
+            devices = self._area_devices(area_id)
             area = self._reg.areas.get(area_id)
             title = f"\U0001f3e0 <b>{area.name if area else area_id}</b>"
-            is_pinned = await self._db.is_pinned(uid, "area", area_id)
-            pin_label = "\U0001f4cc Убрать" if is_pinned else "\U0001f4cc Закрепить"
-            pin_btn = InlineKeyboardButton(text=pin_label, callback_data=f"pin:area:{area_id}")
+            if item_type == "area" and target_id == area_id:
+                is_pinned = now_pinned
+            else:
+                is_pinned = await self._db.is_pinned(uid, "area", area_id)
+            pin_btn = build_pin_button(area_id, is_pinned)
             t, k = build_device_list(
                 devices, 0, self._cfg.menu_page_size,
                 title=title, back_cb="nav:manage",
@@ -1497,21 +1931,21 @@ class Handlers:
     # -----------------------------------------------------------------------
 
     async def _fav_toggle(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
-        eid = data.split(":", 1)[1] if ":" in data else ""
+        eid = data.partition(":")[2]
         if not eid:
             await cb.answer()
             return
         now_fav = await self._db.toggle_favorite(uid, eid)
         label = "Добавлено в избранное" if now_fav else "Удалено из избранного"
         await cb.answer(f"\u2b50 {label}")
-        await self._show_entity_control(cid, uid, eid)
+        self._defer_refresh(cid, self._show_entity_control, cid, uid, eid)
 
     # -----------------------------------------------------------------------
     # ntog: — toggle notification
     # -----------------------------------------------------------------------
 
     async def _notif_toggle(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
-        eid = data.split(":", 1)[1] if ":" in data else ""
+        eid = data.partition(":")[2]
         if not eid:
             await cb.answer()
             return
@@ -1519,12 +1953,12 @@ class Handlers:
         label = "Уведомления включены" if now_on else "Уведомления отключены"
         await cb.answer(f"\U0001f514 {label}")
         # Refresh the current view
-        menu_state = await self._db.get_menu_state(cid)
+        menu_state = await self._get_menu_state(cid)
         current_menu = menu_state.get("current_menu", "") if menu_state else ""
         if current_menu == "notif":
-            await self._show_notif_list(cid, uid, 0)
+            self._defer_refresh(cid, self._show_notif_list, cid, uid, 0)
         else:
-            await self._show_entity_control(cid, uid, eid)
+            self._defer_refresh(cid, self._show_entity_control, cid, uid, eid)
 
     # -----------------------------------------------------------------------
     # favp: — favorites pagination
@@ -1532,7 +1966,7 @@ class Handlers:
 
     async def _fav_page(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
         try:
-            page = int(data.split(":", 1)[1])
+            page = int(data.partition(":")[2])
         except (ValueError, IndexError):
             page = 0
         await cb.answer()
@@ -1544,7 +1978,7 @@ class Handlers:
 
     async def _notif_page(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
         try:
-            page = int(data.split(":", 1)[1])
+            page = int(data.partition(":")[2])
         except (ValueError, IndexError):
             page = 0
         await cb.answer()
@@ -1556,15 +1990,16 @@ class Handlers:
 
     async def _notif_action(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
         # nact:entity_id:service
-        parts = data.split(":", 2)
-        if len(parts) < 3:
+        args = _cb_args(data)
+        if args is None:
             await cb.answer()
             return
-        eid, service = parts[1], parts[2]
-        domain = eid.split(".", 1)[0]
-        if service not in _ALLOWED_SERVICES:
-            await cb.answer("Недопустимый сервис.", show_alert=True)
+        eid, service = args
+        target = _service_target(eid, service)
+        if target is None:
+            await cb.answer("Недопустимое действие.", show_alert=True)
             return
+        domain, action = target
 
         await cb.answer("\u2699\ufe0f Выполняю...")
         try:
@@ -1573,13 +2008,12 @@ class Handlers:
             logger.exception("Notification action %s.%s failed for %s", domain, service, eid)
             ok, err = False, str(exc)[:200]
         if ok:
-            self._rl.record()
             await cb.answer(f"\u2705 {service}", show_alert=False)
         else:
             await cb.answer(f"\u274c {(err or '')[:180]}", show_alert=True)
 
         await _audit(self._db, chat_id=cid, user_id=uid, username=uname,
-                     action=f"nact.{domain}.{service}", entity_id=eid,
+                     action=f"nact.{action}", entity_id=eid,
                      success=ok, error=err if not ok else None)
 
     # -----------------------------------------------------------------------
@@ -1588,13 +2022,13 @@ class Handlers:
 
     async def _notif_mute(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
         # nmute:entity_id:target_user_id
-        parts = data.split(":", 2)
-        if len(parts) < 3:
+        args = _cb_args(data)
+        if args is None:
             await cb.answer()
             return
-        eid = parts[1]
+        eid, raw_uid = args
         try:
-            target_uid = int(parts[2])
+            target_uid = int(raw_uid)
         except ValueError:
             await cb.answer()
             return
@@ -1614,7 +2048,7 @@ class Handlers:
 
     async def _fav_actions_page(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
         try:
-            page = int(data.split(":", 1)[1])
+            page = int(data.partition(":")[2])
         except (ValueError, IndexError):
             page = 0
         await cb.answer()
@@ -1626,13 +2060,12 @@ class Handlers:
 
     async def _fav_action_run(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
         try:
-            action_id = int(data.split(":", 1)[1])
+            action_id = int(data.partition(":")[2])
         except (ValueError, IndexError):
             await cb.answer("Некорректное действие.", show_alert=True)
             return
 
-        actions = await self._db.get_favorite_actions(uid)
-        action = next((a for a in actions if a["id"] == action_id), None)
+        action = await self._db.get_favorite_action(uid, action_id)
         if not action:
             await cb.answer("Действие не найдено.", show_alert=True)
             return
@@ -1651,7 +2084,6 @@ class Handlers:
 
         ok, err = await self._ha.call_service(domain, service, svc_data)
         if ok:
-            self._rl.record()
             await cb.answer(f"\u2705 {action.get('label', 'OK')}", show_alert=False)
         else:
             await cb.answer(f"\u274c {(err or '')[:180]}", show_alert=True)
@@ -1667,7 +2099,7 @@ class Handlers:
 
     async def _fav_action_del(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
         try:
-            action_id = int(data.split(":", 1)[1])
+            action_id = int(data.partition(":")[2])
         except (ValueError, IndexError):
             await cb.answer()
             return
@@ -1685,18 +2117,20 @@ class Handlers:
 
     async def _search_page(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
         try:
-            page = int(data.split(":", 1)[1])
+            page = int(data.partition(":")[2])
         except (ValueError, IndexError):
             page = 0
         await cb.answer()
 
-        cached = self._search_cache.get(cid, [])
+        cached, truncated = self._search_cache.get(cid, ([], False))
         if not cached:
             t, k = build_search_prompt()
             await self._send_or_edit(cid, t, k, menu="search")
             return
 
-        t, k = build_search_results("...", cached, page, self._cfg.menu_page_size)
+        t, k = build_search_results(
+            "...", cached, page, self._cfg.menu_page_size, truncated=truncated,
+        )
         await self._send_or_edit(cid, t, k, menu="search_results")
 
     # -----------------------------------------------------------------------
@@ -1705,14 +2139,14 @@ class Handlers:
 
     async def _active_page(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
         try:
-            page = int(data.split(":", 1)[1])
+            page = int(data.partition(":")[2])
         except (ValueError, IndexError):
             page = 0
         await cb.answer()
 
-        cached = self._search_cache.get(cid, [])
-        if not cached:
-            await self._show_active_now(cid, uid, 0)
+        cached = self._active_cache.get(cid)
+        if cached is None:
+            await self._show_active_now(cid, uid, page)
             return
 
         t, k = build_active_now_menu(cached, page, self._cfg.menu_page_size)
@@ -1723,7 +2157,7 @@ class Handlers:
     # -----------------------------------------------------------------------
 
     async def _diag_cb(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
-        target = data.split(":", 1)[1] if ":" in data else ""
+        target = data.partition(":")[2]
         await cb.answer()
 
         if not await self._check_role(uid, "admin"):
@@ -1746,7 +2180,7 @@ class Handlers:
 
     async def _snap_detail(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
         try:
-            snap_id = int(data.split(":", 1)[1])
+            snap_id = int(data.partition(":")[2])
         except (ValueError, IndexError):
             await cb.answer()
             return
@@ -1767,7 +2201,7 @@ class Handlers:
 
     async def _snap_diff(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
         try:
-            snap_id = int(data.split(":", 1)[1])
+            snap_id = int(data.partition(":")[2])
         except (ValueError, IndexError):
             await cb.answer()
             return
@@ -1779,20 +2213,29 @@ class Handlers:
             await self._send_or_edit(cid, t, k, menu="snap_err")
             return
 
-        diff_lines: list[str] = []
-        snap_entities = {e["entity_id"]: e for e in snap.get("payload", [])}
+        # One bulk fetch instead of a request per snapshot entity
+        states = await self._ha.list_states()
+        if not states:
+            t, k = build_confirmation("\U0001f534 Не удалось получить состояния.", "menu:snapshots")
+            await self._send_or_edit(cid, t, k, menu="snap_err")
+            return
+        current_map = {s["entity_id"]: s for s in states}
 
-        for eid, snap_ent in list(snap_entities.items())[:50]:
-            current = await self._ha.get_state(eid)
+        diff_lines: list[str] = []
+        for snap_ent in snap.get("payload") or ():
+            eid = snap_ent.get("entity_id")
+            current = current_map.get(eid)
             if current is None:
                 diff_lines.append(f"\u2796 {eid}: removed")
-                continue
-            old_state = snap_ent.get("state", "?")
-            new_state = current.get("state", "?")
-            if old_state != new_state:
-                diff_lines.append(f"\u2022 {eid}: {old_state} \u2192 {new_state}")
+            else:
+                old_state = snap_ent.get("state", "?")
+                new_state = current.get("state", "?")
+                if old_state != new_state:
+                    diff_lines.append(f"\u2022 {eid}: {old_state} \u2192 {new_state}")
+            if len(diff_lines) >= _SNAP_DIFF_MAX_LINES:
+                break
 
-        diff_text = "\n".join(diff_lines[:30]) if diff_lines else "No changes detected."
+        diff_text = "\n".join(diff_lines) if diff_lines else "No changes detected."
         t, k = build_snapshot_detail(snap, diff_text)
         await self._send_or_edit(cid, t, k, menu="snap_diff")
 
@@ -1802,7 +2245,7 @@ class Handlers:
 
     async def _snap_del(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
         try:
-            snap_id = int(data.split(":", 1)[1])
+            snap_id = int(data.partition(":")[2])
         except (ValueError, IndexError):
             await cb.answer()
             return
@@ -1823,7 +2266,7 @@ class Handlers:
 
     async def _sched_toggle(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
         try:
-            sched_id = int(data.split(":", 1)[1])
+            sched_id = int(data.partition(":")[2])
         except (ValueError, IndexError):
             await cb.answer()
             return
@@ -1845,7 +2288,7 @@ class Handlers:
 
     async def _sched_del(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
         try:
-            sched_id = int(data.split(":", 1)[1])
+            sched_id = int(data.partition(":")[2])
         except (ValueError, IndexError):
             await cb.answer()
             return
@@ -1865,11 +2308,11 @@ class Handlers:
     # -----------------------------------------------------------------------
 
     async def _vac_rooms(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
-        eid = data.split(":", 1)[1] if ":" in data else ""
+        eid = data.partition(":")[2]
         await cb.answer()
 
         state = await self._ha.get_state(eid)
-        name = state.get("attributes", {}).get("friendly_name", eid) if state else eid
+        name = self._friendly_name(state, eid)
 
         segments = await self._vac.get_rooms(eid)
         if not segments:
@@ -1888,15 +2331,15 @@ class Handlers:
     # -----------------------------------------------------------------------
 
     async def _vac_room_sel(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
-        parts = data.split(":", 2)
-        if len(parts) < 3:
+        args = _cb_args(data)
+        if args is None:
             await cb.answer()
             return
-        eid, seg_id = parts[1], parts[2]
+        eid, seg_id = args
         await cb.answer()
 
         state = await self._ha.get_state(eid)
-        name = state.get("attributes", {}).get("friendly_name", eid) if state else eid
+        name = self._friendly_name(state, eid)
 
         segments = await self._vac.get_rooms(eid)
         t, k = build_vacuum_rooms(eid, name, segments, selected_room=seg_id)
@@ -1907,19 +2350,17 @@ class Handlers:
     # -----------------------------------------------------------------------
 
     async def _vac_seg_clean(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
-        parts = data.split(":", 2)
-        if len(parts) < 3:
+        args = _cb_args(data)
+        if args is None:
             await cb.answer("Некорректные данные.", show_alert=True)
             return
-        eid, seg_id = parts[1], parts[2]
+        eid, seg_id = args
         if not await self._check_rl(uid, "vacuum.segment_clean", cb):
             return
 
         await cb.answer("\u2699\ufe0f Запускаю уборку...")
 
         ok, err = await self._vac.clean_segment(eid, seg_id)
-        if ok:
-            self._rl.record()
 
         segments = await self._vac.get_rooms(eid)
         seg_display = self._vac.get_segment_display_name(seg_id, segments)
@@ -1943,12 +2384,12 @@ class Handlers:
     # -----------------------------------------------------------------------
 
     async def _vac_cmd(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
-        parts = data.split(":", 2)
-        if len(parts) < 3:
+        args = _cb_args(data)
+        if args is None:
             await cb.answer()
             return
-        eid, command = parts[1], parts[2]
-        if command not in ("stop", "return_to_base"):
+        eid, command = args
+        if command not in _VAC_SIMPLE_CMDS:
             await cb.answer("Недопустимая команда.", show_alert=True)
             return
         if not await self._check_rl(uid, f"vacuum.{command}", cb):
@@ -1956,29 +2397,30 @@ class Handlers:
 
         await cb.answer("\u2699\ufe0f Выполняю...")
         ok, err = await self._vac.execute_command(eid, command)
-        if ok:
-            self._rl.record()
-        await _audit(self._db, chat_id=cid, user_id=uid, username=uname,
-                     action=f"vacuum.{command}", entity_id=eid,
-                     success=ok, error=err if not ok else None)
 
         label = command.replace("_", " ").title()
         if ok:
             t, k = build_confirmation(f"\u2705 Vacuum: {label}", f"ent:{eid}")
         else:
             t, k = build_confirmation(f"\u274c {label}: {(err or '')[:200]}", f"ent:{eid}")
-        await self._send_or_edit(cid, t, k, menu="vac_result", entity=eid)
+        # Audit write and result render are independent (_audit never raises)
+        await asyncio.gather(
+            _audit(self._db, chat_id=cid, user_id=uid, username=uname,
+                   action=f"vacuum.{command}", entity_id=eid,
+                   success=ok, error=err if not ok else None),
+            self._send_or_edit(cid, t, k, menu="vac_result", entity=eid),
+        )
 
     # -----------------------------------------------------------------------
     # vrtn: — vacuum routines list
     # -----------------------------------------------------------------------
 
     async def _vac_routines(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
-        eid = data.split(":", 1)[1] if ":" in data else ""
+        eid = data.partition(":")[2]
         await cb.answer()
 
         state = await self._ha.get_state(eid)
-        name = state.get("attributes", {}).get("friendly_name", eid) if state else eid
+        name = self._friendly_name(state, eid)
 
         routines = await self._vac.get_routines(eid)
         t, k = build_vacuum_routines(eid, name, routines)
@@ -1989,7 +2431,7 @@ class Handlers:
     # -----------------------------------------------------------------------
 
     async def _routine_press(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
-        btn_eid = data.split(":", 1)[1] if ":" in data else ""
+        btn_eid = data.partition(":")[2]
         if not btn_eid:
             await cb.answer()
             return
@@ -1998,25 +2440,21 @@ class Handlers:
 
         await cb.answer("\u2699\ufe0f Запускаю сценарий...")
         ok, err = await self._vac.press_routine(btn_eid)
-        if ok:
-            self._rl.record()
-        await _audit(self._db, chat_id=cid, user_id=uid, username=uname,
-                     action="button.press", entity_id=btn_eid,
-                     success=ok, error=err if not ok else None)
 
         # Find parent vacuum for back button
-        parent_vac = ""
-        for vac_eid, btns in self._reg.vacuum_routines.items():
-            if btn_eid in btns:
-                parent_vac = vac_eid
-                break
+        parent_vac = self._reg.routine_to_vacuum.get(btn_eid, "")
 
         back = f"vrtn:{parent_vac}" if parent_vac else "nav:main"
         if ok:
             t, k = build_confirmation(f"\u2705 Сценарий запущен!", back)
         else:
             t, k = build_confirmation(f"\u274c Ошибка: {(err or '')[:200]}", back)
-        await self._send_or_edit(cid, t, k, menu="rtn_result")
+        await asyncio.gather(
+            _audit(self._db, chat_id=cid, user_id=uid, username=uname,
+                   action="button.press", entity_id=btn_eid,
+                   success=ok, error=err if not ok else None),
+            self._send_or_edit(cid, t, k, menu="rtn_result"),
+        )
 
     # -----------------------------------------------------------------------
     # Manage / Floors / Areas display
@@ -2030,106 +2468,114 @@ class Handlers:
             await self._show_areas_direct(cid)
 
     async def _show_floors(self, cid: int) -> None:
-        domains = frozenset(self._cfg.menu_domains_allowlist)
-        sa = self._cfg.show_all_enabled
-        floors_sorted = self._reg.get_floors_sorted()
-        floor_dicts = []
-        for f in floors_sorted:
-            areas = self._reg.get_areas_for_floor(f.floor_id)
-            area_count = 0
-            for a in areas:
-                if self._reg.get_area_entities(a.area_id, domains, show_all=sa):
-                    area_count += 1
-            if area_count > 0:
-                floor_dicts.append({
-                    "floor_id": f.floor_id,
-                    "name": f.name,
-                    "area_count": area_count,
-                })
-
-        unassigned_areas = self._reg.get_unassigned_areas()
-        ua_count = sum(
-            1 for a in unassigned_areas
-            if self._reg.get_area_entities(a.area_id, domains, show_all=sa)
-        )
+        def build() -> tuple[list[dict[str, Any]], int]:
+            counts = self._area_counts()
+            floor_dicts = []
+            for f in self._reg.get_floors_sorted():
+                area_count = sum(a.area_id in counts for a in self._reg.get_areas_for_floor(f.floor_id))
+                if area_count:
+                    floor_dicts.append({
+                        "floor_id": f.floor_id,
+                        "name": f.name,
+                        "area_count": area_count,
+                    })
+
+            unassigned_areas = self._reg.get_unassigned_areas()
+            ua_count = sum(1 for a in unassigned_areas if a.area_id in counts)
+            return floor_dicts, ua_count
+
+        floor_dicts, ua_count = self._reg_view("floors", build)
 
         t, k = build_floors_menu(floor_dicts, ua_count)
         await self._send_or_edit(cid, t, k, menu="floors")
 
     async def _show_areas_direct(self, cid: int) -> None:
         """Show all areas without floor grouping."""
-        domains = frozenset(self._cfg.menu_domains_allowlist)
+        domains = self._cfg.menu_domains_allowlist_set
         sa = self._cfg.show_all_enabled
-        all_areas = self._reg.get_all_areas_sorted()
-        area_dicts = []
-        for a in all_areas:
-            eids = self._reg.get_area_entities(a.area_id, domains, show_all=sa)
-            if eids:
-                area_dicts.append({"area_id": a.area_id, "name": a.name, "entity_count": len(eids)})
-
-        unassigned = self._reg.get_unassigned_entities(domains, show_all=sa)
+
+        def build() -> tuple[list[dict[str, Any]], int]:
+            counts = self._area_counts()
+            area_dicts = [
+                {"area_id": a.area_id, "name": a.name, "entity_count": n}
+                for a in self._reg.get_all_areas_sorted()
+                if (n := counts.get(a.area_id))
+            ]
+            return area_dicts, len(self._reg.get_unassigned_entities(domains, show_all=sa))
+
+        area_dicts, unassigned_count = self._reg_view("areas", build)
+
         t, k = build_areas_menu(
             area_dicts, back_target="nav:main",
-            unassigned_entity_count=len(unassigned),
+            unassigned_entity_count=unassigned_count,
         )
         await self._send_or_edit(cid, t, k, menu="areas")
 
     async def _show_favorites(self, cid: int, uid: int, page: int) -> None:
-        fav_eids = await self._db.get_favorites(uid)
+        # Only the visible page is read from the DB and enriched with state
+        size = self._cfg.menu_page_size
+        total, fav_actions, pinned = await asyncio.gather(
+            self._db.count_favorites(uid),
+            self._db.get_favorite_actions(uid),
+            self._db.get_pinned_items(uid),
+        )
+        page = max(0, min(page, math.ceil(total / size) - 1))
+        fav_eids = await self._db.get_favorites_page(uid, page * size, size)
         ent_list = await self._enrich_entities(fav_eids)
-        fav_actions = await self._db.get_favorite_actions(uid)
-        pinned = await self._db.get_pinned_items(uid)
-        t, k = build_favorites_menu(ent_list, page, self._cfg.menu_page_size, fav_actions, pinned)
+        t, k = build_favorites_menu(
+            ent_list, page, size, fav_actions, pinned, total=total,
+        )
         await self._send_or_edit(cid, t, k, menu="favorites")
 
     async def _show_active_now(self, cid: int, uid: int, page: int) -> None:
         """Show all entities that are currently in an active state, deduplicated by device."""
-        _DOMAIN_RANK = {
-            "vacuum": 0, "media_player": 1, "climate": 2, "light": 3,
-            "cover": 4, "fan": 5, "switch": 6, "lock": 7, "water_heater": 8,
-        }
-        domains = frozenset(self._cfg.menu_domains_allowlist)
         try:
             all_states = await self._ha.list_states()
         except Exception:
             logger.exception("Failed to fetch states for Active Now")
             all_states = []
+        active = self._collect_active(all_states)
+        # Cache for pagination
+        self._active_cache[cid] = active
+        t, k = build_active_now_menu(active, page, self._cfg.menu_page_size)
+        await self._send_or_edit(cid, t, k, menu="active")
+
+    def _collect_active(self, all_states: list[dict[str, Any]]) -> list[dict[str, Any]]:
+        """Active entities in the menu domains, one per device (best domain rank)."""
+        domains = self._cfg.menu_domains_allowlist_set
         # Collect best active entity per device, prioritising by domain rank
-        device_best: dict[str, tuple[int, dict[str, Any]]] = {}
+        best_rank: dict[str, int] = {}
+        best_entry: dict[str, dict[str, Any]] = {}
         no_device: list[dict[str, Any]] = []
+        # Loop-invariant lookups bound once: this walks every HA state
+        entity_device = self._reg.entity_device
+        overrides = self._device_overrides
         for s in all_states:
             eid = s.get("entity_id", "")
             if not eid:
                 continue
-            domain = eid.split(".", 1)[0]
+            domain = eid.partition(".")[0]
             if domain not in domains:
                 continue
             state_val = s.get("state", "")
-            mapped = map_state(eid, state_val, s.get("attributes", {}),
-                               self._device_overrides)
-            if not mapped.is_active:
+            attrs = s.get("attributes") or {}
+            if not map_state(eid, state_val, attrs, overrides).is_active:
                 continue
-            fname = s.get("attributes", {}).get("friendly_name", eid)
             entry = {
                 "entity_id": eid,
-                "friendly_name": fname,
+                "friendly_name": attrs.get("friendly_name", eid),
                 "state": state_val,
                 "domain": domain,
             }
-            ent_info = self._reg.entities.get(eid)
-            dev_id = ent_info.device_id if ent_info and ent_info.device_id else None
+            dev_id = entity_device.get(eid)
             if dev_id:
-                rank = _DOMAIN_RANK.get(domain, 99)
-                existing = device_best.get(dev_id)
-                if existing is None or rank < existing[0]:
-                    device_best[dev_id] = (rank, entry)
+                rank = _ACTIVE_DOMAIN_RANK.get(domain, 99)
+                if rank < best_rank.get(dev_id, 100):
+                    best_rank[dev_id] = rank
+                    best_entry[dev_id] = entry
             else:
                 no_device.append(entry)
-        active = [ent for _, ent in device_best.values()] + no_device
-        # Cache for pagination
-        self._search_cache[cid] = active
-        t, k = build_active_now_menu(active, page, self._cfg.menu_page_size)
-        await self._send_or_edit(cid, t, k, menu="active")
+        return [*best_entry.values(), *no_device]
 
     async def _show_fav_actions(self, cid: int, uid: int, page: int) -> None:
         actions = await self._db.get_favorite_actions(uid)
@@ -2137,31 +2583,36 @@ class Handlers:
         await self._send_or_edit(cid, t, k, menu="fav_actions")
 
     async def _show_notif_list(self, cid: int, uid: int, page: int) -> None:
-        subs = await self._db.get_user_notifications(uid)
-        enriched = []
-        for sub in subs:
-            state = await self._ha.get_state(sub["entity_id"])
-            fname = sub["entity_id"]
-            if state:
-                fname = state.get("attributes", {}).get("friendly_name", sub["entity_id"])
-            enriched.append({**sub, "friendly_name": fname})
-        t, k = build_notif_list(enriched, page, self._cfg.menu_page_size)
+        size = self._cfg.menu_page_size
+        total = await self._db.count_user_notifications(uid)
+        page = max(0, min(page, math.ceil(total / size) - 1))
+        subs = await self._db.get_user_notifications_page(uid, page * size, size)
+        # Names come from the registry JOIN; only unnamed entities hit HA,
+        # concurrently
+        unnamed = [sub for sub in subs if not sub["friendly_name"]]
+        states = await asyncio.gather(*(self._ha.get_state(sub["entity_id"]) for sub in unnamed))
+        for sub, state in zip(unnamed, states):
+            sub["friendly_name"] = self._friendly_name(state, sub["entity_id"])
+        t, k = build_notif_list(subs, page, size, total=total)
         await self._send_or_edit(cid, t, k, menu="notif")
 
     async def _do_refresh(self, cid: int) -> None:
-        t, k = build_confirmation("\U0001f504 Синхронизация с Home Assistant...", "nav:main")
-        await self._send_or_edit(cid, t, k, menu="refreshing")
-
         # Snapshot before sync for diff
-        old_areas = set(self._reg.areas.keys())
-        old_devices = set(self._reg.devices.keys())
-        old_entities = set(self._reg.entities.keys())
+        old_areas = set(self._reg.areas)
+        old_devices = set(self._reg.devices)
+        old_entities = set(self._reg.entities)
 
-        try:
-            ok = await self._reg.sync()
-        except Exception:
-            logger.exception("Registry sync error during refresh")
-            ok = False
+        if self._reg.last_sync_age < _REFRESH_FRESH_SECONDS:
+            # Registry was synced moments ago (double tap, startup): report it as is
+            ok = True
+        else:
+            t, k = build_confirmation("\U0001f504 Синхронизация с Home Assistant...", "nav:main")
+            await self._send_or_edit(cid, t, k, menu="refreshing")
+            try:
+                ok = await self._reg.sync()
+            except Exception:
+                logger.exception("Registry sync error during refresh")
+                ok = False
         if ok:
             # Friendly summary with counts
             nf = len(self._reg.floors)
@@ -2177,18 +2628,15 @@ class Handlers:
                 f"\U0001f50c Сущностей: <b>{ne}</b>",
             ]
 
-            # Diff summary
-            new_areas = set(self._reg.areas.keys())
-            new_devices = set(self._reg.devices.keys())
-            new_entities = set(self._reg.entities.keys())
+            # Diff summary: one intersection per registry gives both directions
+            kept_a = len(old_areas.intersection(self._reg.areas))
+            kept_d = len(old_devices.intersection(self._reg.devices))
+            kept_e = len(old_entities.intersection(self._reg.entities))
 
             diff_parts: list[str] = []
-            added_a = len(new_areas - old_areas)
-            removed_a = len(old_areas - new_areas)
-            added_d = len(new_devices - old_devices)
-            removed_d = len(old_devices - new_devices)
-            added_e = len(new_entities - old_entities)
-            removed_e = len(old_entities - new_entities)
+            added_a, removed_a = na - kept_a, len(old_areas) - kept_a
+            added_d, removed_d = nd - kept_d, len(old_devices) - kept_d
+            added_e, removed_e = ne - kept_e, len(old_entities) - kept_e
 
             if added_a:
                 diff_parts.append(f"+{added_a} комнат")
@@ -2227,51 +2675,96 @@ class Handlers:
         query_lower = query.lower()
         all_states = await self._ha.list_states()
         results: list[dict[str, Any]] = []
+        # One match past the cap tells a cut list from exactly cap matches
+        for low_eid, low_name, row in self._search_rows(all_states):
+            if query_lower in low_eid or query_lower in low_name:
+                results.append(row)
+                if len(results) > _SEARCH_MAX_RESULTS:
+                    break
+        truncated = len(results) > _SEARCH_MAX_RESULTS
+        if truncated:
+            del results[_SEARCH_MAX_RESULTS:]
+
+        self._search_cache[cid] = (results, truncated)
+
+        t, k = build_search_results(
+            query, results, 0, self._cfg.menu_page_size, truncated=truncated,
+        )
+        tid = self._get_thread_id(message) if message else None
+        await self._send_or_edit(
+            cid, t, k, source=message, menu="search_results", thread_id=tid,
+        )
 
-        for s in all_states:
-            eid = s.get("entity_id", "")
-            fname = s.get("attributes", {}).get("friendly_name", eid)
-            if query_lower in eid.lower() or query_lower in fname.lower():
-                results.append({
+    def _search_rows(self, all_states: list[dict[str, Any]]) -> list[tuple[str, str, dict[str, Any]]]:
+        """(lowered id, lowered name, result row) per state, built once per state list.
+
+        list_states() hands out the same list until it refetches, so the
+        index is reused across searches within the state cache window.
+        """
+        def build() -> list[tuple[str, str, dict[str, Any]]]:
+            rows: list[tuple[str, str, dict[str, Any]]] = []
+            for s in all_states:
+                eid = s.get("entity_id", "")
+                fname = (s.get("attributes") or {}).get("friendly_name") or eid
+                rows.append((eid.lower(), fname.lower(), {
                     "entity_id": eid,
                     "friendly_name": fname,
                     "state": s.get("state", "unknown"),
-                    "domain": eid.split(".", 1)[0],
-                })
+                    "domain": eid.partition(".")[0],
+                }))
+            return rows
 
-        self._search_cache[cid] = results
+        return self._state_view("search", all_states, build)
 
-        t, k = build_search_results(query, results, 0, self._cfg.menu_page_size)
-        tid = self._get_thread_id(message) if message else None
-        await self._send_or_edit(
-            cid, t, k, source=message, menu="search_results", thread_id=tid,
-        )
+    def _states_by_domain(self, all_states: list[dict[str, Any]]) -> dict[str, list[dict[str, Any]]]:
+        """States grouped by domain in list order, built once per state list."""
+        def build() -> dict[str, list[dict[str, Any]]]:
+            by_domain: dict[str, list[dict[str, Any]]] = {}
+            for s in all_states:
+                eid = s.get("entity_id")
+                if eid:
+                    by_domain.setdefault(eid.partition(".")[0], []).append(s)
+            return by_domain
+
+        return self._state_view("by_domain", all_states, build)
 
     # -----------------------------------------------------------------------
     # Data helpers
     # -----------------------------------------------------------------------
 
+    def _friendly_name(self, state: dict[str, Any] | None, eid: str) -> str:
+        """Display name from HA state, else from the registry, else the entity id."""
+        attrs = state.get("attributes") if state else None
+        name = attrs.get("friendly_name") if attrs else None
+        return name or self._reg.get_entity_display_name(eid)
+
     async def _enrich_entities(self, eids: list[str]) -> list[dict[str, Any]]:
-        """Fetch state for entity IDs, return enriched dicts for UI."""
+        """Fetch state for entity IDs, return enriched dicts for UI.
+
+        States are fetched concurrently; HAClient bounds the in-flight
+        requests and serves entities seen by a recent get_state() or bulk
+        list_states() from its cache without a round-trip.
+        """
+        states = await asyncio.gather(*(self._ha.get_state(eid) for eid in eids))
         result: list[dict[str, Any]] = []
-        for eid in eids:
-            state = await self._ha.get_state(eid)
-            if state and isinstance(state, dict):
-                result.append({
-                    "entity_id": eid,
-                    "friendly_name": state.get("attributes", {}).get("friendly_name", eid),
-                    "state": state.get("state", "unknown"),
-                    "domain": eid.split(".", 1)[0],
-                })
-            else:
-                result.append({
-                    "entity_id": eid,
-                    "friendly_name": eid,
-                    "state": "unavailable",
-                    "domain": eid.split(".", 1)[0],
-                })
+        for eid, state in zip(eids, states):
+            if not isinstance(state, dict):
+                state = None
+            result.append({
+                "entity_id": eid,
+                "friendly_name": self._friendly_name(state, eid),
+                "state": state.get("state", "unknown") if state else "unavailable",
+                "domain": eid.partition(".")[0],
+            })
         return result
 
+    async def _enrich_page(self, eids: list[str], page: int) -> tuple[int, list[dict[str, Any]]]:
+        """Enrich only the entities shown on *page*; returns the clamped page."""
+        size = self._cfg.menu_page_size
+        page = max(0, min(page, (len(eids) - 1) // size))
+        start = page * size
+        return page, await self._enrich_entities(eids[start:start + size])
+
     async def _fetch_status_entities(self) -> list[dict[str, Any]]:
         if self._cfg.status_entities:
             entities: list[dict[str, Any]] = []
@@ -2288,30 +2781,23 @@ class Handlers:
         except Exception:
             logger.exception("Failed to fetch states for Status")
             return []
-        domains = frozenset(self._cfg.menu_domains_allowlist)
+        domains = self._cfg.menu_domains_allowlist_set
+        overrides = self._device_overrides
         active: list[dict[str, Any]] = []
+        # Counted in the same pass for the summary shown when nothing is active
+        domain_counts: dict[str, int] = {}
         for s in all_states:
             eid = s.get("entity_id", "")
             if not eid:
                 continue
-            domain = eid.split(".", 1)[0]
+            domain = eid.partition(".")[0]
             if domain not in domains:
                 continue
-            state_val = s.get("state", "")
-            mapped = map_state(eid, state_val, s.get("attributes", {}),
-                               self._device_overrides)
-            if mapped.is_active:
+            domain_counts[domain] = domain_counts.get(domain, 0) + 1
+            if map_state(eid, s.get("state", ""), s.get("attributes"), overrides).is_active:
                 active.append(s)
         if not active:
             # Nothing active — show summary of all entities by domain count
-            domain_counts: dict[str, int] = {}
-            for s in all_states:
-                eid = s.get("entity_id", "")
-                if not eid:
-                    continue
-                domain = eid.split(".", 1)[0]
-                if domain in domains:
-                    domain_counts[domain] = domain_counts.get(domain, 0) + 1
             summary: list[dict[str, Any]] = []
             for d, cnt in sorted(domain_counts.items()):
                 summary.append({
@@ -2332,21 +2818,27 @@ class Handlers:
 
     async def _show_scenarios(self, cid: int, page: int = 0) -> None:
         """Show all scene and script entities grouped as scenarios."""
-        scenarios: list[dict[str, Any]] = []
-        for eid, ent in self._reg.entities.items():
-            if ent.disabled_by:
-                continue
-            domain = eid.split(".", 1)[0]
-            if domain in ("scene", "script"):
-                name = ent.name or ent.original_name or eid
-                scenarios.append({"entity_id": eid, "friendly_name": name, "domain": domain})
-        scenarios.sort(key=lambda x: x["friendly_name"].lower())
+        def build() -> list[dict[str, Any]]:
+            scenarios: list[dict[str, Any]] = []
+            for eid, ent in self._reg.entities.items():
+                if ent.disabled_by:
+                    continue
+                domain = eid.partition(".")[0]
+                if domain in ("scene", "script"):
+                    name = ent.name or ent.original_name or eid
+                    scenarios.append({"entity_id": eid, "friendly_name": name, "domain": domain})
+            scenarios.sort(key=lambda x: x["friendly_name"].lower())
+            return scenarios
+
+        scenarios = self._reg_view("scenarios", build)
         t, k = build_scenarios_menu(scenarios, page, self._cfg.menu_page_size)
         await self._send_or_edit(cid, t, k, menu="scenarios")
 
     async def _scenario_page(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
-        parts = data.split(":")
-        page = int(parts[1]) if len(parts) > 1 else 0
+        try:
+            page = int(data.partition(":")[2])
+        except ValueError:
+            page = 0
         await cb.answer()
         await self._show_scenarios(cid, page)
 
@@ -2355,11 +2847,11 @@ class Handlers:
     # -----------------------------------------------------------------------
 
     async def _quick_scene(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
-        _, eid = data.split(":", 1) if ":" in data else ("", "")
+        eid = data.partition(":")[2]
         if not eid:
             await cb.answer("\u274c Не найден сценарий")
             return
-        domain = eid.split(".", 1)[0]
+        domain = eid.partition(".")[0]
         try:
             ok, _err = await self._ha.call_service(domain, "turn_on", {"entity_id": eid})
         except Exception:
@@ -2380,7 +2872,7 @@ class Handlers:
     # -----------------------------------------------------------------------
 
     async def _light_color_menu(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
-        _, eid = data.split(":", 1) if ":" in data else ("", "")
+        eid = data.partition(":")[2]
         await cb.answer()
         if not eid:
             return
@@ -2390,13 +2882,13 @@ class Handlers:
         await self._send_or_edit(cid, t, k, menu=f"lclr:{eid}")
 
     async def _light_color_set(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
-        parts = data.split(":")
-        if len(parts) < 3:
+        args = _cb_args(data)
+        if args is None:
             await cb.answer("\u274c Неверный формат")
             return
-        eid = parts[1]
+        eid, raw_idx = args
         try:
-            color_idx = int(parts[2])
+            color_idx = int(raw_idx)
         except ValueError:
             await cb.answer("\u274c Неверный индекс цвета")
             return
@@ -2426,9 +2918,8 @@ class Handlers:
     # -----------------------------------------------------------------------
 
     async def _global_color(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
-        parts = data.split(":")
         try:
-            color_idx = int(parts[1]) if len(parts) > 1 else -1
+            color_idx = int(data.partition(":")[2])
         except ValueError:
             color_idx = -1
         if color_idx < 0 or color_idx >= len(COLOR_PRESETS):
@@ -2444,23 +2935,25 @@ class Handlers:
             await cb.answer("\u274c Ошибка получения состояний", show_alert=True)
             return
 
+        targets = [
+            s["entity_id"] for s in self._states_by_domain(all_states).get("light", ())
+            if not RGB_COLOR_MODES.isdisjoint(
+                (s.get("attributes") or {}).get("supported_color_modes") or ()
+            )
+        ]
+        # Issued together; HAClient caps how many are in flight at once
+        rgb_color = list(rgb)
+        results = await asyncio.gather(
+            *(self._ha.call_service("light", "turn_on", {"entity_id": eid, "rgb_color": rgb_color})
+              for eid in targets),
+            return_exceptions=True,
+        )
         count = 0
-        for s in all_states:
-            eid = s.get("entity_id", "")
-            if not eid.startswith("light."):
-                continue
-            attrs = s.get("attributes", {})
-            color_modes = attrs.get("supported_color_modes", [])
-            if any(m in ("rgb", "rgbw", "rgbww", "hs", "xy") for m in color_modes):
-                try:
-                    ok, _err = await self._ha.call_service(
-                        "light", "turn_on",
-                        {"entity_id": eid, "rgb_color": list(rgb)},
-                    )
-                    if ok:
-                        count += 1
-                except Exception:
-                    logger.warning("Failed to set color on %s", eid)
+        for eid, res in zip(targets, results):
+            if isinstance(res, BaseException):
+                logger.warning("Failed to set color on %s", eid)
+            elif res[0]:
+                count += 1
 
         await cb.answer(f"\u2705 {label} — {count} ламп")
         await _audit(self._db, chat_id=cid, user_id=uid, username=uname,
@@ -2482,14 +2975,13 @@ class Handlers:
         except Exception:
             logger.exception("Failed to fetch states for radio")
             all_states = []
-        for s in all_states:
-            eid = s.get("entity_id", "")
-            if eid.startswith("media_player."):
-                fname = s.get("attributes", {}).get("friendly_name", eid)
-                players.append({"entity_id": eid, "friendly_name": fname})
+        for s in self._states_by_domain(all_states).get("media_player", ()):
+            eid = s["entity_id"]
+            fname = (s.get("attributes") or {}).get("friendly_name", eid)
+            players.append({"entity_id": eid, "friendly_name": fname})
 
         # Get configured stations from config
-        stations = list(self._cfg.radio_stations)
+        stations = self._cfg.radio_stations
 
         current_station = state.get("station_idx", 0)
         current_player = state.get("player_eid", "")
@@ -2505,11 +2997,10 @@ class Handlers:
         await self._send_or_edit(cid, t, k, menu="radio")
 
     async def _radio_control(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
-        parts = data.split(":")
-        action = parts[1] if len(parts) > 1 else ""
+        action = data.partition(":")[2]
         state = self._radio_state.setdefault(cid, {"station_idx": 0, "player_eid": "", "playing": False})
 
-        stations = list(self._cfg.radio_stations)
+        stations = self._cfg.radio_stations
 
         if action == "play":
             player = state.get("player_eid", "")
@@ -2553,7 +3044,7 @@ class Handlers:
 
         elif action == "next":
             idx = state.get("station_idx", 0)
-            state["station_idx"] = (idx + 1) % max(len(stations), 1)
+            state["station_idx"] = (idx + 1) % (len(stations) or 1)
             await cb.answer()
             if state.get("playing"):
                 # Auto-play next station
@@ -2575,7 +3066,7 @@ class Handlers:
 
         elif action == "prev":
             idx = state.get("station_idx", 0)
-            state["station_idx"] = (idx - 1) % max(len(stations), 1)
+            state["station_idx"] = (idx - 1) % (len(stations) or 1)
             await cb.answer()
             if state.get("playing"):
                 new_idx = state["station_idx"]
@@ -2597,8 +3088,7 @@ class Handlers:
             await cb.answer()
 
     async def _radio_output(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
-        parts = data.split(":", 1)
-        player_eid = parts[1] if len(parts) > 1 else ""
+        player_eid = data.partition(":")[2]
         state = self._radio_state.setdefault(cid, {"station_idx": 0, "player_eid": "", "playing": False})
         state["player_eid"] = player_eid
         fname = self._reg.get_entity_display_name(player_eid)
@@ -2616,24 +3106,27 @@ class Handlers:
         except Exception:
             logger.exception("Failed to fetch states for Automations")
             all_states = []
-        automations: list[dict[str, Any]] = []
-        for s in all_states:
-            eid = s.get("entity_id", "")
-            if eid.startswith("automation."):
-                fname = s.get("attributes", {}).get("friendly_name", eid)
+
+        def build() -> list[dict[str, Any]]:
+            automations: list[dict[str, Any]] = []
+            for s in self._states_by_domain(all_states).get("automation", ()):
+                eid = s["entity_id"]
+                fname = (s.get("attributes") or {}).get("friendly_name") or eid
                 automations.append({
                     "entity_id": eid,
                     "friendly_name": fname,
                     "state": s.get("state", "off"),
                 })
-        automations.sort(key=lambda x: x["friendly_name"].lower())
+            automations.sort(key=lambda x: x["friendly_name"].lower())
+            return automations
+
+        automations = self._state_view("automations", all_states, build)
         t, k = build_automations_menu(automations, page, self._cfg.menu_page_size)
         await self._send_or_edit(cid, t, k, menu="automations")
 
     async def _automation_toggle(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
         """Toggle automation on/off."""
-        parts = data.split(":", 1)
-        eid = parts[1] if len(parts) > 1 else ""
+        eid = data.partition(":")[2]
         if not eid:
             await cb.answer("Некорректная автоматизация.", show_alert=True)
             return
@@ -2659,8 +3152,7 @@ class Handlers:
 
     async def _automation_trigger(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
         """Trigger an automation."""
-        parts = data.split(":", 1)
-        eid = parts[1] if len(parts) > 1 else ""
+        eid = data.partition(":")[2]
         if not eid:
             await cb.answer("Некорректная автоматизация.", show_alert=True)
             return
@@ -2679,8 +3171,10 @@ class Handlers:
                          action="automation.trigger", entity_id=eid, success=False, error=err)
 
     async def _automation_page(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
-        parts = data.split(":")
-        page = int(parts[1]) if len(parts) > 1 else 0
+        try:
+            page = int(data.partition(":")[2])
+        except ValueError:
+            page = 0
         await cb.answer()
         await self._show_automations(cid, page)
 
@@ -2695,20 +3189,23 @@ class Handlers:
         except Exception:
             logger.exception("Failed to fetch states for To-Do")
             all_states = []
-        todo_lists: list[dict[str, Any]] = []
-        for s in all_states:
-            eid = s.get("entity_id", "")
-            if eid.startswith("todo."):
-                fname = s.get("attributes", {}).get("friendly_name", eid)
+
+        def build() -> list[dict[str, Any]]:
+            todo_lists: list[dict[str, Any]] = []
+            for s in self._states_by_domain(all_states).get("todo", ()):
+                eid = s["entity_id"]
+                fname = (s.get("attributes") or {}).get("friendly_name") or eid
                 todo_lists.append({"entity_id": eid, "friendly_name": fname})
-        todo_lists.sort(key=lambda x: x["friendly_name"].lower())
+            todo_lists.sort(key=lambda x: x["friendly_name"].lower())
+            return todo_lists
+
+        todo_lists = self._state_view("todo", all_states, build)
         t, k = build_todo_lists_menu(todo_lists)
         await self._send_or_edit(cid, t, k, menu="todo")
 
     async def _todo_list_items(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
         """Show items in a selected to-do list."""
-        parts = data.split(":", 1)
-        list_eid = parts[1] if len(parts) > 1 else ""
+        list_eid = data.partition(":")[2]
         if not list_eid:
             await cb.answer("Некорректный список.", show_alert=True)
             return
@@ -2719,7 +3216,7 @@ class Handlers:
         """Fetch and display items from a to-do list."""
         # Get list name
         state = await self._ha.get_state(list_eid)
-        list_name = state.get("attributes", {}).get("friendly_name", list_eid) if state else list_eid
+        list_name = self._friendly_name(state, list_eid)
         # Fetch items via todo.get_items service
         try:
             ok, result = await self._ha.call_service(
@@ -2739,11 +3236,11 @@ class Handlers:
 
     async def _todo_complete_item(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
         """Mark a to-do item as completed."""
-        parts = data.split(":", 2)
-        if len(parts) < 3:
+        args = _cb_args(data)
+        if args is None:
             await cb.answer("Некорректные данные.", show_alert=True)
             return
-        list_eid, item_uid = parts[1], parts[2]
+        list_eid, item_uid = args
         try:
             ok, err = await self._ha.call_service(
                 "todo", "update_item",
@@ -2762,11 +3259,11 @@ class Handlers:
 
     async def _todo_delete_item(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
         """Delete a to-do item."""
-        parts = data.split(":", 2)
-        if len(parts) < 3:
+        args = _cb_args(data)
+        if args is None:
             await cb.answer("Некорректные данные.", show_alert=True)
             return
-        list_eid, item_uid = parts[1], parts[2]
+        list_eid, item_uid = args
         try:
             ok, err = await self._ha.call_service(
                 "todo", "remove_item",
@@ -2785,8 +3282,7 @@ class Handlers:
 
     async def _todo_add_start(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
         """Enter add-item mode: next text message will be the item summary."""
-        parts = data.split(":", 1)
-        list_eid = parts[1] if len(parts) > 1 else ""
+        list_eid = data.partition(":")[2]
         if not list_eid:
             await cb.answer("Некорректный список.", show_alert=True)
             return
@@ -2800,12 +3296,12 @@ class Handlers:
 
     async def _todo_page(self, cid: int, uid: int, uname: str, data: str, cb: CallbackQuery) -> None:
         """Paginate to-do items."""
-        parts = data.split(":", 2)
-        if len(parts) < 3:
+        args = _cb_args(data)
+        if args is None:
             await cb.answer()
             return
-        list_eid = parts[1]
-        page = int(parts[2]) if parts[2].isdigit() else 0
+        list_eid, raw_page = args
+        page = int(raw_page) if raw_page.isdigit() else 0
         await cb.answer()
         await self._show_todo_items(cid, list_eid, page)
 
@@ -2815,13 +3311,13 @@ class Handlers:
 
     async def cmd_terminal(self, message: Message) -> None:
         """Execute a shell command (local container only, restricted)."""
-        uid, uname = self._extract_user(message)
-        if uid is None:
-            return
         cid = message.chat.id
         if not self._is_authorized_chat(cid):
             await message.answer("\u26d4 Неавторизованный чат.")
             return
+        uid, uname = self._extract_user(message)
+        if uid is None:
+            return
         if not self._is_authorized_user(uid):
             await message.answer("\u26d4 Неавторизованный пользователь.")
             return
@@ -2834,7 +3330,7 @@ class Handlers:
             )
             return
         # Admin only
-        role = await self._db.get_user_role(uid)
+        role = await self._get_role(uid)
         if role != "admin":
             await message.answer("\u26d4 Только для администраторов.")
             return
@@ -248,7 +248,7 @@ class NotificationManager:
 
             # mode=state_and_key_attrs: also check key attributes
             elif mode == "state_and_key_attrs":
-                domain = entity_id.split(".", 1)[0]
+                domain = entity_id.partition(".")[0]
                 key_attrs = _KEY_ATTRS.get(domain, frozenset())
                 state_changed = old_val != new_val
                 attrs_changed = False
@@ -267,7 +267,7 @@ class NotificationManager:
             ts = datetime.now(timezone.utc).strftime("%H:%M:%S")
 
             # Vacuum completion / error detection
-            domain = entity_id.split(".", 1)[0]
+            domain = entity_id.partition(".")[0]
             completion_line = ""
             if domain == "vacuum" and old_val in ("cleaning", "returning") and new_val in ("docked", "idle"):
                 completion_line = "\u2705 Уборка завершена!\n"
@@ -284,7 +284,7 @@ class NotificationManager:
 
             # Add key attr changes if relevant
             if mode == "state_and_key_attrs":
-                domain = entity_id.split(".", 1)[0]
+                domain = entity_id.partition(".")[0]
                 key_attrs = _KEY_ATTRS.get(domain, frozenset())
                 old_attrs = old_state.get("attributes", {})
                 new_attrs = new_state.get("attributes", {})
@@ -298,7 +298,7 @@ class NotificationManager:
                     text += "\n" + "\n".join(changes)
 
             # Build actionable buttons
-            domain = entity_id.split(".", 1)[0]
+            domain = entity_id.partition(".")[0]
             kb = _build_notif_buttons(entity_id, domain, user_id)
 
             await self._send_notification(user_id, text, kb)
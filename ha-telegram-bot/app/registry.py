@@ -13,6 +13,8 @@ import asyncio
 import json
 import logging
 import re
+import time
+from collections import Counter
 from dataclasses import dataclass, field
 from typing import Any
 
@@ -92,6 +94,7 @@ class EntityInfo:
     hidden_by: str | None = None
     translation_key: str | None = None
     entity_category: str | None = None  # "diagnostic", "config", or None (primary)
+    has_entity_name: bool = False  # name is relative to the device name
 
 
 # ---------------------------------------------------------------------------
@@ -115,8 +118,31 @@ class HARegistry:
         # Vacuum-specific
         self.vacuum_routines: dict[str, list[str]] = {}   # vacuum_eid -> [button_eid, ...]
         self.vacuum_platforms: dict[str, str] = {}          # vacuum_eid -> platform
+        self.routine_to_vacuum: dict[str, str] = {}         # button_eid -> vacuum_eid
+
+        # Per-area entity counts by domain (all / primary-only, i.e. without
+        # diagnostic and config entities) — built with the cross-refs
+        self._area_domain_counts: dict[str, Counter[str]] = {}
+        self._area_primary_counts: dict[str, Counter[str]] = {}
+        # Sorted views for menus, also rebuilt with the cross-refs
+        # (shared lists: callers must treat them as read-only)
+        self._floors_sorted: list[FloorInfo] = []
+        self._areas_sorted: list[AreaInfo] = []
+        self._unassigned_areas: list[AreaInfo] = []
+        self._unassigned_eids: list[str] = []
+        # Enabled entity ids per device (sorted), so device taps skip a full
+        # entity scan
+        self._device_entities: dict[str, list[str]] = {}
+        # entity_id -> device_id for entities attached to a device
+        self.entity_device: dict[str, str] = {}
 
         self._synced = False
+        # Bumped whenever a sync replaces the in-memory registry; consumers
+        # key derived caches on it
+        self.version = 0
+        # Bumped once a sync has (re)written vacuum segments to the DB
+        self.segments_version = 0
+        self._last_sync_mono: float | None = None
 
     @property
     def has_floors(self) -> bool:
@@ -126,6 +152,13 @@ class HARegistry:
     def synced(self) -> bool:
         return self._synced
 
+    @property
+    def last_sync_age(self) -> float:
+        """Seconds since the last successful sync (inf if never synced)."""
+        if self._last_sync_mono is None:
+            return float("inf")
+        return time.monotonic() - self._last_sync_mono
+
     # -------------------------------------------------------------------
     # WebSocket helpers
     # -------------------------------------------------------------------
@@ -203,10 +236,18 @@ class HARegistry:
             self._process_entities(entities_raw)
             self._build_cross_refs()
             self._detect_vacuum_routines()
+            # Structures above are already replaced: invalidate derived caches
+            # now, even if a DB write below fails
+            self.version += 1
             await self._populate_entity_area_cache()
-            await self._detect_vacuum_segments()
+            await self._populate_entity_names()
+            try:
+                await self._detect_vacuum_segments()
+            finally:
+                self.segments_version += 1
 
             self._synced = True
+            self._last_sync_mono = time.monotonic()
             logger.info(
                 "Registry sync OK: %d floors, %d areas, %d devices, %d entities",
                 len(self.floors), len(self.areas), len(self.devices), len(self.entities),
@@ -275,6 +316,7 @@ class HARegistry:
                     hidden_by=item.get("hidden_by"),
                     translation_key=item.get("translation_key"),
                     entity_category=item.get("entity_category"),
+                    has_entity_name=bool(item.get("has_entity_name")),
                 )
 
     # -------------------------------------------------------------------
@@ -288,6 +330,8 @@ class HARegistry:
             f.area_ids = []
         for a in self.areas.values():
             a.entity_ids = []
+        self._area_domain_counts = {aid: Counter() for aid in self.areas}
+        self._area_primary_counts = {aid: Counter() for aid in self.areas}
 
         # Areas -> floors
         for area in self.areas.values():
@@ -297,9 +341,16 @@ class HARegistry:
         # Entities -> areas (entity.area_id takes priority, else device.area_id)
         assigned_count = 0
         unassigned_count = 0
+        unassigned_eids: list[str] = []
+        device_entities: dict[str, list[str]] = {}
+        entity_device: dict[str, str] = {}
         for ent in self.entities.values():
+            if ent.device_id:
+                entity_device[ent.entity_id] = ent.device_id
             if ent.disabled_by:
                 continue
+            if ent.device_id:
+                device_entities.setdefault(ent.device_id, []).append(ent.entity_id)
             area_id = ent.area_id
             if not area_id and ent.device_id:
                 dev = self.devices.get(ent.device_id)
@@ -307,9 +358,28 @@ class HARegistry:
                     area_id = dev.area_id
             if area_id and area_id in self.areas:
                 self.areas[area_id].entity_ids.append(ent.entity_id)
+                domain = ent.entity_id.partition(".")[0]
+                self._area_domain_counts[area_id][domain] += 1
+                if ent.entity_category not in ("diagnostic", "config"):
+                    self._area_primary_counts[area_id][domain] += 1
                 assigned_count += 1
             else:
                 unassigned_count += 1
+                unassigned_eids.append(ent.entity_id)
+
+        self._floors_sorted = sorted(self.floors.values(), key=lambda f: (f.level, f.name))
+        self._areas_sorted = sorted(self.areas.values(), key=lambda a: a.name)
+        self._unassigned_areas = [
+            a for a in self._areas_sorted
+            if not (a.floor_id and a.floor_id in self.floors)
+        ]
+        for f in self.floors.values():
+            f.area_ids.sort(key=lambda aid: self.areas[aid].name)
+        self._unassigned_eids = sorted(unassigned_eids)
+        for eids in device_entities.values():
+            eids.sort()
+        self._device_entities = device_entities
+        self.entity_device = entity_device
         logger.info(
             "Cross-refs built: %d entities assigned to areas, %d unassigned",
             assigned_count, unassigned_count,
@@ -322,6 +392,7 @@ class HARegistry:
     def _detect_vacuum_routines(self) -> None:
         self.vacuum_routines.clear()
         self.vacuum_platforms.clear()
+        self.routine_to_vacuum.clear()
 
         # Map device_id -> vacuum_entity_id
         dev_to_vacuum: dict[str, str] = {}
@@ -361,6 +432,7 @@ class HARegistry:
             # Include non-system buttons and all routine-heuristic buttons
             if is_routine or not is_system:
                 self.vacuum_routines.setdefault(vacuum_eid, []).append(ent.entity_id)
+                self.routine_to_vacuum[ent.entity_id] = vacuum_eid
 
         for vac_eid, btns in self.vacuum_routines.items():
             logger.info("Vacuum %s: %d routine button(s) found", vac_eid, len(btns))
@@ -447,6 +519,14 @@ class HARegistry:
             )
         await self._db.commit_entity_area_cache()
 
+    async def _populate_entity_names(self) -> None:
+        """Write entity display names to DB so list queries can JOIN them."""
+        await self._db.replace_registry_entities([
+            (eid, self._composed_name(ent), eid.partition(".")[0])
+            for eid, ent in self.entities.items()
+            if not ent.disabled_by
+        ])
+
     # -------------------------------------------------------------------
     # Query helpers
     # -------------------------------------------------------------------
@@ -465,29 +545,21 @@ class HARegistry:
         return None
 
     def get_floors_sorted(self) -> list[FloorInfo]:
-        return sorted(self.floors.values(), key=lambda f: (f.level, f.name))
+        return self._floors_sorted
 
     def get_areas_for_floor(self, floor_id: str) -> list[AreaInfo]:
         floor = self.floors.get(floor_id)
         if not floor:
             return []
-        return sorted(
-            [self.areas[aid] for aid in floor.area_ids if aid in self.areas],
-            key=lambda a: a.name,
-        )
+        # area_ids are kept in name order by _build_cross_refs
+        return [self.areas[aid] for aid in floor.area_ids if aid in self.areas]
 
     def get_unassigned_areas(self) -> list[AreaInfo]:
         """Areas not assigned to any floor."""
-        assigned = set()
-        for f in self.floors.values():
-            assigned.update(f.area_ids)
-        return sorted(
-            [a for a in self.areas.values() if a.area_id not in assigned],
-            key=lambda a: a.name,
-        )
+        return self._unassigned_areas
 
     def get_all_areas_sorted(self) -> list[AreaInfo]:
-        return sorted(self.areas.values(), key=lambda a: a.name)
+        return self._areas_sorted
 
     def get_area_entities(
         self, area_id: str, domains: frozenset[str] | None = None,
@@ -503,7 +575,7 @@ class HARegistry:
             return []
         eids = area.entity_ids
         if domains:
-            eids = [e for e in eids if e.split(".", 1)[0] in domains]
+            eids = [e for e in eids if e.partition(".")[0] in domains]
         if not show_all:
             eids = [
                 e for e in eids
@@ -511,28 +583,47 @@ class HARegistry:
             ]
         return sorted(eids)
 
+    def count_area_entities(
+        self, area_id: str, domains: frozenset[str] | None = None,
+        show_all: bool = False,
+    ) -> int:
+        """Number of entities get_area_entities() would return, without building the list."""
+        counts = (self._area_domain_counts if show_all else self._area_primary_counts).get(area_id)
+        if not counts:
+            return 0
+        if not domains:
+            return sum(counts.values())
+        return sum(counts[d] for d in domains if d in counts)
+
     def get_unassigned_entities(
         self, domains: frozenset[str] | None = None, show_all: bool = False,
     ) -> list[str]:
         """Entities not in any area."""
-        assigned: set[str] = set()
-        for area in self.areas.values():
-            assigned.update(area.entity_ids)
         result = []
-        for ent in self.entities.values():
-            if ent.entity_id not in assigned and not ent.disabled_by:
-                if domains and ent.entity_id.split(".", 1)[0] not in domains:
-                    continue
-                if not show_all and ent.entity_category in ("diagnostic", "config"):
-                    continue
-                result.append(ent.entity_id)
-        return sorted(result)
+        for eid in self._unassigned_eids:
+            if domains and eid.partition(".")[0] not in domains:
+                continue
+            if not show_all and self.entities[eid].entity_category in ("diagnostic", "config"):
+                continue
+            result.append(eid)
+        return result
+
+    def _composed_name(self, ent: EntityInfo) -> str | None:
+        """Name as HA shows it: entities with has_entity_name are prefixed
+        with their device name ("Thermostat Temperature", not "Temperature").
+        """
+        if ent.name:
+            return ent.name
+        dev = self.devices.get(ent.device_id) if ent.has_entity_name and ent.device_id else None
+        if dev is None:
+            return ent.original_name
+        return f"{dev.name} {ent.original_name}" if ent.original_name else dev.name
 
     def get_entity_display_name(self, entity_id: str) -> str:
         """Best available display name for an entity."""
         ent = self.entities.get(entity_id)
         if ent:
-            return ent.name or ent.original_name or entity_id
+            return self._composed_name(ent) or entity_id
         return entity_id
 
     def match_segment_to_area(self, segment_name: str) -> str | None:
@@ -578,7 +669,7 @@ class HARegistry:
 
     def _pick_primary_domain(self, entity_ids: list[str]) -> str:
         """Pick the most relevant domain from a list of entity IDs for icon display."""
-        domains = {eid.split(".", 1)[0] for eid in entity_ids}
+        domains = {eid.partition(".")[0] for eid in entity_ids}
         for d in self._DOMAIN_PRIORITY:
             if d in domains:
                 return d
@@ -596,10 +687,10 @@ class HARegistry:
         rank_limit = len(self._DOMAIN_PRIORITY)
 
         def _key(eid: str) -> tuple[int, int, str]:
-            domain = eid.split(".", 1)[0]
+            domain = eid.partition(".")[0]
             domain_rank = self._DOMAIN_RANK.get(domain, rank_limit)
             # Penalise junk entities (connectivity, signal, etc.)
-            suffix = eid.split(".", 1)[1] if "." in eid else ""
+            suffix = eid.partition(".")[2]
             penalty = 0
             if any(suffix.endswith(j) for j in self._JUNK_SUFFIXES):
                 penalty = 1
@@ -632,7 +723,7 @@ class HARegistry:
 
         raw_eids = area.entity_ids
         if domains:
-            raw_eids = [e for e in raw_eids if e.split(".", 1)[0] in domains]
+            raw_eids = [e for e in raw_eids if e.partition(".")[0] in domains]
         if not show_all:
             raw_eids = [
                 e for e in raw_eids
@@ -708,26 +799,18 @@ class HARegistry:
         self, device_id: str, domains: frozenset[str] | None = None,
     ) -> list[str]:
         """Get entity IDs belonging to a device, filtered by domains."""
-        eids: list[str] = []
-        for ent in self.entities.values():
-            if ent.disabled_by:
-                continue
-            if ent.device_id == device_id:
-                if domains and ent.entity_id.split(".", 1)[0] not in domains:
-                    continue
-                eids.append(ent.entity_id)
-        return sorted(eids)
+        eids = self._device_entities.get(device_id, [])
+        if domains:
+            return [e for e in eids if e.partition(".")[0] in domains]
+        return list(eids)
 
     def is_vacuum_device(self, device_id: str) -> bool:
         """Check if device has a vacuum entity."""
-        for ent in self.entities.values():
-            if ent.device_id == device_id and ent.entity_id.startswith("vacuum.") and not ent.disabled_by:
-                return True
-        return False
+        return self.get_vacuum_entity_for_device(device_id) is not None
 
     def get_vacuum_entity_for_device(self, device_id: str) -> str | None:
         """Get the vacuum entity_id for a device, if any."""
-        for ent in self.entities.values():
-            if ent.device_id == device_id and ent.entity_id.startswith("vacuum.") and not ent.disabled_by:
-                return ent.entity_id
+        for eid in self._device_entities.get(device_id, ()):
+            if eid.startswith("vacuum."):
+                return eid
         return None
@@ -98,7 +98,7 @@ _JUNK_SUFFIXES: tuple[str, ...] = (
 def is_junk_primary(entity_id: str) -> bool:
     """Return True if entity is a connectivity/diagnostic sensor
     that should not be a device's primary representative."""
-    suffix = entity_id.split(".", 1)[1] if "." in entity_id else ""
+    suffix = entity_id.partition(".")[2]
     return any(suffix.endswith(j) for j in _JUNK_SUFFIXES)
 
 
@@ -124,7 +124,7 @@ def map_state(
     Returns:
         MappedState with normalized fields.
     """
-    domain = entity_id.split(".", 1)[0]
+    domain = entity_id.partition(".")[0]
     attrs = attrs or {}
 
     # --- unavailable / unknown first ---
@@ -7,6 +7,7 @@ Tables:
 - favorites: per-user entity bookmarks
 - rooms: canonical room names with HA area mapping and aliases
 - entity_area_cache: cached entity->area->floor mapping from registry
+- registry_entities: entity display names from registry, for list JOINs
 - vacuum_room_map: vacuum segment_id <-> area mapping
 - notifications: per-user entity notification preferences
 - user_roles: role-based access control (admin/user/guest)
@@ -19,6 +20,7 @@ Tables:
 
 from __future__ import annotations
 
+import asyncio
 import json
 import logging
 import time
@@ -30,6 +32,24 @@ import aiosqlite
 
 logger = logging.getLogger("ha_bot.storage")
 
+# Audit rows are buffered and written in one executemany per flush
+AUDIT_FLUSH_DELAY: float = 0.1
+AUDIT_FLUSH_MAX_ROWS: int = 100
+
+_FAV_ACTION_COLUMNS = "id, action_type, payload_json, label, created_at"
+
+
+def _fav_action_row(r: Any) -> dict[str, Any]:
+    """Decode a favorites_actions row selected with _FAV_ACTION_COLUMNS."""
+    try:
+        payload = json.loads(r[2])
+    except (json.JSONDecodeError, TypeError):
+        payload = {}
+    return {
+        "id": r[0], "action_type": r[1], "payload": payload,
+        "label": r[3], "created_at": r[4],
+    }
+
 
 class Database:
     """Manages a persistent SQLite connection with WAL journal mode."""
@@ -37,6 +57,8 @@ class Database:
     def __init__(self, path: Path) -> None:
         self._path = path
         self._db: aiosqlite.Connection | None = None
+        self._audit_buf: list[tuple[Any, ...]] = []
+        self._audit_task: asyncio.Task[None] | None = None
 
     async def open(self) -> None:
         self._db = await aiosqlite.connect(str(self._path))
@@ -105,6 +127,13 @@ class Database:
                    updated_at REAL NOT NULL
                )"""
         )
+        await self._db.execute(
+            """CREATE TABLE IF NOT EXISTS registry_entities (
+                   entity_id     TEXT PRIMARY KEY,
+                   friendly_name TEXT,
+                   domain        TEXT NOT NULL
+               )"""
+        )
         await self._db.execute(
             """CREATE TABLE IF NOT EXISTS vacuum_room_map (
                    vacuum_entity_id TEXT NOT NULL,
@@ -193,7 +222,15 @@ class Database:
         )
 
     async def close(self) -> None:
+        if self._audit_task is not None:
+            # At most AUDIT_FLUSH_DELAY away; cancelling could drop a batch
+            await self._audit_task
+            self._audit_task = None
         if self._db is not None:
+            try:
+                await self.flush_audit()
+            except Exception:
+                logger.exception("Failed to flush audit records on close")
             await self._db.close()
             self._db = None
 
@@ -234,12 +271,40 @@ class Database:
         success: bool,
         error: str | None = None,
     ) -> None:
+        """Queue an audit row; it is persisted by the next flush_audit().
+
+        Rows are flushed AUDIT_FLUSH_DELAY seconds after the first queued
+        one, or immediately once AUDIT_FLUSH_MAX_ROWS are pending, so the
+        caller never waits on an INSERT + commit.
+        """
         assert self._db is not None
         ts = datetime.now(timezone.utc).isoformat()
-        await self._db.execute(
+        self._audit_buf.append(
+            (ts, chat_id, user_id, username, action, entity_id, 1 if success else 0, error),
+        )
+        if len(self._audit_buf) >= AUDIT_FLUSH_MAX_ROWS:
+            await self.flush_audit()
+        elif self._audit_task is None or self._audit_task.done():
+            self._audit_task = asyncio.create_task(
+                self._flush_audit_later(), name="audit_flush",
+            )
+
+    async def _flush_audit_later(self) -> None:
+        await asyncio.sleep(AUDIT_FLUSH_DELAY)
+        try:
+            await self.flush_audit()
+        except Exception:
+            logger.exception("Failed to persist audit records")
+
+    async def flush_audit(self) -> None:
+        """Write all queued audit rows in a single transaction."""
+        if not self._audit_buf or self._db is None:
+            return
+        rows, self._audit_buf = self._audit_buf, []
+        await self._db.executemany(
             "INSERT INTO audit (timestamp, chat_id, user_id, username, action, entity_id, success, error) "
             "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-            (ts, chat_id, user_id, username, action, entity_id, 1 if success else 0, error),
+            rows,
         )
         await self._db.commit()
 
@@ -311,6 +376,26 @@ class Database:
             rows = await cur.fetchall()
         return [r[0] for r in rows]
 
+    async def count_favorites(self, user_id: int) -> int:
+        assert self._db is not None
+        async with self._db.execute(
+            "SELECT COUNT(*) FROM favorites WHERE user_id = ?",
+            (user_id,),
+        ) as cur:
+            row = await cur.fetchone()
+        return row[0] if row else 0
+
+    async def get_favorites_page(self, user_id: int, offset: int, limit: int) -> list[str]:
+        """One page of favorites in get_favorites() order, read via the PK index."""
+        assert self._db is not None
+        async with self._db.execute(
+            "SELECT entity_id FROM favorites WHERE user_id = ? "
+            "ORDER BY entity_id LIMIT ? OFFSET ?",
+            (user_id, limit, offset),
+        ) as cur:
+            rows = await cur.fetchall()
+        return [r[0] for r in rows]
+
     async def is_favorite(self, user_id: int, entity_id: str) -> bool:
         assert self._db is not None
         async with self._db.execute(
@@ -375,6 +460,18 @@ class Database:
         assert self._db is not None
         await self._db.commit()
 
+    # --- registry_entities ---
+
+    async def replace_registry_entities(self, rows: list[tuple[str, str | None, str]]) -> None:
+        """Replace the entity name table with (entity_id, friendly_name, domain) rows."""
+        assert self._db is not None
+        await self._db.execute("DELETE FROM registry_entities")
+        await self._db.executemany(
+            "INSERT INTO registry_entities (entity_id, friendly_name, domain) VALUES (?, ?, ?)",
+            rows,
+        )
+        await self._db.commit()
+
     async def get_entity_area(self, entity_id: str) -> dict[str, Any] | None:
         assert self._db is not None
         async with self._db.execute(
@@ -512,6 +609,38 @@ class Database:
             for r in rows
         ]
 
+    async def count_user_notifications(self, user_id: int) -> int:
+        assert self._db is not None
+        async with self._db.execute(
+            "SELECT COUNT(*) FROM notifications WHERE user_id = ?",
+            (user_id,),
+        ) as cur:
+            row = await cur.fetchone()
+        return row[0] if row else 0
+
+    async def get_user_notifications_page(
+        self, user_id: int, offset: int, limit: int,
+    ) -> list[dict[str, Any]]:
+        """One page of subscriptions in get_user_notifications() order.
+
+        Each row carries the registry ``friendly_name`` (None if unknown).
+        """
+        assert self._db is not None
+        async with self._db.execute(
+            "SELECT n.entity_id, n.enabled, n.mode, n.throttle_seconds, e.friendly_name "
+            "FROM notifications n LEFT JOIN registry_entities e USING (entity_id) "
+            "WHERE n.user_id = ? ORDER BY n.entity_id LIMIT ? OFFSET ?",
+            (user_id, limit, offset),
+        ) as cur:
+            rows = await cur.fetchall()
+        return [
+            {
+                "entity_id": r[0], "enabled": bool(r[1]), "mode": r[2],
+                "throttle_seconds": r[3], "friendly_name": r[4],
+            }
+            for r in rows
+        ]
+
     # --- rooms ---
 
     async def upsert_room(self, canonical_name: str, ha_area_id: str | None, aliases: list[str]) -> None:
@@ -600,22 +729,23 @@ class Database:
     async def get_favorite_actions(self, user_id: int) -> list[dict[str, Any]]:
         assert self._db is not None
         async with self._db.execute(
-            "SELECT id, action_type, payload_json, label, created_at "
+            f"SELECT {_FAV_ACTION_COLUMNS} "
             "FROM favorites_actions WHERE user_id = ? ORDER BY created_at DESC",
             (user_id,),
         ) as cur:
             rows = await cur.fetchall()
-        result = []
-        for r in rows:
-            try:
-                payload = json.loads(r[2])
-            except (json.JSONDecodeError, TypeError):
-                payload = {}
-            result.append({
-                "id": r[0], "action_type": r[1], "payload": payload,
-                "label": r[3], "created_at": r[4],
-            })
-        return result
+        return [_fav_action_row(r) for r in rows]
+
+    async def get_favorite_action(self, user_id: int, action_id: int) -> dict[str, Any] | None:
+        """Return one of *user_id*'s favorite actions by id, or None."""
+        assert self._db is not None
+        async with self._db.execute(
+            f"SELECT {_FAV_ACTION_COLUMNS} "
+            "FROM favorites_actions WHERE id = ? AND user_id = ?",
+            (action_id, user_id),
+        ) as cur:
+            row = await cur.fetchone()
+        return _fav_action_row(row) if row else None
 
     async def remove_favorite_action(self, user_id: int, action_id: int) -> bool:
         assert self._db is not None
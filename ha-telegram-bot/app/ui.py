@@ -15,6 +15,9 @@ Menu tree:
 from __future__ import annotations
 
 import math
+import sys
+from collections.abc import Sequence
+from functools import lru_cache
 from typing import Any
 
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
@@ -66,6 +69,9 @@ DOMAIN_LABELS: dict[str, str] = {
     "water_heater": "Водонагреватели",
 }
 
+# supported_color_modes values that accept an rgb_color
+RGB_COLOR_MODES: frozenset[str] = frozenset({"rgb", "rgbw", "rgbww", "hs", "xy"})
+
 # Color presets: (label, rgb_color)
 COLOR_PRESETS: list[tuple[str, tuple[int, int, int]]] = [
     ("\U0001f534 Красный", (255, 0, 0)),
@@ -114,6 +120,12 @@ def _trunc(text: str, max_len: int = 28) -> str:
     return text[:max_len] if len(text) > max_len else text
 
 
+@lru_cache(maxsize=2048)
+def _cb(prefix: str, arg: str) -> str:
+    """Interned "prefix:arg" callback data, shared across renders."""
+    return sys.intern(f"{prefix}:{arg}")
+
+
 def _home_btn() -> InlineKeyboardButton:
     """Home button to return to main menu."""
     return InlineKeyboardButton(text="\U0001f3e0 Меню", callback_data="nav:main")
@@ -209,13 +221,13 @@ def _build_active_entity_list(
         eid = ent["entity_id"]
         name = ent.get("friendly_name", eid)
         state = ent.get("state", "")
-        domain = eid.split(".", 1)[0]
+        domain = eid.partition(".")[0]
         si = _state_icon(domain, state)
         icon = DOMAIN_ICONS.get(domain, "")
         # Use ent: callback to open entity detail (not close)
         rows.append([InlineKeyboardButton(
             text=f"{si}{icon} {_trunc(name)}",
-            callback_data=f"ent:{eid}",
+            callback_data=_cb("ent", eid),
         )])
 
     # Pagination
@@ -305,14 +317,23 @@ def build_entity_list(
     back_cb: str,
     page_cb_prefix: str = "pg",
     show_fav_btn: bool = False,
+    total: int | None = None,
 ) -> tuple[str, InlineKeyboardMarkup]:
-    """entities: [{"entity_id", "friendly_name", "state", "domain"}, ...]"""
-    total = len(entities)
-    total_pages = max(1, math.ceil(total / page_size))
-    page = max(0, min(page, total_pages - 1))
-    start = page * page_size
-    end = min(start + page_size, total)
-    page_ents = entities[start:end]
+    """entities: [{"entity_id", "friendly_name", "state", "domain"}, ...]
+
+    When *total* is given, *entities* is already the requested page
+    (fetched with LIMIT/OFFSET) and is rendered as-is.
+    """
+    if total is None:
+        total = len(entities)
+        total_pages = max(1, math.ceil(total / page_size))
+        page = max(0, min(page, total_pages - 1))
+        start = page * page_size
+        page_ents = entities[start:start + page_size]
+    else:
+        total_pages = max(1, math.ceil(total / page_size))
+        page = max(0, min(page, total_pages - 1))
+        page_ents = entities
 
     text = f"{title} (стр. {page + 1}/{total_pages})"
     rows: list[list[InlineKeyboardButton]] = []
@@ -321,12 +342,12 @@ def build_entity_list(
         eid = ent["entity_id"]
         name = ent.get("friendly_name", eid)
         state = ent.get("state", "")
-        domain = eid.split(".", 1)[0]
+        domain = eid.partition(".")[0]
         si = _state_icon(domain, state)
         icon = DOMAIN_ICONS.get(domain, "")
         rows.append([InlineKeyboardButton(
             text=f"{si}{icon} {_trunc(name)}",
-            callback_data=f"ent:{eid}",
+            callback_data=_cb("ent", eid),
         )])
 
     # Pagination
@@ -349,6 +370,22 @@ def build_entity_list(
 # ---------------------------------------------------------------------------
 
 
+_PIN_LABEL_ON = "\U0001f4cc Убрать"
+_PIN_LABEL_OFF = "\U0001f4cc Закрепить"
+
+
+@lru_cache(maxsize=1024)
+def build_pin_button(area_id: str, is_pinned: bool) -> InlineKeyboardButton:
+    """Pin/unpin toggle for an area screen.
+
+    Cached per (area, state) and shared — callers must not modify it.
+    """
+    return InlineKeyboardButton(
+        text=_PIN_LABEL_ON if is_pinned else _PIN_LABEL_OFF,
+        callback_data=f"pin:area:{area_id}",
+    )
+
+
 def build_device_list(
     devices: list[dict[str, Any]],
     page: int,
@@ -377,7 +414,7 @@ def build_device_list(
         for sc in scenes[:4]:
             sc_eid = sc["entity_id"]
             sc_name = sc.get("friendly_name", sc_eid)
-            sc_domain = sc_eid.split(".", 1)[0]
+            sc_domain = sc_eid.partition(".")[0]
             sc_icon = DOMAIN_ICONS.get(sc_domain, "\U0001f3ac")
             cb = f"qsc:{sc_eid}"
             if len(cb) <= 64:
@@ -395,7 +432,7 @@ def build_device_list(
         suffix = f" ({count})" if count > 1 else ""
         cb = f"dev:{did}"
         if len(cb) > 64:
-            cb = f"ent:{dev['primary_entity_id']}"
+            cb = _cb("ent", dev["primary_entity_id"])
         rows.append([InlineKeyboardButton(
             text=f"{icon} {_trunc(name, 25)}{suffix}",
             callback_data=cb,
@@ -430,8 +467,11 @@ def build_entity_control(
     is_fav: bool = False,
     is_notif: bool = False,
     back_cb: str = "nav:main",
+    *,
+    extras: list[list[InlineKeyboardButton]] | None = None,
 ) -> tuple[str, InlineKeyboardMarkup]:
-    domain = entity_id.split(".", 1)[0]
+    """Entity card; *extras* rows go between the favorite/notify row and Back."""
+    domain = entity_id.partition(".")[0]
     attrs = state_data.get("attributes", {})
     name = attrs.get("friendly_name", entity_id)
     raw_state = state_data.get("state", "unknown")
@@ -533,6 +573,8 @@ def build_entity_control(
     notif_label = "\U0001f515 Отписаться" if is_notif else "\U0001f514 Подписаться"
     util_row.append(InlineKeyboardButton(text=notif_label, callback_data=f"ntog:{entity_id}"))
     rows.append(util_row)
+    if extras:
+        rows.extend(extras)
 
     rows.append([InlineKeyboardButton(text="\u2b05 Назад", callback_data=back_cb)])
     if back_cb != "nav:main":
@@ -552,7 +594,7 @@ def _control_buttons(
             InlineKeyboardButton(text="\U0001f504 Toggle", callback_data=f"act:{entity_id}:toggle"),
         ])
         if domain == "light":
-            supported = attrs.get("supported_color_modes", [])
+            supported = attrs.get("supported_color_modes") or []
             has_br = any(m != "onoff" for m in supported) if supported else False
             if has_br or attrs.get("brightness") is not None:
                 rows.append([
@@ -560,10 +602,7 @@ def _control_buttons(
                     InlineKeyboardButton(text="\U0001f506 +", callback_data=f"bright:{entity_id}:up"),
                 ])
             # Color button for color-capable lights
-            has_color = any(
-                m in ("rgb", "rgbw", "rgbww", "hs", "xy") for m in supported
-            ) if supported else False
-            if has_color:
+            if not RGB_COLOR_MODES.isdisjoint(supported):
                 rows.append([InlineKeyboardButton(
                     text="\U0001f3a8 Цвет",
                     callback_data=f"lclr:{entity_id}",
@@ -765,7 +804,7 @@ def build_scenarios_menu(
 
 
 def build_radio_menu(
-    stations: list[dict[str, Any]],
+    stations: Sequence[dict[str, Any]],
     current_idx: int = 0,
     current_player: str | None = None,
     players: list[dict[str, Any]] | None = None,
@@ -872,7 +911,7 @@ def build_vacuum_rooms(
         InlineKeyboardButton(text="\u23f9 Стоп", callback_data=f"vcmd:{entity_id}:stop"),
         InlineKeyboardButton(text="\U0001f3e0 Док", callback_data=f"vcmd:{entity_id}:return_to_base"),
     ])
-    rows.append([InlineKeyboardButton(text="\u2b05 Назад", callback_data=f"ent:{entity_id}")])
+    rows.append([InlineKeyboardButton(text="\u2b05 Назад", callback_data=_cb("ent", entity_id))])
     rows.append([_home_btn()])
     return text, InlineKeyboardMarkup(inline_keyboard=rows)
 
@@ -897,7 +936,7 @@ def build_vacuum_routines(
             callback_data=f"rtn:{rt['entity_id']}",
         )])
 
-    rows.append([InlineKeyboardButton(text="\u2b05 Назад", callback_data=f"ent:{entity_id}")])
+    rows.append([InlineKeyboardButton(text="\u2b05 Назад", callback_data=_cb("ent", entity_id))])
     rows.append([_home_btn()])
     return text, InlineKeyboardMarkup(inline_keyboard=rows)
 
@@ -926,7 +965,7 @@ def build_media_source_menu(
                 callback_data=cb,
             )])
 
-    rows.append([InlineKeyboardButton(text="\u2b05 Назад", callback_data=f"ent:{entity_id}")])
+    rows.append([InlineKeyboardButton(text="\u2b05 Назад", callback_data=_cb("ent", entity_id))])
     rows.append([_home_btn()])
     return text, InlineKeyboardMarkup(inline_keyboard=rows)
 
@@ -942,6 +981,7 @@ def build_favorites_menu(
     page_size: int,
     fav_actions: list[dict[str, Any]] | None = None,
     pinned_items: list[dict[str, Any]] | None = None,
+    total: int | None = None,
 ) -> tuple[str, InlineKeyboardMarkup]:
     if not entities and not fav_actions and not pinned_items:
         text = "\u2b50 <b>Избранное</b>\n\nСписок пуст."
@@ -981,6 +1021,7 @@ def build_favorites_menu(
         title="\u2b50 <b>Избранное</b>",
         back_cb="nav:main",
         page_cb_prefix="favp",
+        total=total,
     )
     rows = k.inline_keyboard[:]
 
@@ -1057,8 +1098,12 @@ def build_notif_list(
     subs: list[dict[str, Any]],
     page: int,
     page_size: int,
+    total: int | None = None,
 ) -> tuple[str, InlineKeyboardMarkup]:
-    """subs: [{"entity_id", "friendly_name", "enabled", "mode"}, ...]"""
+    """subs: [{"entity_id", "friendly_name", "enabled", "mode"}, ...]
+
+    When *total* is given, *subs* is already the requested page.
+    """
     text = "\U0001f514 <b>Уведомления</b>\n\n"
     if not subs:
         text += "Нет подписок. Добавьте через карточку устройства."
@@ -1067,12 +1112,16 @@ def build_notif_list(
         ])
         return text, kb
 
-    total = len(subs)
-    total_pages = max(1, math.ceil(total / page_size))
-    page = max(0, min(page, total_pages - 1))
-    start = page * page_size
-    end = min(start + page_size, total)
-    page_subs = subs[start:end]
+    if total is None:
+        total = len(subs)
+        total_pages = max(1, math.ceil(total / page_size))
+        page = max(0, min(page, total_pages - 1))
+        start = page * page_size
+        page_subs = subs[start:start + page_size]
+    else:
+        total_pages = max(1, math.ceil(total / page_size))
+        page = max(0, min(page, total_pages - 1))
+        page_subs = subs
 
     text += f"Стр. {page + 1}/{total_pages}\n\n"
     rows: list[list[InlineKeyboardButton]] = []
@@ -1114,7 +1163,7 @@ def build_status_menu(entities: list[dict[str, Any]]) -> tuple[str, InlineKeyboa
             eid = ent.get("entity_id", "unknown")
             name = ent.get("attributes", {}).get("friendly_name", eid)
             state = ent.get("state", "unknown")
-            domain = eid.split(".", 1)[0]
+            domain = eid.partition(".")[0]
             icon = DOMAIN_ICONS.get(domain, "\u2022")
             unit = ent.get("attributes", {}).get("unit_of_measurement", "")
             unit_str = f" {_sanitize(str(unit))}" if unit else ""
@@ -1150,8 +1199,13 @@ def build_search_results(
     entities: list[dict[str, Any]],
     page: int = 0,
     page_size: int = 8,
+    truncated: bool = False,
 ) -> tuple[str, InlineKeyboardMarkup]:
-    """Build search results page."""
+    """Build search results page.
+
+    *truncated* marks a result list cut at the search cap; the count
+    is shown as "N+".
+    """
     if not entities:
         text = f"\U0001f50d <b>Поиск:</b> {_sanitize(query)}\n\nНичего не найдено."
         kb = InlineKeyboardMarkup(inline_keyboard=[
@@ -1161,7 +1215,7 @@ def build_search_results(
 
     return build_entity_list(
         entities, page, page_size,
-        title=f"\U0001f50d <b>Поиск:</b> {_sanitize(query)} ({len(entities)})",
+        title=f"\U0001f50d <b>Поиск:</b> {_sanitize(query)} ({len(entities)}{'+' if truncated else ''})",
         back_cb="nav:main",
         page_cb_prefix="srp",
     )
@@ -1302,16 +1356,26 @@ def build_roles_list(
 # ---------------------------------------------------------------------------
 
 
-def build_confirmation(
-    message: str,
-    back_cb: str = "nav:main",
-) -> tuple[str, InlineKeyboardMarkup]:
+@lru_cache(maxsize=256)
+def build_confirmation_kb(back_cb: str = "nav:main") -> InlineKeyboardMarkup:
+    """Back(/Home) keyboard for result screens.
+
+    Depends only on *back_cb*, so instances are cached and shared —
+    callers must not modify the returned markup.
+    """
     rows: list[list[InlineKeyboardButton]] = [
         [InlineKeyboardButton(text="\u2b05 Назад", callback_data=back_cb)],
     ]
     if back_cb != "nav:main":
         rows.append([_home_btn()])
-    return message, InlineKeyboardMarkup(inline_keyboard=rows)
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
+def build_confirmation(
+    message: str,
+    back_cb: str = "nav:main",
+) -> tuple[str, InlineKeyboardMarkup]:
+    return message, build_confirmation_kb(back_cb)
 
 
 # ---------------------------------------------------------------------------
@@ -1371,7 +1435,7 @@ def sort_entities_for_device(
     read_only_domains = frozenset({"sensor", "binary_sensor"})
 
     def sort_key(ent: dict[str, Any]) -> tuple[int, str]:
-        domain = ent.get("domain", ent["entity_id"].split(".", 1)[0])
+        domain = ent.get("domain", ent["entity_id"].partition(".")[0])
         if domain in action_domains:
             return (0, ent.get("friendly_name", ent["entity_id"]))
         elif domain in scenario_domains:
@@ -1395,7 +1459,7 @@ def group_sensor_entities(
     non_sensors: list[dict[str, Any]] = []
 
     for ent in entities:
-        domain = ent.get("domain", ent["entity_id"].split(".", 1)[0])
+        domain = ent.get("domain", ent["entity_id"].partition(".")[0])
         if domain in ("sensor", "binary_sensor"):
             sensors.append(ent)
         else:
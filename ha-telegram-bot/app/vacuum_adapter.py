@@ -19,6 +19,9 @@ from storage import Database
 
 logger = logging.getLogger("ha_bot.vacuum")
 
+# Plain vacuum.* services accepted by execute_command()
+VACUUM_COMMANDS: frozenset[str] = frozenset({"start", "stop", "pause", "return_to_base", "locate"})
+
 
 @dataclass(frozen=True, slots=True)
 class VacuumCapabilities:
@@ -42,13 +45,31 @@ class VacuumAdapter:
         self._strategy = strategy
         self._script_eid = script_entity_id
         self._presets = presets
+        # Room list offered when a vacuum has no imported segments
+        self._preset_rooms: list[dict[str, Any]] = [
+            {"segment_id": r, "segment_name": r.replace("_", " ").title()}
+            for r in presets
+        ]
+        # vacuum_eid -> (registry segments version, segment map); the map is
+        # only rewritten during a registry sync
+        self._room_maps: dict[str, tuple[int, list[dict[str, Any]]]] = {}
+
+    async def _room_map(self, vacuum_eid: str) -> list[dict[str, Any]]:
+        """Imported segments for *vacuum_eid*, read from the DB once per sync."""
+        version = self._reg.segments_version
+        cached = self._room_maps.get(vacuum_eid)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        segments = await self._db.get_vacuum_room_map(vacuum_eid)
+        self._room_maps[vacuum_eid] = (version, segments)
+        return segments
 
     async def get_capabilities(self, vacuum_eid: str) -> VacuumCapabilities:
         """Detect capabilities for a specific vacuum entity."""
         try:
             platform = self._reg.vacuum_platforms.get(vacuum_eid, "")
             routines = self._reg.vacuum_routines.get(vacuum_eid, [])
-            segments = await self._db.get_vacuum_room_map(vacuum_eid)
+            segments = await self._room_map(vacuum_eid)
 
             seg_count = len(segments) if segments else len(self._presets)
             return VacuumCapabilities(
@@ -63,16 +84,14 @@ class VacuumAdapter:
             return VacuumCapabilities()
 
     async def get_rooms(self, vacuum_eid: str) -> list[dict[str, Any]]:
-        """Get available rooms/segments for vacuum."""
+        """Get available rooms/segments for vacuum.
+
+        The returned list is shared between calls — do not modify it.
+        """
         try:
-            segments = await self._db.get_vacuum_room_map(vacuum_eid)
-            if segments:
-                return segments
+            segments = await self._room_map(vacuum_eid)
             # Fall back to config presets
-            return [
-                {"segment_id": r, "segment_name": r.replace("_", " ").title()}
-                for r in self._presets
-            ]
+            return segments or self._preset_rooms
         except Exception:
             logger.exception("Failed to get vacuum rooms for %s", vacuum_eid)
             return []
@@ -123,7 +142,7 @@ class VacuumAdapter:
     ) -> tuple[bool, str]:
         """Execute a vacuum command (start, stop, pause, return_to_base, locate)."""
         try:
-            if command not in ("start", "stop", "pause", "return_to_base", "locate"):
+            if command not in VACUUM_COMMANDS:
                 return False, f"Unknown vacuum command: {command}"
             return await self._ha.call_service("vacuum", command, {"entity_id": vacuum_eid})
         except Exception as exc:
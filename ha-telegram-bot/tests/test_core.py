@@ -12,7 +12,7 @@ import math
 import sys
 import time
 from pathlib import Path
-from unittest.mock import AsyncMock, MagicMock
+from unittest.mock import AsyncMock, MagicMock, patch
 
 import pytest
 import pytest_asyncio
@@ -100,15 +100,34 @@ class TestGlobalRateLimiter:
             rl.record()
         assert rl.check() is False
 
+    def test_try_acquire_takes_slot(self) -> None:
+        rl = GlobalRateLimiter(2, 60)
+        assert rl.try_acquire() is True
+        assert rl.try_acquire() is True
+        assert rl.try_acquire() is False
+        assert rl.check() is False
+
     def test_window_expiry(self) -> None:
         rl = GlobalRateLimiter(1, 1)
         rl.record()
         assert rl.check() is False
         # Manually advance timestamps
-        rl._timestamps = [time.monotonic() - 2]
+        rl._timestamps[0] = time.monotonic() - 2
         assert rl.check() is True
 
 
+class TestLRUDict:
+    def test_evicts_least_recently_written(self) -> None:
+        from handlers import _LRUDict
+        d = _LRUDict(cap=2)
+        d[1] = "a"
+        d[2] = "b"
+        d.setdefault(1, "x")  # touch 1
+        d[3] = "c"
+        assert list(d) == [1, 3]
+        assert d[1] == "a"
+
+
 # ---------------------------------------------------------------------------
 # Cron parsing
 # ---------------------------------------------------------------------------
@@ -196,6 +215,14 @@ class TestUIBuilders:
         assert "/search" in text
         assert "/schedule" in text
 
+    def test_pin_button_cached_per_state(self) -> None:
+        from ui import build_pin_button
+        btn = build_pin_button("kitchen", True)
+        assert build_pin_button("kitchen", True) is btn
+        assert btn.callback_data == "pin:area:kitchen"
+        assert "Убрать" in btn.text
+        assert "Закрепить" in build_pin_button("kitchen", False).text
+
     def test_search_prompt(self) -> None:
         from ui import build_search_prompt
         text, kb = build_search_prompt()
@@ -244,6 +271,13 @@ class TestUIBuilders:
         assert text == "Test message"
         assert kb.inline_keyboard[0][0].callback_data == "nav:main"
 
+    def test_confirmation_keyboard_shared(self) -> None:
+        from ui import build_confirmation
+        _, kb1 = build_confirmation("Done", "ent:light.a")
+        _, kb2 = build_confirmation("Failed", "ent:light.a")
+        assert kb1 is kb2
+        assert len(kb1.inline_keyboard) == 2  # back + home
+
     def test_diagnostics_menu(self) -> None:
         from ui import build_diagnostics_menu
         text, kb = build_diagnostics_menu("Diag info here")
@@ -255,6 +289,14 @@ class TestUIBuilders:
         text, kb = build_favorites_menu([], 0, 8)
         assert "пуст" in text.lower()
 
+    def test_entity_list_prepaged(self) -> None:
+        from ui import build_entity_list
+        page = [{"entity_id": "light.c", "friendly_name": "C", "state": "on"}]
+        text, kb = build_entity_list(page, 1, 2, "Title", "nav:main", total=3)
+        assert "2/2" in text
+        assert kb.inline_keyboard[0][0].callback_data == "ent:light.c"
+        assert kb.inline_keyboard[1][0].callback_data == "pg:0"
+
     def test_snapshots_empty(self) -> None:
         from ui import build_snapshots_list
         text, kb = build_snapshots_list([])
@@ -296,6 +338,47 @@ async def test_favorites_crud(db) -> None:
     assert await db.is_favorite(user_id, eid) is False
 
 
+@pytest.mark.asyncio
+async def test_audit_rows_batched(db) -> None:
+    async def count() -> int:
+        async with db._db.execute("SELECT COUNT(*) FROM audit") as cur:
+            return (await cur.fetchone())[0]
+
+    for i in range(3):
+        await db.write_audit(chat_id=1, user_id=2, username="u",
+                             action=f"light.turn_on:{i}", success=True)
+    assert await count() == 0
+    await db.flush_audit()
+    assert await count() == 3
+
+    await db.write_audit(chat_id=1, user_id=2, username="u", action="x", success=False)
+    await asyncio.sleep(0.2)  # background flush
+    assert await count() == 4
+
+
+@pytest.mark.asyncio
+async def test_favorites_and_notifications_paging(db) -> None:
+    uid = 7
+    eids = [f"light.l{i}" for i in range(5)]
+    for eid in reversed(eids):
+        await db.toggle_favorite(uid, eid)
+        await db.toggle_notification(uid, eid)
+    await db.toggle_favorite(8, "light.other")
+
+    assert await db.count_favorites(uid) == 5
+    assert await db.get_favorites_page(uid, 0, 2) == eids[:2]
+    assert await db.get_favorites_page(uid, 4, 2) == eids[4:]
+
+    assert await db.count_user_notifications(uid) == 5
+    page = await db.get_user_notifications_page(uid, 2, 2)
+    assert [n["entity_id"] for n in page] == eids[2:4]
+    assert page[0]["friendly_name"] is None
+
+    await db.replace_registry_entities([("light.l2", "Lamp 2", "light")])
+    page = await db.get_user_notifications_page(uid, 2, 2)
+    assert [n["friendly_name"] for n in page] == ["Lamp 2", None]
+
+
 @pytest.mark.asyncio
 async def test_user_roles(db) -> None:
     # Default role
@@ -422,6 +505,10 @@ async def test_favorite_actions(db) -> None:
     actions = await db.get_favorite_actions(uid)
     assert len(actions) == 1
     assert actions[0]["label"] == "Turn on light"
+    action = await db.get_favorite_action(uid, action_id)
+    assert action == actions[0]
+    assert action["payload"]["service"] == "turn_on"
+    assert await db.get_favorite_action(uid + 1, action_id) is None
 
     deleted = await db.remove_favorite_action(uid, action_id)
     assert deleted is True
@@ -692,6 +779,26 @@ class TestEntityControlEnhanced:
         assert "Volume Number" in text
         assert "Диапазон" in text
 
+    def test_single_color_button_for_rgb_light(self) -> None:
+        from ui import build_entity_control
+        state = {"state": "on", "attributes": {"supported_color_modes": ["color_temp", "xy"]}}
+        _, kb = build_entity_control("light.a", state)
+        cbs = [b.callback_data for row in kb.inline_keyboard for b in row]
+        assert cbs.count("lclr:light.a") == 1
+        _, kb = build_entity_control("light.b", {"state": "on", "attributes": {"supported_color_modes": None}})
+        assert not any(b.callback_data.startswith("lclr:") for row in kb.inline_keyboard for b in row)
+
+    def test_extras_placed_before_back(self) -> None:
+        from aiogram.types import InlineKeyboardButton
+        from ui import build_entity_control
+        extra = [InlineKeyboardButton(text="Color", callback_data="lclr:light.a")]
+        _, kb = build_entity_control(
+            "light.a", {"state": "on", "attributes": {}}, back_cb="ar:hall", extras=[extra],
+        )
+        cbs = [row[0].callback_data for row in kb.inline_keyboard]
+        assert cbs[-4:-2] == ["fav:light.a", "lclr:light.a"]
+        assert cbs[-2] == "ar:hall"
+
 
 # ---------------------------------------------------------------------------
 # Active Now menu tests
@@ -1048,58 +1155,108 @@ class TestPerActionCooldown:
 
 
 class TestBrightnessDebounce:
-    def test_pending_dict_state(self) -> None:
-        """Pending brightness dict tracks (cid, uid, eid) -> brightness value."""
+    @staticmethod
+    def _make_handler():
         from handlers import Handlers
 
         h = Handlers.__new__(Handlers)
-        h._pending_brightness = {}
-        h._pending_volume = {}
-        h._debounce_tasks = {}
+        h._steppers = {}
+        h._bg_tasks = set()
+        h._check_rl = AsyncMock(return_value=True)
+        h._ha = MagicMock()
+        h._ha.get_state = AsyncMock(return_value={"attributes": {"brightness": 100}})
+        return h
 
+    @pytest.mark.asyncio
+    async def test_taps_step_from_pending_target(self) -> None:
+        """Only the first tap reads HA; later taps step the pending target."""
+        h = self._make_handler()
         key = (100, 200, "light.test")
-        h._pending_brightness[key] = 128
-        assert h._pending_brightness[key] == 128
+        h._debounce = MagicMock()
+        for _ in range(2):
+            await h._brightness(100, 200, "u", "bright:light.test:up", AsyncMock())
+        assert h._steppers[key].target == 202
+        h._ha.get_state.assert_awaited_once()
 
-        # Update brightness
-        h._pending_brightness[key] = 179
-        assert h._pending_brightness[key] == 179
-
-    def test_flush_cleanup(self) -> None:
-        """After flush, pending state and task refs are cleared."""
-        from handlers import Handlers
+    @pytest.mark.asyncio
+    async def test_flush_cleanup(self) -> None:
+        """Flush sends the latest target once and drops the stepper."""
+        from handlers import _Stepper
+
+        h = self._make_handler()
+        h._ha.call_service = AsyncMock(return_value=(False, "x"))
+        h._db = MagicMock()
+        h._db.write_audit = AsyncMock()
+        key = (100, 200, "media_player.tv")
+        h._steppers[key] = _Stepper(0.551)
+        await h._flush_volume(key, 100, 200, "u", "media_player.tv")
+        h._ha.call_service.assert_awaited_once_with(
+            "media_player", "volume_set",
+            {"entity_id": "media_player.tv", "volume_level": 0.55},
+        )
+        assert key not in h._steppers
+        await h._flush_volume(key, 100, 200, "u", "media_player.tv")
+        h._ha.call_service.assert_awaited_once()
 
+    @pytest.mark.asyncio
+    async def test_rapid_taps_flush_once(self) -> None:
+        from handlers import _STEPPER_DEBOUNCE_SECONDS, Handlers, _Stepper
         h = Handlers.__new__(Handlers)
-        h._pending_brightness = {}
-        h._pending_volume = {}
-        h._debounce_tasks = {}
-
+        h._bg_tasks = set()
+        flush = AsyncMock()
         key = (100, 200, "light.test")
-        h._pending_brightness[key] = 200
-
-        # Simulate flush cleanup
-        target = h._pending_brightness.pop(key, None)
-        h._debounce_tasks.pop(key, None)
+        h._steppers = {key: _Stepper(128)}
+        for _ in range(4):
+            h._debounce(key, flush, 100, 200, "u", "light.test")
+        await asyncio.sleep(_STEPPER_DEBOUNCE_SECONDS + 0.05)
+        flush.assert_awaited_once_with(key, 100, 200, "u", "light.test")
+        assert h._steppers[key].handle is None
 
-        assert target == 200
-        assert key not in h._pending_brightness
-        assert key not in h._debounce_tasks
+    @pytest.mark.asyncio
+    async def test_timer_due_during_answer_keeps_tap(self) -> None:
+        from handlers import _STEPPER_DEBOUNCE_SECONDS
+        h = self._make_handler()
+        h._ha.call_service = AsyncMock(return_value=(False, "x"))
+        h._db = MagicMock(write_audit=AsyncMock())
+        await h._brightness(1, 2, "u", "bright:light.a:up", MagicMock(answer=AsyncMock()))
+
+        async def slow_answer(*args, **kwargs):
+            await asyncio.sleep(_STEPPER_DEBOUNCE_SECONDS + 0.05)
+
+        await h._brightness(1, 2, "u", "bright:light.a:up", MagicMock(answer=slow_answer))
+        await asyncio.sleep(_STEPPER_DEBOUNCE_SECONDS + 0.05)
+        h._ha.call_service.assert_awaited_once_with(
+            "light", "turn_on", {"entity_id": "light.a", "brightness": 202},
+        )
 
-    def test_volume_pending_dict(self) -> None:
-        """Pending volume dict tracks float values."""
-        from handlers import Handlers
 
+class TestToggleRefreshCoalescing:
+    @pytest.mark.asyncio
+    async def test_toggle_bursts_refresh_once(self) -> None:
+        from handlers import _TOGGLE_REFRESH_SECONDS, Handlers, _dispatch_ctx
         h = Handlers.__new__(Handlers)
-        h._pending_brightness = {}
-        h._pending_volume = {}
-        h._debounce_tasks = {}
-
-        key = (100, 200, "media_player.tv")
-        h._pending_volume[key] = 0.55
-        assert h._pending_volume[key] == 0.55
-
-        h._pending_volume[key] = 0.60
-        assert h._pending_volume[key] == 0.60
+        h._bg_tasks = set()
+        h._refresh_handles = {}
+        h._nav_screens = {1: {(2, "ar:kitchen"): (time.monotonic(), 1, "t", "k", {}, [])}}
+        h._db = MagicMock()
+        h._db.toggle_favorite = AsyncMock(side_effect=[True, False, True])
+        seen_ctx = []
+
+        async def show(cid, uid, eid):
+            seen_ctx.append(_dispatch_ctx.get())
+
+        h._show_entity_control = AsyncMock(side_effect=show)
+        token = _dispatch_ctx.set(("fav:light.a", 2, []))
+        try:
+            for _ in range(3):
+                await h._fav_toggle(1, 2, "u", "fav:light.a", MagicMock(answer=AsyncMock()))
+        finally:
+            _dispatch_ctx.reset(token)
+        await asyncio.sleep(_TOGGLE_REFRESH_SECONDS + 0.05)
+        h._show_entity_control.assert_awaited_once_with(1, 2, "light.a")
+        assert seen_ctx == [None]
+        assert h._refresh_handles == {}
+        assert 1 not in h._nav_screens
 
 
 # ---------------------------------------------------------------------------
@@ -1168,6 +1325,53 @@ class TestCallbackRaceProtection:
         prefix3 = data3.split(":", 1)[0]
         assert prefix3 not in _DEBOUNCE_PREFIXES
 
+    def _make_handler(self):
+        from handlers import Handlers
+        h = Handlers.__new__(Handlers)
+        h._cfg = MagicMock(allowed_chat_id=0, allowed_user_ids=())
+        h._last_cb = {}
+        h._user_locks = {}
+        h._nav_screens = {}
+        h._check_role = AsyncMock(return_value=True)
+        h._dispatch = AsyncMock()
+        return h
+
+    @staticmethod
+    def _callback(data: str):
+        cb = MagicMock()
+        cb.data = data
+        cb.message.chat.id = 1
+        cb.from_user.id = 5
+        cb.answer = AsyncMock()
+        return cb
+
+    @pytest.mark.asyncio
+    async def test_navigation_not_blocked_by_user_lock(self) -> None:
+        h = self._make_handler()
+        lock = h._user_locks.setdefault(5, asyncio.Lock())
+        async with lock:
+            await asyncio.wait_for(h.handle_callback(self._callback("menu:favorites")), 1)
+        h._dispatch.assert_awaited_once()
+
+    @pytest.mark.asyncio
+    async def test_double_tap_dropped(self) -> None:
+        h = self._make_handler()
+        await h.handle_callback(self._callback("menu:favorites"))
+        await h.handle_callback(self._callback("menu:favorites"))
+        h._dispatch.assert_awaited_once()
+        assert isinstance(h._last_cb[5][1], int)
+
+    @pytest.mark.asyncio
+    async def test_write_action_waits_for_user_lock(self) -> None:
+        h = self._make_handler()
+        lock = h._user_locks.setdefault(5, asyncio.Lock())
+        async with lock:
+            task = asyncio.create_task(h.handle_callback(self._callback("act:light.a:toggle")))
+            await asyncio.sleep(0.05)
+            h._dispatch.assert_not_awaited()
+        await task
+        h._dispatch.assert_awaited_once()
+
 
 # ---------------------------------------------------------------------------
 # Readiness with sync tests
@@ -1386,6 +1590,31 @@ class TestTokenValidation:
         config, _ = app_mod._load_and_validate_config()
         assert config.bot_token == token
 
+    def test_domains_allowlist_set_derived(self, tmp_path: Path, monkeypatch) -> None:
+        """Config exposes the domain allowlist as a prebuilt frozenset."""
+        import app as app_mod
+        opts = self._write_options(tmp_path, {
+            "bot_token": "123456789:ABCDefGH_ijklmnop-QRS",
+            "menu_domains_allowlist": ["light", "switch"],
+        })
+        monkeypatch.setattr(app_mod, "OPTIONS_PATH", opts)
+        monkeypatch.setenv("SUPERVISOR_TOKEN", "fake-supervisor")
+        config, _ = app_mod._load_and_validate_config()
+        assert config.menu_domains_allowlist_set == frozenset({"light", "switch"})
+
+    def test_allowed_user_ids_is_frozenset(self, tmp_path: Path, monkeypatch) -> None:
+        """Authorization runs on every update; membership must stay O(1)."""
+        import app as app_mod
+        opts = self._write_options(tmp_path, {
+            "bot_token": "123456789:ABCDefGH_ijklmnop-QRS",
+            "allowed_user_ids": [11, "22"],
+        })
+        monkeypatch.setattr(app_mod, "OPTIONS_PATH", opts)
+        monkeypatch.setenv("SUPERVISOR_TOKEN", "fake-supervisor")
+        config, _ = app_mod._load_and_validate_config()
+        assert config.allowed_user_ids == frozenset({11, 22})
+        assert isinstance(config.allowed_user_ids, frozenset)
+
     def test_non_string_token_exits(self, tmp_path: Path, monkeypatch) -> None:
         """Non-string bot_token (e.g. int) causes sys.exit(1)."""
         import app as app_mod
@@ -1726,3 +1955,1228 @@ class TestControlButtonsDomainHandling:
         all_cbs = [btn.callback_data for row in rows for btn in row]
         assert any("turn_on" in cb for cb in all_cbs)
         assert any("turn_off" in cb for cb in all_cbs)
+
+
+# ---------------------------------------------------------------------------
+# HA state cache tests
+# ---------------------------------------------------------------------------
+
+
+class TestStateCache:
+    def _client(self):
+        from api import HAClient
+        client = HAClient("token")
+        client._request = AsyncMock(return_value=(True, {"entity_id": "light.a", "state": "on"}))
+        return client
+
+    @pytest.mark.asyncio
+    async def test_repeated_get_state_hits_cache(self) -> None:
+        client = self._client()
+        await client.get_state("light.a")
+        await client.get_state("light.a")
+        assert client._request.call_count == 1
+
+    @pytest.mark.asyncio
+    async def test_expired_entry_refetched(self) -> None:
+        client = self._client()
+        await client.get_state("light.a")
+        ts, state = client._state_cache["light.a"]
+        client._state_cache["light.a"] = (ts - 60, state)
+        await client.get_state("light.a")
+        assert client._request.call_count == 2
+
+    @pytest.mark.asyncio
+    async def test_call_service_invalidates_target(self) -> None:
+        client = self._client()
+        await client.get_state("light.a")
+        await client.call_service("light", "turn_off", {"entity_id": "light.a"})
+        assert "light.a" not in client._state_cache
+
+    @pytest.mark.asyncio
+    async def test_failed_fetch_not_cached(self) -> None:
+        client = self._client()
+        client._request = AsyncMock(return_value=(False, "HTTP 404"))
+        assert await client.get_state("light.missing") is None
+        assert "light.missing" not in client._state_cache
+
+    @pytest.mark.asyncio
+    async def test_fetch_overlapping_service_call_not_cached(self) -> None:
+        client = self._client()
+        started = asyncio.Event()
+        release = asyncio.Event()
+
+        async def request(method, path, **kwargs):
+            if method == "POST":
+                return True, []
+            started.set()
+            await release.wait()
+            return True, {"entity_id": "light.a", "state": "off"} if path != "states" else [
+                {"entity_id": "light.a", "state": "off"},
+            ]
+
+        client._request = AsyncMock(side_effect=request)
+        for fetch in (client.get_state("light.a"), client.list_states()):
+            task = asyncio.create_task(fetch)
+            await started.wait()
+            await client.call_service("light", "turn_on", {"entity_id": "light.a"})
+            release.set()
+            await task
+            started.clear()
+            release.clear()
+            assert "light.a" not in client._state_cache
+            assert client._states_list is None
+
+    @pytest.mark.asyncio
+    async def test_state_list_keeps_entries_patched_during_fetch(self) -> None:
+        client = self._client()
+
+        async def request(method, path, **kwargs):
+            base = {"entity_id": "light.a", "state": "off", "attributes": {}}
+            client.patch_state("light.a", base, state="on")
+            return True, [base, {"entity_id": "light.b", "state": "off"}]
+
+        client._request = AsyncMock(side_effect=request)
+        await client.list_states()
+        assert client._state_cache["light.a"][1]["state"] == "on"
+        assert client._state_cache["light.b"][1]["state"] == "off"
+        assert client._cached_during_list is None
+
+    @pytest.mark.asyncio
+    async def test_state_list_reused_until_service_call(self) -> None:
+        client = self._client()
+        client._request = AsyncMock(return_value=(True, [{"entity_id": "light.a"}]))
+        states = await client.list_states()
+        assert await client.list_states() is states
+        assert client._request.await_count == 1
+        await client.call_service("light", "turn_on", {"entity_id": "light.a"})
+        await client.list_states()
+        assert client._request.await_count == 3
+
+    @pytest.mark.asyncio
+    async def test_state_list_seeds_entity_cache(self) -> None:
+        client = self._client()
+        client._request = AsyncMock(return_value=(True, [{"entity_id": "light.a", "state": "on"}]))
+        await client.list_states()
+        assert (await client.get_state("light.a"))["state"] == "on"
+        assert client._request.await_count == 1
+
+    @pytest.mark.asyncio
+    async def test_concurrent_state_list_misses_share_fetch(self) -> None:
+        client = self._client()
+
+        async def slow_request(*args, **kwargs):
+            await asyncio.sleep(0.01)
+            return True, [{"entity_id": "light.a"}]
+
+        client._request = AsyncMock(side_effect=slow_request)
+        a, b, c = await asyncio.gather(*(client.list_states() for _ in range(3)))
+        assert a is b is c
+        assert client._request.await_count == 1
+
+    @pytest.mark.asyncio
+    async def test_patched_state_served_then_expires(self) -> None:
+        from api import OPTIMISTIC_STATE_TTL
+        client = self._client()
+        base = {"entity_id": "light.a", "state": "off", "attributes": {"brightness": 10}}
+        client.patch_state("light.a", base, state="on", brightness=200)
+        state = await client.get_state("light.a")
+        assert state["state"] == "on"
+        assert state["attributes"]["brightness"] == 200
+        assert base["attributes"]["brightness"] == 10
+        client._request.assert_not_called()
+        ts, state = client._state_cache["light.a"]
+        client._state_cache["light.a"] = (ts - OPTIMISTIC_STATE_TTL, state)
+        await client.get_state("light.a")
+        assert client._request.call_count == 1
+
+    @pytest.mark.asyncio
+    async def test_inflight_requests_capped(self) -> None:
+        from api import MAX_CONCURRENT_REQUESTS, HAClient
+        client = HAClient("token")
+        active = peak = 0
+
+        class _Resp:
+            status = 200
+
+            async def __aenter__(self):
+                nonlocal active, peak
+                active += 1
+                peak = max(peak, active)
+                await asyncio.sleep(0.01)
+                return self
+
+            async def __aexit__(self, *exc):
+                nonlocal active
+                active -= 1
+
+            async def json(self, content_type=None):
+                return {}
+
+        client._session = MagicMock()
+        client._session.request = lambda *a, **kw: _Resp()
+        await asyncio.gather(*(client.ha_get("config") for _ in range(MAX_CONCURRENT_REQUESTS * 3)))
+        assert peak == MAX_CONCURRENT_REQUESTS
+
+
+# ---------------------------------------------------------------------------
+# Vacuum routine reverse index tests
+# ---------------------------------------------------------------------------
+
+
+class TestRoutineReverseIndex:
+    def test_button_maps_to_parent_vacuum(self) -> None:
+        from registry import EntityInfo, HARegistry
+        reg = HARegistry("", MagicMock())
+        reg.entities = {
+            "vacuum.robo": EntityInfo(entity_id="vacuum.robo", device_id="d1", platform="roborock"),
+            "button.robo_mop_routine": EntityInfo(
+                entity_id="button.robo_mop_routine", device_id="d1", original_name="Mop routine",
+            ),
+            "button.robo_reset_filter": EntityInfo(
+                entity_id="button.robo_reset_filter", device_id="d1", original_name="Reset filter",
+            ),
+        }
+        reg._detect_vacuum_routines()
+        assert reg.routine_to_vacuum == {"button.robo_mop_routine": "vacuum.robo"}
+        assert reg.vacuum_routines == {"vacuum.robo": ["button.robo_mop_routine"]}
+
+
+# ---------------------------------------------------------------------------
+# Floors / areas menu cache tests
+# ---------------------------------------------------------------------------
+
+
+class TestMenuAggregateCache:
+    def _handlers(self):
+        from handlers import Handlers
+        h = Handlers.__new__(Handlers)
+        h._cfg = MagicMock(menu_domains_allowlist_set=frozenset({"light"}), show_all_enabled=False)
+        h._reg = MagicMock(version=1)
+        h._reg.get_all_areas_sorted.return_value = []
+        h._reg.get_unassigned_entities.return_value = []
+        h._menu_cache = {}
+        h._send_or_edit = AsyncMock()
+        return h
+
+    @pytest.mark.asyncio
+    async def test_reused_until_registry_version_changes(self) -> None:
+        h = self._handlers()
+        await h._show_areas_direct(1)
+        await h._show_areas_direct(1)
+        assert h._reg.get_all_areas_sorted.call_count == 1
+
+        h._reg.version = 2
+        await h._show_areas_direct(1)
+        assert h._reg.get_all_areas_sorted.call_count == 2
+
+
+# ---------------------------------------------------------------------------
+# Precomputed area entity counts
+# ---------------------------------------------------------------------------
+
+
+class TestAreaEntityCounts:
+    def _build_registry(self):
+        from registry import AreaInfo, EntityInfo, HARegistry
+        reg = HARegistry("", MagicMock())
+        reg.areas = {"kitchen": AreaInfo(area_id="kitchen", name="Kitchen")}
+        reg.entities = {
+            "light.kitchen": EntityInfo(entity_id="light.kitchen", area_id="kitchen"),
+            "sensor.kitchen_temp": EntityInfo(entity_id="sensor.kitchen_temp", area_id="kitchen"),
+            "sensor.kitchen_signal": EntityInfo(
+                entity_id="sensor.kitchen_signal", area_id="kitchen", entity_category="diagnostic",
+            ),
+            "switch.kitchen_old": EntityInfo(
+                entity_id="switch.kitchen_old", area_id="kitchen", disabled_by="user",
+            ),
+        }
+        reg._build_cross_refs()
+        return reg
+
+    @pytest.mark.parametrize("domains", [None, frozenset({"sensor"}), frozenset({"light", "fan"})])
+    @pytest.mark.parametrize("show_all", [False, True])
+    def test_matches_get_area_entities(self, domains, show_all) -> None:
+        reg = self._build_registry()
+        expected = len(reg.get_area_entities("kitchen", domains, show_all=show_all))
+        assert reg.count_area_entities("kitchen", domains, show_all=show_all) == expected
+
+    def test_unknown_area(self) -> None:
+        reg = self._build_registry()
+        assert reg.count_area_entities("garage") == 0
+
+
+class TestRegistrySyncVersion:
+    @pytest.mark.asyncio
+    async def test_version_bumped_even_if_db_write_fails(self) -> None:
+        import aiohttp
+        from registry import HARegistry
+        reg = HARegistry("", MagicMock())
+        ws = MagicMock()
+        ws.send_json = AsyncMock()
+        ws.receive = AsyncMock(side_effect=[
+            MagicMock(type=aiohttp.WSMsgType.TEXT, data='{"type": "auth_required"}'),
+            MagicMock(type=aiohttp.WSMsgType.TEXT, data='{"type": "auth_ok"}'),
+        ])
+        session = MagicMock()
+        session.ws_connect.return_value.__aenter__ = AsyncMock(return_value=ws)
+        session.ws_connect.return_value.__aexit__ = AsyncMock(return_value=False)
+        session_cm = MagicMock()
+        session_cm.__aenter__ = AsyncMock(return_value=session)
+        session_cm.__aexit__ = AsyncMock(return_value=False)
+        reg._ws_command = AsyncMock(return_value=[])
+        reg._populate_entity_area_cache = AsyncMock()
+        reg._populate_entity_names = AsyncMock(side_effect=RuntimeError("db closed"))
+        reg._detect_vacuum_segments = AsyncMock()
+
+        with patch("registry.aiohttp.ClientSession", return_value=session_cm):
+            assert await reg.sync() is False
+
+        assert reg.version == 1
+        reg._detect_vacuum_segments.assert_not_awaited()
+        assert reg.segments_version == 0
+
+
+class TestRegistryEntityNames:
+    @pytest.mark.asyncio
+    async def test_stored_names_include_device_for_relative_names(self) -> None:
+        from registry import DeviceInfo, EntityInfo, HARegistry
+        db = MagicMock(replace_registry_entities=AsyncMock())
+        reg = HARegistry("", db)
+        reg.devices = {"d1": DeviceInfo(device_id="d1", name="Thermostat")}
+        reg.entities = {
+            "sensor.t": EntityInfo(entity_id="sensor.t", original_name="Temperature",
+                                   device_id="d1", has_entity_name=True),
+            "climate.t": EntityInfo(entity_id="climate.t", device_id="d1", has_entity_name=True),
+            "sensor.h": EntityInfo(entity_id="sensor.h", name="Hall humidity",
+                                   original_name="Humidity", device_id="d1", has_entity_name=True),
+            "sensor.old": EntityInfo(entity_id="sensor.old", original_name="Old style", device_id="d1"),
+        }
+        await reg._populate_entity_names()
+        rows = {eid: name for eid, name, _ in db.replace_registry_entities.await_args.args[0]}
+        assert rows == {
+            "sensor.t": "Thermostat Temperature",
+            "climate.t": "Thermostat",
+            "sensor.h": "Hall humidity",
+            "sensor.old": "Old style",
+        }
+
+
+class TestDeviceEntityIndex:
+    def test_lookups_use_index(self) -> None:
+        from registry import EntityInfo, HARegistry
+        reg = HARegistry("", MagicMock())
+        reg.entities = {
+            "vacuum.robo": EntityInfo(entity_id="vacuum.robo", device_id="d1"),
+            "button.robo_clean": EntityInfo(entity_id="button.robo_clean", device_id="d1"),
+            "sensor.robo_old": EntityInfo(entity_id="sensor.robo_old", device_id="d1", disabled_by="user"),
+            "light.a": EntityInfo(entity_id="light.a", device_id="d2"),
+        }
+        reg._build_cross_refs()
+        assert reg.get_device_entity_ids("d1") == ["button.robo_clean", "vacuum.robo"]
+        assert reg.get_device_entity_ids("d1", frozenset({"vacuum"})) == ["vacuum.robo"]
+        assert reg.get_vacuum_entity_for_device("d1") == "vacuum.robo"
+        assert reg.get_vacuum_entity_for_device("d2") is None
+        assert reg.get_device_entity_ids("missing") == []
+        assert reg.entity_device == {
+            "vacuum.robo": "d1", "button.robo_clean": "d1", "sensor.robo_old": "d1", "light.a": "d2",
+        }
+
+
+class TestRegistrySortedViews:
+    def test_views_rebuilt_with_cross_refs(self) -> None:
+        from registry import AreaInfo, EntityInfo, FloorInfo, HARegistry
+        reg = HARegistry("", MagicMock())
+        reg.floors = {
+            "up": FloorInfo(floor_id="up", name="Upstairs", level=1),
+            "ground": FloorInfo(floor_id="ground", name="Ground", level=0),
+        }
+        reg.areas = {
+            "z": AreaInfo(area_id="z", name="Zal", floor_id="ground"),
+            "b": AreaInfo(area_id="b", name="Bath", floor_id="ground"),
+            "g": AreaInfo(area_id="g", name="Garage"),
+        }
+        reg.entities = {
+            "light.b": EntityInfo(entity_id="light.b", area_id="b"),
+            "switch.x": EntityInfo(entity_id="switch.x"),
+            "light.a": EntityInfo(entity_id="light.a"),
+            "sensor.diag": EntityInfo(entity_id="sensor.diag", entity_category="diagnostic"),
+        }
+        reg._build_cross_refs()
+
+        assert [f.floor_id for f in reg.get_floors_sorted()] == ["ground", "up"]
+        assert [a.area_id for a in reg.get_areas_for_floor("ground")] == ["b", "z"]
+        assert [a.area_id for a in reg.get_unassigned_areas()] == ["g"]
+        assert [a.area_id for a in reg.get_all_areas_sorted()] == ["b", "g", "z"]
+        assert reg.get_unassigned_entities() == ["light.a", "switch.x"]
+        assert reg.get_unassigned_entities(frozenset({"light", "sensor"}), show_all=True) == [
+            "light.a", "sensor.diag",
+        ]
+
+
+# ---------------------------------------------------------------------------
+# Menu re-render skipping
+# ---------------------------------------------------------------------------
+
+
+class TestSkipIdenticalRender:
+    def _make_handler(self):
+        from handlers import Handlers
+        h = Handlers.__new__(Handlers)
+        h._bot = MagicMock()
+        h._bot.edit_message_text = AsyncMock()
+        h._db = MagicMock()
+        h._db.get_menu_state = AsyncMock(return_value={"message_id": 42})
+        h._db.save_menu_state = AsyncMock()
+        h._menu_state = {}
+        h._bg_tasks = set()
+        h._last_render = {}
+        h._edit_last = {}
+        h._edit_pending = {}
+        h._edit_tasks = {}
+        h._chat_penalty = {}
+        return h
+
+    @pytest.mark.asyncio
+    async def test_identical_edit_skipped(self) -> None:
+        from ui import build_main_menu
+        h = self._make_handler()
+        t, k = build_main_menu()
+        await h._render_menu(1, t, k, menu="main")
+        await h._render_menu(1, t, k, menu="main")
+        assert h._bot.edit_message_text.await_count == 1
+
+    @pytest.mark.asyncio
+    async def test_changed_text_edits_again(self) -> None:
+        from ui import build_main_menu
+        h = self._make_handler()
+        t, k = build_main_menu()
+        await h._render_menu(1, t, k, menu="main")
+        await h._render_menu(1, t + "!", k, menu="main")
+        assert h._bot.edit_message_text.await_count == 2
+
+    @pytest.mark.asyncio
+    async def test_rapid_renders_coalesced(self) -> None:
+        from handlers import _EDIT_DEBOUNCE_SECONDS
+        from ui import build_main_menu
+        h = self._make_handler()
+        _, k = build_main_menu()
+        await h._send_or_edit(1, "first", k)
+        await h._send_or_edit(1, "second", k)
+        await h._send_or_edit(1, "third", k)
+        assert h._bot.edit_message_text.await_count == 1
+        await asyncio.sleep(_EDIT_DEBOUNCE_SECONDS + 0.1)
+        assert h._bot.edit_message_text.await_count == 2
+        assert h._bot.edit_message_text.await_args.kwargs["text"] == "third"
+
+    @pytest.mark.asyncio
+    async def test_retry_after_defers_renders(self) -> None:
+        from aiogram.exceptions import TelegramRetryAfter
+        from ui import build_main_menu
+        h = self._make_handler()
+        _, k = build_main_menu()
+        h._bot.edit_message_text.side_effect = TelegramRetryAfter(
+            method=MagicMock(), message="Too Many Requests", retry_after=30,
+        )
+        await h._send_or_edit(1, "first", k)
+        assert h._chat_penalty[1] > time.monotonic() + 29
+
+        h._bot.edit_message_text.reset_mock()
+        h._edit_last.clear()
+        await h._send_or_edit(1, "second", k)
+        h._bot.edit_message_text.assert_not_awaited()
+        assert h._edit_pending[1][0] == "second"
+        h._edit_tasks[1].cancel()
+
+    @pytest.mark.asyncio
+    async def test_command_cancels_superseded_flush(self) -> None:
+        from ui import build_main_menu
+        h = self._make_handler()
+        _, k = build_main_menu()
+        h._render_menu = AsyncMock()
+        h._edit_last[1] = time.monotonic()
+        await h._send_or_edit(1, "deferred", k)
+        old_task = h._edit_tasks[1]
+
+        await h._send_or_edit(1, "command", k, source=MagicMock())
+        await asyncio.sleep(0)
+        assert old_task.cancelled()
+        assert 1 not in h._edit_tasks
+
+        h._edit_last[1] = time.monotonic()
+        await h._send_or_edit(1, "next", k)
+        assert h._edit_tasks[1] is not old_task
+        h._edit_tasks[1].cancel()
+        assert [c.args[1] for c in h._render_menu.await_args_list] == ["command"]
+
+    @pytest.mark.asyncio
+    async def test_deferred_command_keeps_source(self) -> None:
+        from ui import build_main_menu
+        h = self._make_handler()
+        _, k = build_main_menu()
+        h._chat_penalty[1] = time.monotonic() + 0.05
+        h._render_menu = AsyncMock()
+        command = MagicMock()
+        await h._send_or_edit(1, "menu", k, source=command, menu="main")
+        # A callback render during the penalty replaces the payload only
+        await h._send_or_edit(1, "later", k, menu="main")
+        h._render_menu.assert_not_awaited()
+
+        await h._edit_tasks[1]
+
+        h._render_menu.assert_awaited_once()
+        assert h._render_menu.await_args.args[1] == "later"
+        assert h._render_menu.await_args.kwargs["source"] is command
+
+    @pytest.mark.asyncio
+    async def test_menu_state_read_once_written_through(self) -> None:
+        from ui import build_main_menu
+        h = self._make_handler()
+        t, k = build_main_menu()
+        await h._render_menu(1, t, k, menu="main")
+        await h._render_menu(1, t + "!", k, menu="main")
+        await asyncio.sleep(0)
+        h._db.get_menu_state.assert_awaited_once_with(1)
+        assert h._db.save_menu_state.await_count == 2
+        assert h._menu_state[1]["current_menu"] == "main"
+
+
+class TestRegistryViewCache:
+    def _make_handler(self):
+        from handlers import Handlers
+        h = Handlers.__new__(Handlers)
+        h._menu_cache = {}
+        h._cfg = MagicMock(menu_domains_allowlist_set=frozenset({"light"}), show_all_enabled=False)
+        h._reg = MagicMock(version=1)
+        h._reg.get_devices_for_area.return_value = [{"device_id": "d1"}]
+        return h
+
+    def test_area_devices_reused_until_registry_changes(self) -> None:
+        h = self._make_handler()
+        first = h._area_devices("kitchen")
+        assert h._area_devices("kitchen") is first
+        assert h._reg.get_devices_for_area.call_count == 1
+        h._reg.version = 2
+        h._area_devices("kitchen")
+        assert h._reg.get_devices_for_area.call_count == 2
+
+    def test_area_counts_shared_across_menus(self) -> None:
+        h = self._make_handler()
+        h._reg.areas = {"a": None, "b": None}
+        h._reg.count_area_entities.side_effect = lambda aid, *_, **__: 3 if aid == "a" else 0
+        assert h._area_counts() == {"a": 3}
+        assert h._area_counts() is h._area_counts()
+        assert h._reg.count_area_entities.call_count == 2
+
+    def test_area_scenes_filtered_by_prefix(self) -> None:
+        from registry import AreaInfo, EntityInfo, HARegistry
+        h = self._make_handler()
+        h._reg = HARegistry("", MagicMock())
+        h._reg.areas = {"hall": AreaInfo("hall", "Hall", entity_ids=[
+            "scene.movie", "script.bed", "light.a", "scenery.x", "scene.off",
+        ])}
+        h._reg.entities = {
+            "scene.movie": EntityInfo("scene.movie", original_name="Movie"),
+            "script.bed": EntityInfo("script.bed", name="Bedtime"),
+            "scene.off": EntityInfo("scene.off", disabled_by="user"),
+        }
+        assert h._area_scenes("hall") == [
+            {"entity_id": "scene.movie", "friendly_name": "Movie"},
+            {"entity_id": "script.bed", "friendly_name": "Bedtime"},
+        ]
+
+
+class TestPinToggle:
+    @pytest.mark.asyncio
+    async def test_area_rerender_uses_toggle_result(self) -> None:
+        from handlers import Handlers
+        from registry import AreaInfo
+        h = Handlers.__new__(Handlers)
+        h._menu_state = {1: {"current_menu": "area:hall:2"}}
+        h._reg = MagicMock(areas={"hall": AreaInfo("hall", "Hall")})
+        h._area_devices = MagicMock(return_value=[])
+        h._cfg = MagicMock(menu_page_size=8)
+        h._db = MagicMock()
+        h._db.toggle_pinned_item = AsyncMock(return_value=True)
+        h._db.is_pinned = AsyncMock()
+        h._send_or_edit = AsyncMock()
+        await h._pin_toggle(1, 2, "u", "pin:area:hall", MagicMock(answer=AsyncMock()))
+        h._area_devices.assert_called_once_with("hall")
+        h._db.is_pinned.assert_not_awaited()
+        kb = h._send_or_edit.await_args.args[2]
+        assert kb.inline_keyboard[0][0].callback_data == "pin:area:hall"
+        assert "Убрать" in kb.inline_keyboard[0][0].text
+
+
+class TestNavStack:
+    def test_depth_capped(self) -> None:
+        from handlers import _NAV_STACK_DEPTH, Handlers
+        h = Handlers.__new__(Handlers)
+        h._nav_stack = {}
+        for i in range(_NAV_STACK_DEPTH + 5):
+            h._push_nav(1, f"ar:{i}")
+        h._push_nav(1, f"ar:{_NAV_STACK_DEPTH + 4}")
+        assert len(h._nav_stack[1]) == _NAV_STACK_DEPTH
+        assert h._nav_stack[1][0] == "ar:5"
+        assert h._pop_nav(1) == f"ar:{_NAV_STACK_DEPTH + 3}"
+
+
+class TestNavBackReplay:
+    def _make_handler(self):
+        from handlers import Handlers
+        h = Handlers.__new__(Handlers)
+        h._nav_stack = {}
+        h._nav_screens = {}
+        h._chat_penalty = {}
+        h._edit_pending = {}
+        h._edit_last = {}
+        h._reg = MagicMock(version=1)
+        h._bg_tasks = set()
+        h._render_menu = AsyncMock()
+        return h
+
+    @pytest.mark.asyncio
+    async def test_back_replays_cached_screen(self) -> None:
+        from handlers import Handlers
+        h = self._make_handler()
+        calls = []
+
+        async def area(self, cid, uid, uname, data, cb):
+            calls.append(data)
+            self._push_nav(cid, "nav:manage")
+            await self._send_or_edit(cid, "area", "kb", menu="area")
+
+        cb = MagicMock(answer=AsyncMock())
+        with patch.dict(Handlers._ROUTES, {"ar": area}):
+            await h._dispatch("ar", 1, 2, "u", "ar:kitchen", cb)
+            h._push_nav(1, "ar:kitchen")
+            h._push_nav(1, "ent:light.a")
+            h._edit_last.clear()
+            await h._dispatch("nav", 1, 2, "u", "nav:back", cb)
+
+        assert calls == ["ar:kitchen"]
+        assert h._render_menu.await_args.args[1:] == ("area", "kb")
+        # The handler's own nav push is replayed too
+        assert list(h._nav_stack[1]) == ["nav:manage"]
+
+    @pytest.mark.asyncio
+    async def test_back_does_not_replay_other_users_screen(self) -> None:
+        from handlers import Handlers
+        h = self._make_handler()
+        calls = []
+
+        async def area(self, cid, uid, uname, data, cb):
+            calls.append(uid)
+            await self._send_or_edit(cid, f"area for {uid}", "kb", menu="area")
+
+        cb = MagicMock(answer=AsyncMock())
+        with patch.dict(Handlers._ROUTES, {"ar": area}):
+            await h._dispatch("ar", 1, 2, "u", "ar:kitchen", cb)
+            h._push_nav(1, "ar:kitchen")
+            h._push_nav(1, "ent:light.a")
+            h._edit_last.clear()
+            await h._dispatch("nav", 1, 3, "v", "nav:back", cb)
+
+        assert calls == [2, 3]
+        assert h._render_menu.await_args.args[1] == "area for 3"
+
+    @pytest.mark.asyncio
+    async def test_back_skips_screen_from_older_registry(self) -> None:
+        from handlers import Handlers
+        h = self._make_handler()
+        calls = []
+
+        async def area(self, cid, uid, uname, data, cb):
+            calls.append(self._reg.version)
+            await self._send_or_edit(cid, "area", "kb", menu="area")
+
+        cb = MagicMock(answer=AsyncMock())
+        with patch.dict(Handlers._ROUTES, {"ar": area}):
+            await h._dispatch("ar", 1, 2, "u", "ar:kitchen", cb)
+            h._push_nav(1, "ar:kitchen")
+            h._push_nav(1, "ent:light.a")
+            h._reg.version = 2
+            h._edit_last.clear()
+            await h._dispatch("nav", 1, 2, "u", "nav:back", cb)
+
+        assert calls == [1, 2]
+
+    @pytest.mark.asyncio
+    async def test_spawned_render_not_cached_as_callback_screen(self) -> None:
+        from handlers import Handlers
+        h = self._make_handler()
+
+        async def later(cid):
+            await h._send_or_edit(cid, "flushed", "kb", menu="entity")
+
+        async def bright(self, cid, uid, uname, data, cb):
+            self._spawn(later(cid), name="flush")
+
+        cb = MagicMock(answer=AsyncMock())
+        with patch.dict(Handlers._ROUTES, {"bright": bright}):
+            await h._dispatch("bright", 1, 2, "u", "bright:light.a:up", cb)
+        await asyncio.gather(*h._bg_tasks)
+        h._render_menu.assert_awaited_once()
+        assert h._nav_screens == {}
+
+    @pytest.mark.asyncio
+    async def test_text_todo_add_drops_cached_screens(self) -> None:
+        h = self._make_handler()
+        h._cfg = MagicMock(allowed_chat_id=0, allowed_user_ids=())
+        h._todo_add_pending = {7: "todo.shopping"}
+        h._ha = MagicMock(call_service=AsyncMock(return_value=(True, None)))
+        h._db = MagicMock(log_action=AsyncMock())
+        h._show_todo_items = AsyncMock()
+        h._nav_screens[7] = {(2, "todo:todo.shopping"): (time.monotonic(), 1, "t", "k", {}, [])}
+        msg = MagicMock(text="milk")
+        msg.chat.id = 7
+        msg.from_user.id = 2
+        await h.handle_text_search(msg)
+        assert 7 not in h._nav_screens
+
+    @pytest.mark.asyncio
+    async def test_write_action_drops_cached_screens(self) -> None:
+        h = self._make_handler()
+        h._cfg = MagicMock(allowed_chat_id=0, allowed_user_ids=())
+        h._last_cb = {}
+        h._user_locks = {}
+        h._check_role = AsyncMock(return_value=True)
+        h._dispatch = AsyncMock()
+        h._nav_screens[7] = {(2, "ar:kitchen"): (time.monotonic(), 1, "t", "k", {}, [])}
+        cb = MagicMock()
+        cb.message.chat.id = 7
+        cb.from_user.id = 2
+        cb.data = "act:light.a:toggle"
+        await h.handle_callback(cb)
+        assert 7 not in h._nav_screens
+
+
+class TestEntityControlFetch:
+    def _make_handler(self):
+        from handlers import Handlers
+        h = Handlers.__new__(Handlers)
+        h._nav_stack = {}
+        h._ha = MagicMock()
+        h._db = MagicMock()
+        h._db.is_favorite = AsyncMock(return_value=False)
+        h._db.get_notification = AsyncMock(return_value=None)
+        h._db.get_entity_area = AsyncMock(return_value={"area_id": "hall"})
+        h._vac = MagicMock()
+        h._send_or_edit = AsyncMock()
+        return h
+
+    @pytest.mark.asyncio
+    async def test_vacuum_caps_fetched_with_state(self) -> None:
+        h = self._make_handler()
+        h._ha.get_state = AsyncMock(return_value={"state": "docked", "attributes": {}})
+        h._vac.get_capabilities = AsyncMock(return_value=MagicMock(
+            supports_segment_clean=True, supports_routines=False,
+        ))
+        await h._show_entity_control(1, 2, "vacuum.robo")
+        kb = h._send_or_edit.await_args.args[2]
+        cbs = [b.callback_data for row in kb.inline_keyboard for b in row]
+        assert "vrooms:vacuum.robo" in cbs
+        assert list(h._nav_stack[1]) == ["ar:hall"]
+
+    @pytest.mark.asyncio
+    async def test_state_failure_renders_not_found(self) -> None:
+        h = self._make_handler()
+        h._ha.get_state = AsyncMock(side_effect=RuntimeError("down"))
+        await h._show_entity_control(1, 2, "light.a")
+        assert h._send_or_edit.await_args.kwargs["menu"] == "entity_err"
+        h._vac.get_capabilities.assert_not_called()
+
+
+class TestEnrichEntities:
+    @pytest.mark.asyncio
+    async def test_states_fetched_concurrently_in_order(self) -> None:
+        from handlers import Handlers
+        from registry import HARegistry
+        h = Handlers.__new__(Handlers)
+        h._reg = HARegistry("", MagicMock())
+        inflight = peak = 0
+
+        async def get_state(eid):
+            nonlocal inflight, peak
+            inflight += 1
+            peak = max(peak, inflight)
+            await asyncio.sleep(0.01)
+            inflight -= 1
+            return None if eid == "light.b" else {"state": "on", "attributes": {}}
+
+        h._ha = MagicMock(get_state=get_state)
+        rows = await h._enrich_entities(["light.a", "light.b", "switch.c"])
+        assert [r["entity_id"] for r in rows] == ["light.a", "light.b", "switch.c"]
+        assert [r["state"] for r in rows] == ["on", "unavailable", "on"]
+        assert peak == 3
+
+    @pytest.mark.asyncio
+    async def test_page_enriches_only_visible_slice(self) -> None:
+        from handlers import Handlers
+        from registry import HARegistry
+        h = Handlers.__new__(Handlers)
+        h._reg = HARegistry("", MagicMock())
+        h._cfg = MagicMock(menu_page_size=2)
+        h._ha = MagicMock()
+        h._ha.get_state = AsyncMock(return_value={"state": "on", "attributes": {}})
+        eids = ["light.a", "light.b", "light.c", "light.d", "light.e"]
+
+        page, rows = await h._enrich_page(eids, 9)
+
+        assert page == 2
+        assert [r["entity_id"] for r in rows] == ["light.e"]
+        h._ha.get_state.assert_awaited_once_with("light.e")
+
+
+class TestNotifList:
+    @pytest.mark.asyncio
+    async def test_fetches_only_unnamed(self) -> None:
+        from handlers import Handlers
+        from registry import HARegistry
+        h = Handlers.__new__(Handlers)
+        h._reg = HARegistry("", MagicMock())
+        h._cfg = MagicMock(menu_page_size=8)
+        h._db = MagicMock()
+        h._db.count_user_notifications = AsyncMock(return_value=2)
+        h._db.get_user_notifications_page = AsyncMock(return_value=[
+            {"entity_id": "light.a", "friendly_name": "Lamp", "enabled": 1},
+            {"entity_id": "light.b", "friendly_name": None, "enabled": 1},
+        ])
+        h._ha = MagicMock()
+        h._ha.get_state = AsyncMock(return_value={"attributes": {"friendly_name": "Bulb"}})
+        h._send_or_edit = AsyncMock()
+        await h._show_notif_list(1, 2, 0)
+        h._ha.get_state.assert_awaited_once_with("light.b")
+        subs = h._db.get_user_notifications_page.return_value
+        assert [s["friendly_name"] for s in subs] == ["Lamp", "Bulb"]
+
+
+class TestGlobalColor:
+    @pytest.mark.asyncio
+    async def test_color_lights_called_concurrently(self) -> None:
+        from handlers import Handlers
+        h = Handlers.__new__(Handlers)
+        h._db = MagicMock(write_audit=AsyncMock())
+        h._state_views = {}
+        h._send_or_edit = AsyncMock()
+        h._ha = MagicMock()
+        h._ha.list_states = AsyncMock(return_value=[
+            {"entity_id": "light.a", "attributes": {"supported_color_modes": ["hs"]}},
+            {"entity_id": "light.b", "attributes": {"supported_color_modes": ["rgb"]}},
+            {"entity_id": "light.c", "attributes": {"supported_color_modes": ["rgb"]}},
+            {"entity_id": "light.dim", "attributes": {"supported_color_modes": ["brightness"]}},
+            {"entity_id": "switch.x", "attributes": {}},
+        ])
+        inflight = peak = 0
+
+        async def call_service(domain, service, data):
+            nonlocal inflight, peak
+            inflight += 1
+            peak = max(peak, inflight)
+            await asyncio.sleep(0.01)
+            inflight -= 1
+            if data["entity_id"] == "light.c":
+                raise RuntimeError("boom")
+            return True, ""
+
+        h._ha.call_service = call_service
+        cb = MagicMock(answer=AsyncMock())
+        await h._global_color(1, 2, "u", "gcl:0", cb)
+        assert peak == 3
+        assert "2 ламп" in cb.answer.await_args.args[0]
+
+
+class TestFriendlyName:
+    def _make_handler(self):
+        from handlers import Handlers
+        from registry import EntityInfo, HARegistry
+        h = Handlers.__new__(Handlers)
+        h._reg = HARegistry("", MagicMock())
+        h._reg.entities = {"light.desk": EntityInfo(entity_id="light.desk", original_name="Desk")}
+        return h
+
+    def test_prefers_state_attribute(self) -> None:
+        h = self._make_handler()
+        state = {"attributes": {"friendly_name": "Desk Lamp"}}
+        assert h._friendly_name(state, "light.desk") == "Desk Lamp"
+
+    def test_falls_back_to_registry_then_entity_id(self) -> None:
+        h = self._make_handler()
+        assert h._friendly_name(None, "light.desk") == "Desk"
+        assert h._friendly_name({"attributes": {}}, "light.other") == "light.other"
+
+
+class TestVacuumCommandResult:
+    @pytest.mark.asyncio
+    async def test_result_rendered_when_audit_write_fails(self) -> None:
+        from handlers import Handlers
+        h = Handlers.__new__(Handlers)
+        h._check_rl = AsyncMock(return_value=True)
+        h._vac = MagicMock()
+        h._vac.execute_command = AsyncMock(return_value=(True, None))
+        h._rl = MagicMock()
+        h._db = MagicMock()
+        h._db.write_audit = AsyncMock(side_effect=RuntimeError("db locked"))
+        h._send_or_edit = AsyncMock()
+        cb = MagicMock()
+        cb.answer = AsyncMock()
+
+        await h._vac_cmd(1, 2, "user", "vcmd:vacuum.robo:stop", cb)
+
+        h._db.write_audit.assert_awaited_once()
+        h._send_or_edit.assert_awaited_once()
+        assert h._send_or_edit.await_args.kwargs["menu"] == "vac_result"
+
+
+class TestRefreshFastPath:
+    @pytest.mark.asyncio
+    async def test_recent_sync_is_reused(self) -> None:
+        import time as _time
+        from handlers import Handlers
+        from registry import HARegistry
+        h = Handlers.__new__(Handlers)
+        h._reg = HARegistry("", MagicMock())
+        assert h._reg.last_sync_age == float("inf")
+        h._reg._last_sync_mono = _time.monotonic()
+        h._reg.sync = AsyncMock()
+        h._send_or_edit = AsyncMock()
+
+        await h._do_refresh(1)
+
+        h._reg.sync.assert_not_awaited()
+        h._send_or_edit.assert_awaited_once()
+        assert "Синхронизация завершена" in h._send_or_edit.await_args.args[1]
+
+    @pytest.mark.asyncio
+    async def test_stale_registry_is_synced(self) -> None:
+        from handlers import Handlers
+        from registry import HARegistry
+        h = Handlers.__new__(Handlers)
+        h._reg = HARegistry("", MagicMock())
+        h._reg.sync = AsyncMock(return_value=True)
+        h._send_or_edit = AsyncMock()
+
+        await h._do_refresh(1)
+
+        h._reg.sync.assert_awaited_once()
+        assert h._send_or_edit.await_count == 2  # progress + result
+
+    @pytest.mark.asyncio
+    async def test_diff_counts_added_and_removed(self) -> None:
+        from handlers import Handlers
+        from registry import HARegistry
+        h = Handlers.__new__(Handlers)
+        h._reg = HARegistry("", MagicMock())
+        h._reg.areas = {"a": MagicMock(), "b": MagicMock()}
+
+        async def _sync() -> bool:
+            h._reg.areas = {"b": MagicMock(), "c": MagicMock(), "d": MagicMock()}
+            return True
+
+        h._reg.sync = _sync
+        h._send_or_edit = AsyncMock()
+
+        await h._do_refresh(1)
+
+        text = h._send_or_edit.await_args.args[1]
+        assert "+2 комнат" in text
+        assert "-1 комнат" in text
+        assert "устройств," not in text
+
+
+class TestHandlersClose:
+    @pytest.mark.asyncio
+    async def test_close_waits_for_background_writes(self) -> None:
+        from handlers import Handlers
+        h = Handlers.__new__(Handlers)
+        h._bg_tasks = set()
+        h._refresh_handles = {}
+        h._steppers = {}
+        h._edit_tasks = {}
+        done = []
+
+        async def write(n):
+            await asyncio.sleep(0.01)
+            done.append(n)
+            if n == 1:
+                h._spawn(write(2), name="follow_up")
+
+        h._spawn(write(1), name="menu_state")
+        await h.close()
+        assert done == [1, 2]
+        assert not h._bg_tasks
+
+    @pytest.mark.asyncio
+    async def test_close_sends_pending_stepper_call(self) -> None:
+        from handlers import Handlers, _Stepper
+        h = Handlers.__new__(Handlers)
+        h._bg_tasks = set()
+        h._refresh_handles = {}
+        h._edit_tasks = {}
+        flush = AsyncMock()
+        key = (1, 2, "light.a")
+        h._steppers = {key: _Stepper(200)}
+        h._debounce(key, flush, 1, 2, "u", "light.a")
+        await h.close()
+        flush.assert_awaited_once_with(key, 1, 2, "u", "light.a")
+
+
+class TestRoleCache:
+    @pytest.mark.asyncio
+    async def test_role_read_once_within_ttl(self) -> None:
+        from handlers import Handlers
+        h = Handlers.__new__(Handlers)
+        h._role_cache = {}
+        h._db = MagicMock()
+        h._db.get_user_role = AsyncMock(return_value="guest")
+
+        assert await h._check_role(7, "user") is False
+        assert await h._check_role(7, "guest") is True
+        h._db.get_user_role.assert_awaited_once_with(7)
+
+        h._role_cache.pop(7)  # as cmd_role does after set_user_role
+        h._db.get_user_role.return_value = "admin"
+        assert await h._check_role(7, "admin") is True
+
+
+class TestCallbackArgs:
+    def test_matches_split_semantics(self) -> None:
+        from handlers import _cb_args
+        for data in ("arp:kitchen:2", "ssel:select.mode:a:b", "act:light.a:", "pin:area"):
+            parts = data.split(":", 2)
+            expected = (parts[1], parts[2]) if len(parts) == 3 else None
+            assert _cb_args(data) == expected
+        assert _cb_args("nav") is None
+
+    @pytest.mark.asyncio
+    async def test_malformed_page_falls_back_to_first(self) -> None:
+        from handlers import Handlers
+        h = Handlers.__new__(Handlers)
+        h._show_automations = AsyncMock()
+        cb = MagicMock(answer=AsyncMock())
+        await h._automation_page(1, 2, "u", "autp:x", cb)
+        await h._automation_page(1, 2, "u", "autp", cb)
+        assert [c.args for c in h._show_automations.await_args_list] == [(1, 0), (1, 0)]
+
+
+class TestEntityIdPattern:
+    @pytest.mark.parametrize("eid,ok", [
+        ("light.kitchen", True),
+        ("sensor.temp_1-a", True),
+        ("light.kitchen\n", False),
+        ("Light.kitchen", False),
+        ("light.", False),
+    ])
+    def test_fullmatch(self, eid: str, ok: bool) -> None:
+        from handlers import _ENTITY_ID_RE
+        assert (_ENTITY_ID_RE.fullmatch(eid) is not None) is ok
+
+    def test_service_target(self) -> None:
+        from handlers import _service_target
+        assert _service_target("light.kitchen", "turn_on") == ("light", "light.turn_on")
+        assert _service_target("light.kitchen", "reload") is None
+        assert _service_target("light.kitchen\n", "turn_on") is None
+
+
+class TestSnapshotDiff:
+    @pytest.mark.asyncio
+    async def test_diff_uses_one_bulk_fetch(self) -> None:
+        from handlers import Handlers
+        h = Handlers.__new__(Handlers)
+        h._db = MagicMock()
+        h._db.get_snapshot = AsyncMock(return_value={
+            "id": 1, "name": "s", "created_at": "2026-01-01 00:00:00",
+            "payload": [
+                {"entity_id": "light.a", "state": "on"},
+                {"entity_id": "light.b", "state": "off"},
+                {"entity_id": "light.gone", "state": "on"},
+            ],
+        })
+        h._ha = MagicMock()
+        h._ha.list_states = AsyncMock(return_value=[
+            {"entity_id": "light.a", "state": "on"},
+            {"entity_id": "light.b", "state": "on"},
+        ])
+        h._ha.get_state = AsyncMock()
+        h._send_or_edit = AsyncMock()
+        await h._snap_diff(1, 2, "u", "snapdiff:1", MagicMock(answer=AsyncMock()))
+        h._ha.get_state.assert_not_awaited()
+        text = h._send_or_edit.await_args.args[1]
+        assert "light.b: off → on" in text
+        assert "light.gone: removed" in text
+        assert "light.a" not in text
+
+    @pytest.mark.asyncio
+    async def test_diff_stops_at_line_cap(self) -> None:
+        from handlers import Handlers, _SNAP_DIFF_MAX_LINES
+        h = Handlers.__new__(Handlers)
+        h._db = MagicMock()
+        h._db.get_snapshot = AsyncMock(return_value={
+            "id": 1, "name": "s", "created_at": "2026-01-01 00:00:00",
+            "payload": [{"entity_id": f"light.l{i}", "state": "on"} for i in range(100)],
+        })
+        h._ha = MagicMock()
+        h._ha.list_states = AsyncMock(return_value=[{"entity_id": "sun.sun", "state": "up"}])
+        h._send_or_edit = AsyncMock()
+        await h._snap_diff(1, 2, "u", "snapdiff:1", MagicMock(answer=AsyncMock()))
+        text = h._send_or_edit.await_args.args[1]
+        assert text.count("removed") == _SNAP_DIFF_MAX_LINES
+
+
+@pytest.fixture
+def state_list_handler():
+    """Bare Handlers whose menus read a stubbed, initially empty list_states()."""
+    from handlers import Handlers
+    h = Handlers.__new__(Handlers)
+    h._cfg = MagicMock(menu_page_size=8)
+    h._search_cache = {}
+    h._state_views = {}
+    h._ha = MagicMock(list_states=AsyncMock(return_value=[]))
+    h._send_or_edit = AsyncMock()
+    return h
+
+
+class TestSearch:
+    @pytest.mark.asyncio
+    async def test_index_reused_for_same_state_list(self, state_list_handler) -> None:
+        h = state_list_handler
+        h._ha.list_states.return_value = [
+            {"entity_id": "light.kitchen", "state": "on", "attributes": {"friendly_name": "Кухня"}},
+            {"entity_id": "switch.pump", "state": "off", "attributes": {"friendly_name": None}},
+        ]
+
+        await h._do_search(1, 2, "КУХ")
+        assert [r["entity_id"] for r in h._search_cache[1][0]] == ["light.kitchen"]
+        index = h._state_views["search"][1]
+
+        await h._do_search(1, 2, "pump")
+        assert h._state_views["search"][1] is index
+        assert h._search_cache[1][0][0]["friendly_name"] == "switch.pump"
+
+    @pytest.mark.asyncio
+    async def test_results_capped_and_marked(self, state_list_handler) -> None:
+        from handlers import _SEARCH_MAX_RESULTS
+        h = state_list_handler
+        states = [{"entity_id": f"light.l{i}", "state": "on"} for i in range(_SEARCH_MAX_RESULTS + 5)]
+        h._ha.list_states.return_value = states
+
+        await h._do_search(1, 2, "light")
+
+        results, truncated = h._search_cache[1]
+        assert len(results) == _SEARCH_MAX_RESULTS
+        assert truncated
+        assert f"({_SEARCH_MAX_RESULTS}+)" in h._send_or_edit.await_args.args[1]
+
+        # Exactly cap matches is a complete list
+        h._ha.list_states.return_value = states[:_SEARCH_MAX_RESULTS]
+        await h._do_search(1, 2, "light")
+        assert h._search_cache[1][1] is False
+        assert f"({_SEARCH_MAX_RESULTS})" in h._send_or_edit.await_args.args[1]
+
+
+class TestStateViews:
+    @pytest.mark.asyncio
+    async def test_automations_rebuilt_only_for_new_state_list(self, state_list_handler) -> None:
+        h = state_list_handler
+        states = [{"entity_id": "automation.b", "state": "on", "attributes": {}},
+                  {"entity_id": "automation.a", "state": "off", "attributes": {}}]
+        h._ha.list_states.return_value = states
+
+        await h._show_automations(1)
+        first = h._state_views["automations"][1]
+        assert [a["entity_id"] for a in first] == ["automation.a", "automation.b"]
+        await h._show_automations(1, 1)
+        assert h._state_views["automations"][1] is first
+
+        h._ha.list_states.return_value = list(states)
+        await h._show_automations(1)
+        assert h._state_views["automations"][1] is not first
+
+    def test_states_grouped_by_domain_once(self) -> None:
+        from handlers import Handlers
+        h = Handlers.__new__(Handlers)
+        h._state_views = {}
+        states = [{"entity_id": "light.a"}, {"entity_id": "todo.x"}, {}, {"entity_id": "light.b"}]
+        by_domain = h._states_by_domain(states)
+        assert [s["entity_id"] for s in by_domain["light"]] == ["light.a", "light.b"]
+        assert list(by_domain) == ["light", "todo"]
+        assert h._states_by_domain(states) is by_domain
+
+
+class TestStatusEntities:
+    @pytest.mark.asyncio
+    async def test_status_summary_when_nothing_active(self, state_list_handler) -> None:
+        h = state_list_handler
+        h._cfg = MagicMock(status_entities=(), menu_domains_allowlist_set=frozenset({"light", "switch"}))
+        h._device_overrides = {}
+        h._ha.list_states.return_value = [
+            {"entity_id": "switch.a", "state": "off"},
+            {"entity_id": "light.a", "state": "off"},
+            {"entity_id": "light.b", "state": "off"},
+            {"entity_id": "sensor.t", "state": "21"},
+        ]
+        rows = await h._fetch_status_entities()
+        assert [(r["entity_id"], r["state"]) for r in rows] == [("light._summary", "2"), ("switch._summary", "1")]
+
+        h._ha.list_states.return_value = [{"entity_id": "light.a", "state": "on"}]
+        rows = await h._fetch_status_entities()
+        assert [r["entity_id"] for r in rows] == ["light.a"]
+
+
+class TestActiveNow:
+    @pytest.mark.asyncio
+    async def test_one_entity_per_device_by_domain_rank(self) -> None:
+        from handlers import Handlers
+        from registry import EntityInfo, HARegistry
+        h = Handlers.__new__(Handlers)
+        h._cfg = MagicMock(menu_domains_allowlist_set=frozenset({"light", "media_player", "switch"}),
+                           menu_page_size=8)
+        h._reg = HARegistry("", MagicMock())
+        h._reg.entities = {
+            "light.tv_backlight": EntityInfo(entity_id="light.tv_backlight", device_id="tv"),
+            "media_player.tv": EntityInfo(entity_id="media_player.tv", device_id="tv"),
+        }
+        h._reg._build_cross_refs()
+        h._device_overrides = {}
+        h._active_cache = {}
+        h._ha = MagicMock()
+        h._ha.list_states = AsyncMock(return_value=[
+            {"entity_id": "light.tv_backlight", "state": "on", "attributes": {}},
+            {"entity_id": "media_player.tv", "state": "playing", "attributes": {"friendly_name": "TV"}},
+            {"entity_id": "switch.fan", "state": "on", "attributes": {}},
+            {"entity_id": "switch.off", "state": "off", "attributes": {}},
+            {"entity_id": "sensor.t", "state": "21", "attributes": {}},
+        ])
+        h._send_or_edit = AsyncMock()
+        await h._show_active_now(1, 2, 0)
+        assert [e["entity_id"] for e in h._active_cache[1]] == ["media_player.tv", "switch.fan"]
+        assert h._active_cache[1][0]["friendly_name"] == "TV"
+
+    @pytest.mark.asyncio
+    async def test_page_without_cache_rebuilds_requested_page(self) -> None:
+        from handlers import Handlers
+        h = Handlers.__new__(Handlers)
+        h._active_cache = {}
+        h._search_cache = {1: ([{"entity_id": "light.search_hit"}], False)}
+        h._show_active_now = AsyncMock()
+        await h._active_page(1, 2, "u", "actp:3", MagicMock(answer=AsyncMock()))
+        h._show_active_now.assert_awaited_once_with(1, 2, 3)
+
+
+class TestVacuumRooms:
+    @pytest.mark.asyncio
+    async def test_room_map_read_once_per_segment_import(self) -> None:
+        from vacuum_adapter import VacuumAdapter
+        db = MagicMock()
+        db.get_vacuum_room_map = AsyncMock(return_value=[{"segment_id": "16", "segment_name": "Hall"}])
+        reg = MagicMock(segments_version=1)
+        vac = VacuumAdapter(MagicMock(), db, reg, "", "", ("living_room",))
+        rooms = await vac.get_rooms("vacuum.robo")
+        assert await vac.get_rooms("vacuum.robo") is rooms
+        assert (await vac.get_capabilities("vacuum.robo")).segment_count == 1
+        assert db.get_vacuum_room_map.await_count == 1
+        reg.segments_version = 2
+        db.get_vacuum_room_map.return_value = []
+        assert await vac.get_rooms("vacuum.robo") == [
+            {"segment_id": "living_room", "segment_name": "Living Room"},
+        ]
+        assert db.get_vacuum_room_map.await_count == 2